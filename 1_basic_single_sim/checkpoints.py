@@ -0,0 +1,131 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from model import State, step
+
+
+COLUMNS = ('time', 'mailly', 'moulin', 'unmet_mailly', 'unmet_moulin')
+
+
+class CheckpointedTrajectory:
+    """Exact random access to a simulation without storing its trajectory.
+
+    While the simulation runs, (t, State, bit-generator state) is saved every
+    `every` steps. traj[t0:t1] restores the closest checkpoint before t0 and
+    replays the steps with model.step, which gives back exactly the rows the
+    original run produced (every step always draws two numbers, so the random
+    stream is the same).
+
+    Attributes:
+        p1: Probability of movement from Mailly to Moulin
+        p2: Probability of movement from Moulin to Mailly
+        steps: Number of steps of the run
+        every: Number of steps between two checkpoints
+        checkpoints: List of (t, mailly, moulin, unmet_mailly, unmet_moulin, bit_generator_state)
+        metrics: Final metrics of the run (same as run_simulation)
+    """
+
+    def __init__(self, p1, p2, steps, every, checkpoints, metrics):
+        self.p1 = p1
+        self.p2 = p2
+        self.steps = steps
+        self.every = every
+        self.checkpoints = checkpoints
+        self.metrics = metrics
+
+    @classmethod
+    def record(cls, initial_mailly, initial_moulin, steps, p1, p2, seed, every=100000):
+        """Run the simulation once and keep only the checkpoints.
+
+        Args:
+            initial_mailly: Initial number of bikes at Mailly station
+            initial_moulin: Initial number of bikes at Moulin station
+            steps: Number of simulation steps to run
+            p1: Probability of movement from Mailly to Moulin
+            p2: Probability of movement from Moulin to Mailly
+            seed: Random seed for reproducibility
+            every: Number of steps between two checkpoints
+
+        Returns:
+            CheckpointedTrajectory of the run
+        """
+        state = State(mailly=initial_mailly,moulin=initial_moulin)
+        rng = np.random.default_rng(seed)
+        metrics = {'unmet_mailly':0,'unmet_moulin':0}
+        checkpoints = []
+        for i in range(steps):
+            if i % every == 0:
+                checkpoints.append((i, state.mailly, state.moulin, state.unmet_mailly, state.unmet_moulin,
+                                    rng.bit_generator.state))
+            step(state,p1,p2,rng,metrics)
+        metrics['mailly']=state.mailly
+        metrics['moulin']=state.moulin
+        metrics['final_imbalance']=state.mailly -state.moulin
+        return cls(p1, p2, steps, every, checkpoints, metrics)
+
+    def __len__(self):
+        return self.steps
+
+    def window(self, t0, t1):
+        """Replay rows t0 <= t < t1.
+
+        Returns:
+            Dictionary of 'time', 'mailly', 'moulin', 'unmet_mailly' and
+            'unmet_moulin' arrays, the same columns as trajectory.MemmapSink
+        """
+        t0 = max(t0, 0)
+        t1 = min(t1, self.steps)
+        if t1 <= t0:
+            return {name: np.empty(0, dtype=np.int64) for name in COLUMNS}
+        t, mailly, moulin, unmet_mailly, unmet_moulin, bit_state = self.checkpoints[t0 // self.every]
+        state = State(mailly=mailly, moulin=moulin, unmet_mailly=unmet_mailly, unmet_moulin=unmet_moulin)
+        rng = np.random.default_rng()
+        rng.bit_generator.state = bit_state
+        metrics = {'unmet_mailly':0,'unmet_moulin':0}
+        for i in range(t, t0):
+            step(state,self.p1,self.p2,rng,metrics)
+        mailly_counts = []
+        moulin_counts = []
+        unmet_mailly_counts = []
+        unmet_moulin_counts = []
+        for i in range(t0, t1):
+            mailly_counts.append(state.mailly)
+            moulin_counts.append(state.moulin)
+            unmet_mailly_counts.append(state.unmet_mailly)
+            unmet_moulin_counts.append(state.unmet_moulin)
+            step(state,self.p1,self.p2,rng,metrics)
+        return {
+            'time': np.arange(t0, t1),
+            'mailly': np.array(mailly_counts, dtype=np.int64),
+            'moulin': np.array(moulin_counts, dtype=np.int64),
+            'unmet_mailly': np.array(unmet_mailly_counts, dtype=np.int64),
+            'unmet_moulin': np.array(unmet_moulin_counts, dtype=np.int64),
+        }
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("checkpointed trajectories only support [t0:t1] slices")
+        t0, t1, _ = key.indices(self.steps)
+        return self.window(t0, t1)
+
+    def save(self, path):
+        """Save the checkpoints as JSON (a few KB, bit-generator states included)."""
+        with open(path, 'w') as f:
+            json.dump({
+                'p1': self.p1,
+                'p2': self.p2,
+                'steps': self.steps,
+                'every': self.every,
+                'checkpoints': self.checkpoints,
+                'metrics': self.metrics,
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load checkpoints saved with save()."""
+        with open(Path(path), 'r') as f:
+            data = json.load(f)
+        return cls(data['p1'], data['p2'], data['steps'], data['every'],
+                   [tuple(c) for c in data['checkpoints']], data['metrics'])
@@ -0,0 +1,164 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+# Compact trajectory file (.vtrj)
+#
+# Per step mailly moves by -1, 0 or +1 and mailly + moulin is constant, so a
+# trajectory is stored as its initial state plus one 2-bit code per step
+# (code = delta + 1), four steps per byte. mailly is also stored every
+# index_every steps, so any window decodes without reading from the start.
+#
+# layout: MAGIC | uint32 header size | json header | int32 index | uint8 codes
+MAGIC = b"VELOTRJ1"
+DEFAULT_INDEX_EVERY = 65536
+
+
+def _layout(steps, index_every, header_bytes):
+    """Return (index_offset, n_index, codes_offset, n_code_bytes)."""
+    index_offset = len(MAGIC) + 4 + len(header_bytes)
+    n_index = -(-steps // index_every)
+    codes_offset = index_offset + 4 * n_index
+    return index_offset, n_index, codes_offset, -(-steps // 4)
+
+
+class CompactWriter:
+    """Write a trajectory to a .vtrj file, block by block.
+
+    Can be used as the sink of stream_simulation: only the 'mailly' column of
+    each block is used, moulin is rebuilt from the fleet size.
+
+    Attributes:
+        path: Path of the .vtrj file
+        steps: Number of steps (rows) the file holds
+        total: Fleet size, mailly + moulin
+        index_every: A checkpoint of mailly is stored every index_every steps
+    """
+
+    def __init__(self, path, steps, total, index_every=DEFAULT_INDEX_EVERY):
+        if index_every % 4:
+            raise ValueError("index_every must be a multiple of 4")
+        self.path = Path(path)
+        self.steps = steps
+        self.total = total
+        self.index_every = index_every
+        self.rows = 0
+        self._last = None
+        self._pending = np.empty(0, dtype=np.uint8)
+
+        header = json.dumps({'steps': steps, 'total': total, 'index_every': index_every}).encode()
+        index_offset, n_index, codes_offset, n_code_bytes = _layout(steps, index_every, header)
+        with open(self.path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint32(len(header)).tobytes())
+            f.write(header)
+            f.truncate(codes_offset + n_code_bytes)
+        self._index = np.memmap(self.path, dtype='<i4', mode='r+', offset=index_offset, shape=(n_index,))
+        self._codes = np.memmap(self.path, dtype=np.uint8, mode='r+', offset=codes_offset, shape=(n_code_bytes,))
+        self._byte = 0
+
+    def write(self, columns):
+        """Encode one block of rows (a dict with at least a 'mailly' array)."""
+        mailly = np.asarray(columns['mailly'], dtype=np.int64)
+        if len(mailly) == 0:
+            return
+        first = self.rows
+        # checkpoints that fall inside this block
+        ticks = np.arange(-(-first // self.index_every) * self.index_every, first + len(mailly), self.index_every)
+        self._index[ticks // self.index_every] = mailly[ticks - first]
+
+        previous = mailly[0] if self._last is None else self._last
+        delta = np.diff(mailly, prepend=previous)
+        if np.any(np.abs(delta) > 1):
+            raise ValueError("mailly moves by more than one bike per step, cannot encode")
+        codes = np.concatenate([self._pending, (delta + 1).astype(np.uint8)])
+        n_full = len(codes) // 4 * 4
+        self._pack(codes[:n_full])
+        self._pending = codes[n_full:]
+        self._last = mailly[-1]
+        self.rows += len(mailly)
+
+    def close(self):
+        """Pack the last codes and flush the file."""
+        if len(self._pending):
+            self._pack(np.concatenate([self._pending, np.ones(4 - len(self._pending), dtype=np.uint8)]))
+            self._pending = np.empty(0, dtype=np.uint8)
+        if self.rows != self.steps:
+            raise ValueError(f"{self.rows} rows written, {self.steps} expected")
+        self._index.flush()
+        self._codes.flush()
+        del self._index, self._codes
+
+    def _pack(self, codes):
+        quads = codes.reshape(-1, 4)
+        packed = quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)
+        self._codes[self._byte:self._byte + len(packed)] = packed
+        self._byte += len(packed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+
+def encode_trajectory(path, mailly, total, index_every=DEFAULT_INDEX_EVERY):
+    """Write a whole mailly series (e.g. a timeseries DataFrame column) to a .vtrj file."""
+    mailly = np.asarray(mailly)
+    with CompactWriter(path, len(mailly), total, index_every) as writer:
+        writer.write({'mailly': mailly})
+
+
+class CompactTrajectory:
+    """Read a .vtrj file with random access.
+
+    traj[t0:t1] decodes only the window (starting from the closest stored
+    checkpoint) and returns a dict of 'time', 'mailly' and 'moulin' arrays;
+    traj[:] decodes everything. The file is memory-mapped, not read up front.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a compact trajectory file")
+            header_size = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+            header = f.read(header_size)
+        meta = json.loads(header)
+        self.steps = meta['steps']
+        self.total = meta['total']
+        self.index_every = meta['index_every']
+        index_offset, n_index, codes_offset, n_code_bytes = _layout(self.steps, self.index_every, header)
+        self._index = np.memmap(self.path, dtype='<i4', mode='r', offset=index_offset, shape=(n_index,))
+        self._codes = np.memmap(self.path, dtype=np.uint8, mode='r', offset=codes_offset, shape=(n_code_bytes,))
+
+    def __len__(self):
+        return self.steps
+
+    def mailly(self, t0, t1):
+        """Decode mailly for rows t0 <= t < t1."""
+        t0 = max(t0, 0)
+        t1 = min(t1, self.steps)
+        if t1 <= t0:
+            return np.empty(0, dtype=np.int64)
+        start = t0 // self.index_every * self.index_every
+        packed = self._codes[start // 4:-(-t1 // 4)]
+        codes = (packed[:, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+        delta = codes.reshape(-1)[:t1 - start].astype(np.int64) - 1
+        # the code of the checkpoint row is already included in the checkpoint
+        delta[0] = 0
+        return (self._index[start // self.index_every] + np.cumsum(delta))[t0 - start:]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("compact trajectories only support [t0:t1] slices")
+        t0, t1, _ = key.indices(self.steps)
+        mailly = self.mailly(t0, t1)
+        return {
+            'time': np.arange(t0, t0 + len(mailly)),
+            'mailly': mailly,
+            'moulin': self.total - mailly,
+        }
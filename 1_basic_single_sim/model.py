@@ -1,7 +1,6 @@
 from dataclasses import dataclass
 from typing import Tuple, Dict
 import numpy as np
-import pandas as pd
 
 
 @dataclass
@@ -74,7 +73,7 @@ def run_simulation(
     p1: float,
     p2: float,
     seed: int,
-) -> Tuple[pd.DataFrame, Dict[str, int]]:
+) -> Tuple['pd.DataFrame', Dict[str, int]]:
     """Run a complete bike-sharing simulation.
 
     Args:
@@ -112,6 +111,8 @@ def run_simulation(
         mailly_counts.append(state.mailly)
         moulin_counts.append(state.moulin)
         step(state,p1,p2,rng,metrics)
+    # imported here only: the streamed formats (stream_simulation) never need pandas
+    import pandas as pd
     results = pd.DataFrame({
         'time':times,
         'mailly': mailly_counts,
@@ -121,3 +122,66 @@ def run_simulation(
     metrics['moulin']=state.moulin
     metrics['final_imbalance']=state.mailly -state.moulin
     return (results,metrics)
+
+
+def stream_simulation(
+    initial_mailly: int,
+    initial_moulin: int,
+    steps: int,
+    p1: float,
+    p2: float,
+    seed: int,
+    sink,
+    block_size: int = 65536,
+) -> Dict[str, int]:
+    """Run a simulation and hand the trajectory to a sink block by block.
+
+    Args:
+        initial_mailly: Initial number of bikes at Mailly station
+        initial_moulin: Initial number of bikes at Moulin station
+        steps: Number of simulation steps to run
+        p1: Probability of movement from Mailly to Moulin
+        p2: Probability of movement from Moulin to Mailly
+        seed: Random seed for reproducibility
+        sink: Object with a write(columns) method, columns being a dict of
+            equal-length arrays 'time', 'mailly', 'moulin', 'unmet_mailly'
+            and 'unmet_moulin'
+        block_size: Number of steps handed to the sink at once
+
+    Returns:
+        Dictionary with the same metrics as run_simulation
+
+    Note:
+        - Same random draws and same rows as run_simulation, but at most
+          block_size steps are held in memory, so the run length is not
+          capped by RAM
+        - unmet_mailly/unmet_moulin columns are the running totals
+    """
+    state = State(mailly=initial_mailly,moulin=initial_moulin)
+    rng = np.random.default_rng(seed)
+    metrics = {'unmet_mailly':0,'unmet_moulin':0}
+    start = 0
+    while start < steps:
+        n = min(block_size, steps - start)
+        mailly_counts = []
+        moulin_counts = []
+        unmet_mailly = []
+        unmet_moulin = []
+        for i in range(n):
+            mailly_counts.append(state.mailly)
+            moulin_counts.append(state.moulin)
+            unmet_mailly.append(state.unmet_mailly)
+            unmet_moulin.append(state.unmet_moulin)
+            step(state,p1,p2,rng,metrics)
+        sink.write({
+            'time': np.arange(start, start + n),
+            'mailly': np.array(mailly_counts),
+            'moulin': np.array(moulin_counts),
+            'unmet_mailly': np.array(unmet_mailly),
+            'unmet_moulin': np.array(unmet_moulin),
+        })
+        start += n
+    metrics['mailly']=state.mailly
+    metrics['moulin']=state.moulin
+    metrics['final_imbalance']=state.mailly -state.moulin
+    return metrics
@@ -2,9 +2,11 @@ import argparse
 import json
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-from model import State, run_simulation
-import pandas as pd
+from model import State, run_simulation, stream_simulation
+from writer import BackgroundSink
+from trajectory import MemmapSink, load_trajectory
+from codec import CompactWriter, CompactTrajectory
+from checkpoints import CheckpointedTrajectory
 
 
 def parse_args():
@@ -20,6 +22,11 @@ def parse_args():
         - seed: Random seed (default: 0)
         - out_csv: Output CSV file path
         - plot: Boolean flag to generate plots
+        - format: Timeseries format, 'csv', 'npy' (streamed to a memory-mapped file)
+          or 'compact' (2-bit packed increments, see codec.py) or 'checkpoints'
+          (only replayable checkpoints, see checkpoints.py)
+        - checkpoint_every: Steps between two checkpoints with --format checkpoints
+        - plot_method: Downsampling of the plotted series, 'minmax' or 'lttb' (plotting.py)
     
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
@@ -33,6 +40,12 @@ def parse_args():
     my_parser.add_argument('--seed',type=int,default=0,help='Random seed (default: 0)')
     my_parser.add_argument('--out-csv',type=str,default='results.csv',help='Output CSV file path')
     my_parser.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
+    my_parser.add_argument('--format',choices=['csv','npy','compact','checkpoints'],default='csv',
+                           help="Timeseries format: csv, npy streamed to a memory-mapped file during the run, "
+                                "compact .vtrj with 2-bit packed increments, or checkpoints to replay any "
+                                "window later (default: csv)")
+    my_parser.add_argument('--checkpoint-every',type=int,default=100000,help='Steps between two checkpoints with --format checkpoints (default: 100000)')
+    my_parser.add_argument('--plot-method',choices=['minmax','lttb'],default='minmax',help='Downsampling of the plotted series: minmax keeps every spike, lttb the shape of the curve (default: minmax)')
     # i used action='store_true' because a had issues with type bool
     return my_parser.parse_args()
 
@@ -47,7 +60,11 @@ def main():
     4. Optionally generate and save plots
     
     Output files:
-    - Timeseries data: CSV with time, mailly, moulin columns
+    - Timeseries data: CSV with time, mailly, moulin columns, or with
+      --format npy a .npy file (plus unmet columns) readable with
+      trajectory.load_trajectory, or with --format compact a .vtrj file
+      readable with codec.CompactTrajectory, or with --format checkpoints
+      a _checkpoints.json file replayed by checkpoints.CheckpointedTrajectory
     - Metrics data: CSV with key-value pairs of simulation metrics
     - Optional plot: PNG showing bike counts over time for both stations
     
@@ -60,29 +77,45 @@ def main():
     #if we a parent in the arg outcsv we will create it
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    results, metrics =run_simulation(initial_mailly=my_args.init_mailly,initial_moulin=my_args.init_moulin,steps=my_args.steps,p1=my_args.p1,p2=my_args.p2,seed=my_args.seed)
-    results.to_csv(path_or_buf=output_path,index=False)
-    print(f"resuklts csv saved")
+    if my_args.format == 'npy':
+        # the trajectory never sits in memory: blocks go straight to the file
+        npy_path = output_path.with_suffix('.npy')
+        # blocks are flushed by a writer thread while the next ones are simulated
+        with BackgroundSink(MemmapSink(npy_path, my_args.steps)) as sink:
+            metrics = stream_simulation(initial_mailly=my_args.init_mailly,initial_moulin=my_args.init_moulin,steps=my_args.steps,p1=my_args.p1,p2=my_args.p2,seed=my_args.seed,sink=sink)
+        results = load_trajectory(npy_path)
+        print(f"results npy saved")
+    elif my_args.format == 'compact':
+        vtrj_path = output_path.with_suffix('.vtrj')
+        with BackgroundSink(CompactWriter(vtrj_path, my_args.steps, my_args.init_mailly + my_args.init_moulin)) as sink:
+            metrics = stream_simulation(initial_mailly=my_args.init_mailly,initial_moulin=my_args.init_moulin,steps=my_args.steps,p1=my_args.p1,p2=my_args.p2,seed=my_args.seed,sink=sink)
+        results = CompactTrajectory(vtrj_path)[:] if my_args.plot else None
+        print(f"results vtrj saved")
+    elif my_args.format == 'checkpoints':
+        traj = CheckpointedTrajectory.record(initial_mailly=my_args.init_mailly,initial_moulin=my_args.init_moulin,steps=my_args.steps,p1=my_args.p1,p2=my_args.p2,seed=my_args.seed,every=my_args.checkpoint_every)
+        traj.save(output_path.with_name(output_path.stem + "_checkpoints.json"))
+        metrics = traj.metrics
+        # plotting needs every row: replay the whole run
+        results = traj[:] if my_args.plot else None
+        print(f"results checkpoints saved")
+    else:
+        results, metrics =run_simulation(initial_mailly=my_args.init_mailly,initial_moulin=my_args.init_moulin,steps=my_args.steps,p1=my_args.p1,p2=my_args.p2,seed=my_args.seed)
+        results.to_csv(path_or_buf=output_path,index=False)
+        print(f"resuklts csv saved")
     
     
     metrics_path = output_path.with_name(output_path.stem + "_metrics.csv")
-    # i reimported here pandas to reuse .to_csv
-    pd.Series(metrics).to_csv(path_or_buf=metrics_path,sep='\t',header=False)
+    # same file as pd.Series(metrics).to_csv(sep='\t', header=False), without loading pandas
+    with open(metrics_path, 'w') as f:
+        f.writelines(f"{name}\t{value}\n" for name, value in metrics.items())
     print(f"metrics csv saved")
     
     
     if my_args.plot:
-        plt.figure(figsize=(10, 10))
-        plt.plot(results['time'], results['mailly'], label='Mailly')
-        plt.plot(results['time'], results['moulin'], label='Moulin')
-        plt.xlabel('Time Step')
-        plt.ylabel('Number of Bikes')
-        plt.title('Bike Sharing Simulation')
-        plt.legend()
-        plt.grid(True)
-        
+        # a few thousand points whatever the number of steps (plotting.py, matplotlib loaded only now)
+        from plotting import summarize_run, draw_run
         plot_path = output_path.with_name(output_path.stem + "_plot.png")
-        plt.savefig(plot_path)
+        draw_run(summarize_run(results, method=my_args.plot_method), 'Bike Sharing Simulation', plot_path)
         print(f"Plot saved")
 if __name__ == "__main__":
     main()
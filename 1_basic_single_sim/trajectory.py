@@ -0,0 +1,91 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+# one row per step, same columns as the csv output plus the unmet counters
+TRAJECTORY_DTYPE = np.dtype([
+    ('time', '<i8'),
+    ('mailly', '<i4'),
+    ('moulin', '<i4'),
+    ('unmet_mailly', '<i8'),
+    ('unmet_moulin', '<i8'),
+])
+
+
+def _rows_path(path):
+    """Sidecar file holding the number of rows already flushed."""
+    return path.with_name(path.name + ".rows")
+
+
+class MemmapSink:
+    """Stream a trajectory into a preallocated .npy file.
+
+    The file is created at full size up front (np.lib.format.open_memmap) and
+    every block written by stream_simulation is copied into it and flushed to
+    disk. After each flush the number of valid rows is written to a small
+    "<file>.rows" sidecar, so if the run crashes the prefix already on disk
+    stays readable with load_trajectory.
+
+    Attributes:
+        path: Path of the .npy file
+        steps: Total number of rows reserved in the file
+        rows: Number of rows written so far
+    """
+
+    def __init__(self, path, steps):
+        self.path = Path(path)
+        self.steps = steps
+        self.rows = 0
+        self._data = np.lib.format.open_memmap(self.path, mode='w+', dtype=TRAJECTORY_DTYPE, shape=(steps,))
+        self._write_rows()
+
+    def write(self, columns):
+        """Copy one block of columns into the file and flush it."""
+        n = len(columns['time'])
+        block = self._data[self.rows:self.rows + n]
+        for name in TRAJECTORY_DTYPE.names:
+            block[name] = columns[name]
+        self._data.flush()
+        self.rows += n
+        self._write_rows()
+
+    def close(self):
+        """Flush and release the memory map."""
+        self._data.flush()
+        del self._data
+
+    def _write_rows(self):
+        # write then rename: the sidecar never holds a half-written number
+        rows_path = _rows_path(self.path)
+        tmp_path = rows_path.with_name(rows_path.name + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows': self.rows, 'steps': self.steps}, f)
+        os.replace(tmp_path, rows_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_trajectory(path):
+    """Open a trajectory written by MemmapSink without reading it into memory.
+
+    Args:
+        path: Path of the .npy file
+
+    Returns:
+        Read-only structured memmap with the fields of TRAJECTORY_DTYPE,
+        cut to the rows actually written (e.g. traj['mailly'] is a zero-copy view)
+    """
+    path = Path(path)
+    data = np.load(path, mmap_mode='r')
+    rows_path = _rows_path(path)
+    if rows_path.exists():
+        with open(rows_path, 'r') as f:
+            data = data[:json.load(f)['rows']]
+    return data
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import Tuple, Dict
+from typing import Callable, Tuple, Dict, List
 import numpy as np
-import pandas as pd
+
+from stationarity import check_stationary
 
 
 @dataclass
@@ -67,6 +68,162 @@ def step(
     return state
 
 
+@dataclass
+class ThresholdPolicy:
+    """Rebalancing rule: every `period` steps, when |mailly - moulin| exceeds
+    `threshold`, an operator moves `k` bikes from the fuller station to the other.
+
+    Attributes:
+        threshold: Imbalance above which bikes are moved
+        k: Bikes moved per intervention (fewer if the station has fewer)
+        period: Steps between two looks at the imbalance
+    """
+
+    threshold: int
+    k: int
+    period: int = 1
+
+    def __call__(self, state: State, t: int) -> int:
+        """Apply the rule before the demand of step t; return the number of bikes moved."""
+        if t % self.period:
+            return 0
+        imbalance = state.mailly - state.moulin
+        if imbalance > self.threshold:
+            n = min(self.k, state.mailly)
+            state.mailly -= n
+            state.moulin += n
+            return n
+        if -imbalance > self.threshold:
+            n = min(self.k, state.moulin)
+            state.moulin -= n
+            state.mailly += n
+            return n
+        return 0
+
+
+class Observer:
+    """Hooks run_simulation calls as the simulation goes: subclass it and
+    override the ones you need, the others are never called.
+
+    Attributes:
+        every: on_step is called before every step t with t % every == 0 (0: never)
+
+    Note:
+        - station is 'mailly' or 'moulin', t the step
+        - With no observer run_simulation takes a loop without any hook,
+          so production sweeps pay nothing for them
+    """
+
+    every = 0
+
+    def on_trip(self, t: int, station: str) -> None:
+        """A bike left station during step t."""
+
+    def on_unmet(self, t: int, station: str) -> None:
+        """A user found station empty during step t."""
+
+    def on_empty(self, t: int, station: str) -> None:
+        """station gave its last bike during step t."""
+
+    def on_step(self, t: int, state: State) -> None:
+        """State before step t (read only)."""
+
+
+# uniforms drawn at once by _fast_loop: the same stream as one rng.random() per draw
+DRAW_BLOCK = 4096
+
+
+def _fast_loop(state, start, stop, p1, p2, rng, res):
+    """Steps start .. stop - 1 of run_simulation without hooks: step() with local variables."""
+    mailly, moulin = state.mailly, state.moulin
+    unmet_mailly, unmet_moulin = state.unmet_mailly, state.unmet_moulin
+    record_mailly = res["mailly"].append
+    record_moulin = res["moulin"].append
+    record_unmet_mailly = res["unmet_mailly"].append
+    record_unmet_moulin = res["unmet_moulin"].append
+    record_imbalance = res["final_imbalance"].append
+    for block in range(start, stop, DRAW_BLOCK):
+        u = rng.random(2 * (min(block + DRAW_BLOCK, stop) - block)).tolist()
+        for k in range(0, len(u), 2):
+            record_mailly(mailly)
+            record_moulin(moulin)
+            record_unmet_mailly(unmet_mailly)
+            record_unmet_moulin(unmet_moulin)
+            record_imbalance(mailly - moulin)
+            if u[k] < p1:
+                if mailly:
+                    mailly -= 1
+                    moulin += 1
+                else:
+                    unmet_mailly += 1
+            if u[k + 1] < p2:
+                if moulin:
+                    moulin -= 1
+                    mailly += 1
+                else:
+                    unmet_moulin += 1
+    state.mailly, state.moulin = mailly, moulin
+    state.unmet_mailly, state.unmet_moulin = unmet_mailly, unmet_moulin
+
+
+def _hooks(observers, name):
+    """Bound `name` hooks of the observers that override it."""
+    default = getattr(Observer, name)
+    return [getattr(o, name) for o in observers if getattr(type(o), name, default) is not default]
+
+
+class _ObservedLoop:
+    """Steps of run_simulation with rebalance and/or observers (same draws as step())."""
+
+    def __init__(self, observers, rebalance):
+        self.rebalance = rebalance
+        self.n_moves = 0
+        self.on_trip = _hooks(observers, 'on_trip')
+        self.on_unmet = _hooks(observers, 'on_unmet')
+        self.on_empty = _hooks(observers, 'on_empty')
+        self.on_step = [(o.every, o.on_step) for o in observers if o.every and _hooks([o], 'on_step')]
+
+    def _trip(self, t, station, left):
+        for hook in self.on_trip:
+            hook(t, station)
+        if not left:
+            for hook in self.on_empty:
+                hook(t, station)
+
+    def __call__(self, state, start, stop, p1, p2, rng, res):
+        random = rng.random
+        for t in range(start, stop):
+            res["mailly"].append(state.mailly)
+            res["moulin"].append(state.moulin)
+            res["unmet_mailly"].append(state.unmet_mailly)
+            res["unmet_moulin"].append(state.unmet_moulin)
+            res["final_imbalance"].append(state.mailly - state.moulin)
+            for every, hook in self.on_step:
+                if t % every == 0:
+                    hook(t, state)
+            if self.rebalance is not None:
+                res["moves"].append(self.n_moves)
+                self.n_moves += self.rebalance(state, t)
+            if random() < p1:
+                if state.mailly:
+                    state.mailly -= 1
+                    state.moulin += 1
+                    self._trip(t, 'mailly', state.mailly)
+                else:
+                    state.unmet_mailly += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'mailly')
+            if random() < p2:
+                if state.moulin:
+                    state.moulin -= 1
+                    state.mailly += 1
+                    self._trip(t, 'moulin', state.moulin)
+                else:
+                    state.unmet_moulin += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'moulin')
+
+
 def run_simulation(
     initial_mailly: int,
     initial_moulin: int,
@@ -74,6 +231,10 @@ def run_simulation(
     p1: float,
     p2: float,
     seed: int,
+    stop_tol: float = None,
+    check_every: int = 1000,
+    rebalance: Callable[[State, int], int] = None,
+    observers: List['Observer'] = None,
 ) -> Dict[str, list]:
     """Run a complete bike-sharing simulation.
 
@@ -84,6 +245,15 @@ def run_simulation(
         p1: Probability of movement from Mailly to Moulin
         p2: Probability of movement from Moulin to Mailly
         seed: Random seed for reproducibility
+        stop_tol: Stop early once the run is stationary within this tolerance
+            (stationarity.check_stationary), None to run all the steps
+        check_every: Steps between two stationarity checks at the start;
+            later checks are 10% of the steps apart, so they cost O(steps) in all
+        rebalance: Operator intervention, called as rebalance(state, t) after
+            step t is recorded and before its demand, returns the bikes it
+            moved (e.g. ThresholdPolicy); None for no intervention
+        observers: Observer instances called on trips, unmet requests,
+            stations running empty and every `every` steps; None for none
 
     Returns:
         - Dictionary indexed by step with metrics including:
@@ -92,33 +262,142 @@ def run_simulation(
             - 'unmet_mailly': Number of unmet requests at Mailly
             - 'unmet_moulin': Number of unmet requests at Moulin
             - 'final_imbalance': Final difference between station bike counts
+            - 'moves': Bikes moved by rebalance so far (only with rebalance)
 
     Note:
         - Create the state object with initial bike counts
         - Initialize metrics dictionary with appropriate counters
         - Record state at each time step for the DataFrame
         - Calculate final_imbalance for each step as mailly - moulin
+        - A run stopped early at step n has lists of length n, exactly those
+          of the same run with steps=n
+        - Without rebalance nor observers the steps run in _fast_loop (no
+          State, no metrics dict, uniforms drawn by blocks), otherwise in
+          an _ObservedLoop; both follow step() draw for draw, so they give the
+          same run
     """
-    state = State(mailly=initial_mailly,moulin=initial_moulin)
     rng = np.random.default_rng(seed)
-    metrics = {'unmet_mailly':0,'unmet_moulin':0}
-    mailly = []
-    moulin = []
-    unmet_mailly = []
-    unmet_moulin = []
-    final_imbalance = []
-    for i in range(steps):
-        mailly.append(state.mailly)
-        moulin.append(state.moulin)
-        unmet_mailly.append(state.unmet_mailly)
-        unmet_moulin.append(state.unmet_moulin)
-        final_imbalance.append(state.mailly - state.moulin)
-        step(state,p1,p2,rng,metrics)
-    return {
+    res = {"mailly": [], "moulin": [], "unmet_mailly": [], "unmet_moulin": [], "final_imbalance": []}
+    if rebalance is not None:
+        res["moves"] = []
+    state = State(mailly=initial_mailly,moulin=initial_moulin)
+    if rebalance is None and not observers:
+        loop = _fast_loop
+    else:
+        loop = _ObservedLoop(observers or [], rebalance)
+    # the steps go by segments between two stationarity checks
+    i = 0
+    next_check = check_every if stop_tol is not None else steps
+    while i < steps:
+        stop = min(next_check, steps)
+        loop(state, i, stop, p1, p2, rng, res)
+        i = stop
+        if i == steps or check_stationary(res, p1, p2, stop_tol)[0]:
+            break
+        next_check = i + max(check_every, i // 10)
+    return res
+        
+
+def run_batch(
+    initial_mailly: int,
+    initial_moulin: int,
+    steps: int,
+    p1: float,
+    p2: float,
+    rngs: list,
+    block_size: int = 4096,
+    antithetic=None,
+    policy=None,
+) -> Dict[str, np.ndarray]:
+    """Run several replicates of the same parameter point side by side.
+
+    Replicate r draws its uniforms from rngs[r] in the same order as step()
+    (two per step), so it gives exactly the final values run_simulation
+    would with that generator; the step loop works on numpy arrays over the
+    replicates instead of one State at a time.
+
+    initial_mailly, initial_moulin, p1 and p2 may also be arrays whose last
+    axis is the replicate (or 1): e.g. p1 of shape (G, 1) runs G points at
+    once, replicate r of every point driven by the same rngs[r] (common
+    random numbers).
+
+    Args:
+        initial_mailly: Initial number of bikes at Mailly station
+        initial_moulin: Initial number of bikes at Moulin station
+        steps: Number of simulation steps to run
+        p1: Probability of movement from Mailly to Moulin
+        p2: Probability of movement from Moulin to Mailly
+        rngs: One np.random.Generator per replicate
+        block_size: Number of steps whose uniforms are drawn at once
+        antithetic: Optional booleans, one per replicate: those replicates
+            use 1 - u instead of every uniform u of their generator
+        policy: Optional (threshold, k, period) of a ThresholdPolicy applied
+            to every replicate; each may be an array broadcast like the
+            parameters, e.g. shape (C, 1) to run C policies with common
+            random numbers
+
+    Returns:
+        Dictionary with the last values of run_simulation ('mailly', 'moulin',
+        'unmet_mailly', 'unmet_moulin', 'final_imbalance'), one array entry
+        per replicate (an array of the broadcast shape of the parameters);
+        with a policy, also 'moves': the bikes it moved
+
+    Note:
+        Like run_simulation, the last recorded values are the state before
+        the last step
+    """
+    shape = np.broadcast_shapes(np.shape(initial_mailly), np.shape(initial_moulin),
+                                np.shape(p1), np.shape(p2), (len(rngs),),
+                                *(np.shape(value) for value in (policy or ())))
+    total = np.broadcast_to(np.add(initial_mailly, initial_moulin), shape)
+    if antithetic is not None:
+        antithetic = np.asarray(antithetic, dtype=bool)
+    mailly = np.broadcast_to(initial_mailly, shape).astype(np.int64)
+    requests_mailly = np.zeros(shape, dtype=np.int64)
+    requests_moulin = np.zeros(shape, dtype=np.int64)
+    moved_mailly = np.zeros(shape, dtype=np.int64)
+    moved_moulin = np.zeros(shape, dtype=np.int64)
+    moves = np.zeros(shape, dtype=np.int64)
+    if policy is not None:
+        threshold, move, period = policy
+    # keep the (steps, *shape) request blocks around 16M entries
+    block_size = max(1, min(block_size, (1 << 24) // mailly.size))
+    # steps - 1 transitions: the state after the last step is never recorded
+    for t0 in range(0, max(steps - 1, 0), block_size):
+        n = min(block_size, steps - 1 - t0)
+        u = np.stack([rng.random((n, 2)) for rng in rngs], axis=1)
+        if antithetic is not None:
+            u[:, antithetic] = 1.0 - u[:, antithetic]
+        # (n, 1, ..., 1, replicates) against the parameters' shape
+        u = u.reshape((n,) + (1,) * (len(shape) - 1) + (len(rngs), 2))
+        want_mailly = u[..., 0] < p1
+        want_moulin = u[..., 1] < p2
+        requests_mailly += want_mailly.sum(axis=0)
+        requests_moulin += want_moulin.sum(axis=0)
+        for k in range(n):
+            if policy is not None and (np.ndim(period) or (t0 + k) % period == 0):
+                # ThresholdPolicy.__call__ on every replicate at once
+                due = (t0 + k) % period == 0
+                imbalance = 2 * mailly - total
+                out = np.where(due & (imbalance > threshold), np.minimum(move, mailly), 0)
+                back = np.where(due & (-imbalance > threshold), np.minimum(move, total - mailly), 0)
+                mailly += back - out
+                moves += out + back
+            # mailly -> moulin needs a bike at mailly, then moulin -> mailly one at moulin
+            ok = want_mailly[k] & (mailly > 0)
+            mailly -= ok
+            moved_mailly += ok
+            ok = want_moulin[k] & (mailly < total)
+            mailly += ok
+            moved_moulin += ok
+    moulin = total - mailly
+    res = {
     "mailly": mailly,
     "moulin": moulin,
-    "unmet_mailly": unmet_mailly,
-    "unmet_moulin": unmet_moulin,
-    "final_imbalance": final_imbalance
+    "unmet_mailly": requests_mailly - moved_mailly,
+    "unmet_moulin": requests_moulin - moved_moulin,
+    "final_imbalance": mailly - moulin
     }
-        
\ No newline at end of file
+    if policy is not None:
+        res["moves"] = moves
+    return res
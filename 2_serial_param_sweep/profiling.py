@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import numpy as np
+
+
+# what phase() hands out when profiling is off: entering it costs next to nothing
+_OFF = nullcontext()
+
+
+def task_clock():
+    """Start marks (wall, cpu) of a task; cpu is the calling thread's, so threads do not see each other."""
+    return time.perf_counter(), time.thread_time()
+
+
+def task_times(start):
+    """Wall and CPU seconds since task_clock() returned start."""
+    return time.perf_counter() - start[0], time.thread_time() - start[1]
+
+
+class Profiler:
+    """Wall and CPU time per phase and per task of a runner, written as timing.json.
+
+    Phases are named blocks (`with profiler.phase('read_params'):`), summed
+    over their calls and over the threads that run them. Tasks are the
+    individual simulations, timed where they run (thread, process or rank)
+    and handed over with add_task. Disabled, every method returns at once.
+
+    Attributes:
+        enabled: Whether anything is recorded
+        capture: None, 'cprofile' (profile.prof and profile.txt next to
+            timing.json, for the calling process) or 'tracemalloc' (peak
+            memory per phase and the top allocation sites)
+    """
+
+    def __init__(self, enabled=False, capture=None):
+        self.enabled = enabled
+        self.capture = capture if enabled else None
+        self.phases = {}
+        self.tasks = {'id': [], 'wall': [], 'cpu': []}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._profile = None
+        if self.capture == 'cprofile':
+            # imported on use, like pstats below: the per-task entry points start faster
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.capture == 'tracemalloc':
+            tracemalloc.start()
+
+    def phase(self, name):
+        """Context manager timing one phase (a no-op when disabled)."""
+        if not self.enabled:
+            return _OFF
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        start = task_clock()
+        try:
+            yield
+        finally:
+            wall, cpu = task_times(start)
+            with self._lock:
+                entry = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+                entry['wall'] += wall
+                entry['cpu'] += cpu
+                entry['calls'] += 1
+                if self.capture == 'tracemalloc':
+                    entry['peak_bytes'] = max(entry.get('peak_bytes', 0), tracemalloc.get_traced_memory()[1])
+
+    def task(self, task_id, phase='simulate'):
+        """Context manager timing one task, also summed into `phase` (a no-op when disabled)."""
+        if not self.enabled:
+            return _OFF
+        return self._task(task_id, phase)
+
+    @contextmanager
+    def _task(self, task_id, phase):
+        start = task_clock()
+        with self._phase(phase):
+            yield
+        self.add_task(task_id, *task_times(start))
+
+    def iterate(self, name, iterable):
+        """iterable, with the time spent producing each item timed as phase `name` (lazy readers, iterrows)."""
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name, iterator):
+        while True:
+            with self._phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def wrap(self, name, function):
+        """function, timed as phase `name` wherever it is called (e.g. on a writer thread)."""
+        if not self.enabled:
+            return function
+
+        def timed(*args, **kwargs):
+            with self._phase(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def add_task(self, task_id, wall, cpu):
+        """Record one task timed with task_clock/task_times."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.tasks['id'].append(int(task_id))
+            self.tasks['wall'].append(float(wall))
+            self.tasks['cpu'].append(float(cpu))
+
+    def summary(self):
+        """Everything recorded so far, as a JSON-able dict."""
+        times = os.times()
+        summary = {
+            'wall': time.perf_counter() - self._start,
+            # this process, all threads; children: pool workers already joined
+            'cpu': time.process_time() - self._cpu_start,
+            'children_cpu': times.children_user + times.children_system,
+            'phases': self.phases,
+        }
+        if self.tasks['id']:
+            wall = np.array(self.tasks['wall'])
+            summary['task_stats'] = {
+                'count': len(wall),
+                'wall_sum': float(wall.sum()),
+                'cpu_sum': float(np.sum(self.tasks['cpu'])),
+                'wall_mean': float(wall.mean()),
+                'wall_p50': float(np.percentile(wall, 50)),
+                'wall_p95': float(np.percentile(wall, 95)),
+                'wall_max': float(wall.max()),
+            }
+            summary['tasks'] = self.tasks
+        return summary
+
+    def save_capture(self, prefix):
+        """Stop the capture and save it (<prefix>.prof and <prefix>.txt for cProfile).
+
+        Returns:
+            What to add to the summary: the cProfile file or the tracemalloc
+            peak and top allocation sites ({} without capture)
+        """
+        prefix = Path(prefix)
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(prefix.with_suffix('.prof'))
+            import pstats
+            with open(prefix.with_suffix('.txt'), 'w') as f:
+                pstats.Stats(self._profile, stream=f).sort_stats('cumulative').print_stats(40)
+            self._profile = None
+            return {'cprofile': str(prefix.with_suffix('.prof'))}
+        if self.capture == 'tracemalloc' and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            capture = {
+                'peak_bytes': tracemalloc.get_traced_memory()[1],
+                'top': [{'where': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+                        for stat in snapshot.statistics('lineno')[:20]],
+            }
+            tracemalloc.stop()
+            return {'tracemalloc': capture}
+        return {}
+
+    def write(self, path, **extra):
+        """Stop the capture and write timing.json at path (capture files: profile.* next to it); extra keys are added as is."""
+        if not self.enabled:
+            return
+        path = Path(path)
+        summary = self.summary()
+        summary.update(self.save_capture(path.with_name('profile')))
+        summary.update(extra)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=4)
+        print(f"timing saved to: {path}")
@@ -0,0 +1,200 @@
+import argparse
+import json
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from model import run_batch
+from streams import generator, stream
+
+
+def policy_grid(fleet, periods):
+    """Every ThresholdPolicy worth trying for a fleet size.
+
+    Thresholds go from 0 to fleet and k from 1 to fleet. |mailly - moulin|
+    never exceeds the fleet, so threshold = fleet never acts: not
+    rebalancing at all is one of the candidates.
+
+    Returns:
+        Tuple of arrays (threshold, k, period), one entry per candidate
+    """
+    threshold, k, period = np.meshgrid(np.arange(fleet + 1), np.arange(1, fleet + 1), np.asarray(periods), indexing='ij')
+    return threshold.ravel(), k.ravel(), period.ravel()
+
+
+def evaluate(policies, init_mailly, init_moulin, steps, p1, p2, first, count, seed=0, move_cost=1.0):
+    """Cost of candidate policies on replicates first .. first + count - 1.
+
+    Replicate r is driven by the stream (seed, 0, r) whatever the policy
+    (common random numbers): two policies are compared on the same demand.
+
+    Args:
+        policies: Tuple of arrays (threshold, k, period), or None for no rebalancing
+        init_mailly, init_moulin, steps, p1, p2: The operating point
+        first, count: Replicates to run
+        seed: Root seed of the streams
+        move_cost: Cost of moving one bike, in unmet requests
+
+    Returns:
+        Array (candidates, count) of unmet_mailly + unmet_moulin + move_cost * moves
+    """
+    rngs = [generator(stream(seed, 0, r)) for r in range(first, first + count)]
+    if policies is None:
+        final = run_batch(init_mailly, init_moulin, steps, p1, p2, rngs)
+        return (final['unmet_mailly'] + final['unmet_moulin'])[None, :].astype(np.float64)
+    policy = tuple(np.asarray(value)[:, None] for value in policies)
+    final = run_batch(init_mailly, init_moulin, steps, p1, p2, rngs, policy=policy)
+    return final['unmet_mailly'] + final['unmet_moulin'] + move_cost * final['moves']
+
+
+def _evaluate_chunk(args):
+    return evaluate(*args)
+
+
+class _NoPool:
+    """Stand-in for multiprocessing.Pool with one worker: map in this process."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, function, iterable):
+        return [function(item) for item in iterable]
+
+
+def optimize(init_mailly, init_moulin, steps, p1, p2, periods=(1, 5, 10, 50, 100), move_cost=1.0,
+             replicates=8, keep=0.25, max_replicates=256, seed=0, workers=1, holdout=None):
+    """Search the ThresholdPolicy that minimizes unmet demand plus moves.
+
+    Successive halving: every candidate of policy_grid runs on `replicates`
+    replicates, the best `keep` fraction (by mean cost) runs on as many new
+    replicates again, and so on until one candidate is left or a candidate
+    has max_replicates replicates. Every candidate sees the same replicates
+    (common random numbers), so the ranking depends on the differences
+    between policies rather than on the demand each one happened to get.
+    Each round is one model.run_batch call over all candidates and
+    replicates, split across `workers` processes.
+
+    The winner is picked as the lowest mean among many noisy candidates, so
+    its cost on the replicates that picked it is biased downwards (winner's
+    curse). The reported cost and improvement come from `holdout` fresh
+    replicates (default: as many as the search used), never seen by the
+    search, on which the winner and no rebalancing run again.
+
+    Returns:
+        Dictionary with the best policy, its mean cost and standard error,
+        the cost without rebalancing, the paired improvement and its
+        standard error (all on the fresh replicates), the winner's mean cost
+        on the search replicates, the number of candidates and of
+        simulations, and the time taken
+    """
+    start = time.perf_counter()
+    fleet = int(init_mailly) + int(init_moulin)
+    candidates = policy_grid(fleet, periods)
+    n_candidates = len(candidates[0])
+    costs = np.empty((n_candidates, 0))
+    n = 0
+    size = replicates
+    n_simulations = 0
+    with Pool(workers) if workers > 1 else _NoPool() as pool:
+        while True:
+            # chunks of candidates, same replicates in every chunk
+            chunks = [tuple(value[i::workers] for value in candidates) for i in range(min(workers, len(candidates[0])))]
+            results = pool.map(_evaluate_chunk, [(chunk, init_mailly, init_moulin, steps, p1, p2, n, size, seed, move_cost)
+                                                 for chunk in chunks])
+            new = np.empty((len(candidates[0]), size))
+            for i, result in enumerate(results):
+                new[i::workers] = result
+            costs = np.concatenate([costs, new], axis=1)
+            n_simulations += new.size
+            n += size
+            if len(candidates[0]) == 1 or n >= max_replicates:
+                break
+            best = np.argsort(costs.mean(axis=1), kind='stable')[:max(1, int(np.ceil(len(candidates[0]) * keep)))]
+            candidates = tuple(value[best] for value in candidates)
+            costs = costs[best]
+            size = min(n, max_replicates - n)
+    winner = int(np.argmin(costs.mean(axis=1)))
+    policy = tuple(value[winner:winner + 1] for value in candidates)
+    # fresh replicates n .. n + holdout - 1: an unbiased estimate of the winner
+    holdout = n if holdout is None else int(holdout)
+    cost = evaluate(policy, init_mailly, init_moulin, steps, p1, p2, n, holdout, seed, move_cost)[0]
+    baseline = evaluate(None, init_mailly, init_moulin, steps, p1, p2, n, holdout, seed)[0]
+    n_simulations += 2 * holdout
+    return {
+        'policy': {name: int(value[0]) for name, value in zip(('threshold', 'k', 'period'), policy)},
+        'cost': float(cost.mean()),
+        'cost_se': float(cost.std(ddof=1) / np.sqrt(holdout)) if holdout > 1 else float('nan'),
+        'baseline_cost': float(baseline.mean()),
+        'improvement': float((baseline - cost).mean()),
+        'improvement_se': float((baseline - cost).std(ddof=1) / np.sqrt(holdout)) if holdout > 1 else float('nan'),
+        'search_cost': float(costs[winner].mean()),
+        'replicates': holdout,
+        'search_replicates': n,
+        'candidates': n_candidates,
+        'simulations': n_simulations,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def parse_args():
+    """Parse command line arguments for the rebalancing optimizer.
+
+    Returns:
+        Parsed arguments containing:
+        - init_mailly, init_moulin, steps, p1, p2: The operating point
+        - periods: Periods (steps between looks at the imbalance) to try
+        - move_cost: Cost of moving one bike, in unmet requests
+        - replicates: Replicates of every candidate in the first round
+        - keep: Fraction of the candidates kept after each round
+        - max_replicates: Replicates of the last candidates
+        - seed: Root seed of the streams
+        - workers: Number of worker processes
+        - holdout: Fresh replicates the winner and no rebalancing are evaluated on (default: as many as the search used)
+        - out: Optional JSON file for the result
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="search a threshold rebalancing policy")
+    my_parser.add_argument('--init-mailly',type=int,required=True,help='Initial bikes at Mailly')
+    my_parser.add_argument('--init-moulin',type=int,required=True,help='Initial bikes at Moulin')
+    my_parser.add_argument('--steps',type=int,required=True,help='Number of simulation steps')
+    my_parser.add_argument('--p1',type=float,required=True,help='Probability Mailly->Moulin')
+    my_parser.add_argument('--p2',type=float,required=True,help='Probability Moulin->Mailly')
+    my_parser.add_argument('--periods',type=int,nargs='+',default=[1, 5, 10, 50, 100],help='Periods to try (default: 1 5 10 50 100)')
+    my_parser.add_argument('--move-cost',type=float,default=1.0,help='Cost of moving one bike, in unmet requests (default: 1)')
+    my_parser.add_argument('--replicates',type=int,default=8,help='Replicates per candidate in the first round (default: 8)')
+    my_parser.add_argument('--keep',type=float,default=0.25,help='Fraction of the candidates kept after each round (default: 0.25)')
+    my_parser.add_argument('--max-replicates',type=int,default=256,help='Replicates of the last candidates (default: 256)')
+    my_parser.add_argument('--seed',type=int,default=0,help='Root seed of the streams (default: 0)')
+    my_parser.add_argument('--workers',type=int,default=1,help='Number of worker processes (default: 1)')
+    my_parser.add_argument('--holdout',type=int,default=None,help='Fresh replicates the reported cost and improvement are measured on (default: as many as the search used)')
+    my_parser.add_argument('--out',type=str,default=None,help='Write the result to this JSON file')
+    return my_parser.parse_args()
+
+
+def main():
+    """Search the best policy for one operating point and print it."""
+    args = parse_args()
+    result = optimize(args.init_mailly, args.init_moulin, args.steps, args.p1, args.p2, args.periods, args.move_cost,
+                      args.replicates, args.keep, args.max_replicates, args.seed, args.workers, args.holdout)
+    policy = result['policy']
+    if policy['threshold'] >= args.init_mailly + args.init_moulin:
+        print("best policy: no rebalancing")
+    else:
+        print(f"best policy: move {policy['k']} bikes when |mailly - moulin| > {policy['threshold']}, every {policy['period']} steps")
+    print(f"cost {result['cost']:.1f} +/- {result['cost_se']:.1f} (no rebalancing: {result['baseline_cost']:.1f}, "
+          f"improvement {result['improvement']:.1f} +/- {result['improvement_se']:.1f}) on {result['replicates']} fresh replicates "
+          f"(cost {result['search_cost']:.1f} on the search replicates)")
+    print(f"{result['candidates']} candidates, {result['simulations']} simulations in {result['seconds']:.1f}s")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
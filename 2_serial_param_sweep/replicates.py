@@ -0,0 +1,172 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from model import run_batch
+from streams import generator, replicate_stream
+
+
+# run_batch keys and the names metrics.csv gives them
+METRICS = {
+    'mailly': 'final_mailly',
+    'moulin': 'final_moulin',
+    'unmet_mailly': 'unmet_mailly',
+    'unmet_moulin': 'unmet_moulin',
+    'final_imbalance': 'ambulance',
+}
+
+
+class RunningStats:
+    """Running mean and variance of a metric, updated one batch at a time.
+
+    Batches are merged with the pairwise formula of Chan et al., which stays
+    accurate when the mean is large compared with the spread.
+
+    Attributes:
+        n: Number of values seen
+        mean: Mean of the values
+        m2: Sum of squared deviations from the mean
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        n_b = len(values)
+        if n_b == 0:
+            return
+        mean_b = values.mean()
+        m2_b = ((values - mean_b) ** 2).sum()
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+
+    @property
+    def var(self):
+        """Sample variance (nan until there are two values)."""
+        if self.n < 2:
+            return float('nan')
+        return self.m2 / (self.n - 1)
+
+    @property
+    def se(self):
+        """Standard error of the mean (inf until there are two values)."""
+        if self.n < 2:
+            return float('inf')
+        return (self.var / self.n) ** 0.5
+
+
+def variance_ratio(reference, reduced):
+    """reference / reduced, nan when the reduced variance is 0 (e.g. a metric that is always 0)."""
+    if not reduced > 0:
+        return float('nan')
+    return reference / reduced
+
+
+def replicate_generator(seed, replicate):
+    """Generator of one replicate: child stream of a streams.row_stream, or [seed, replicate] for an integer seed."""
+    if isinstance(seed, np.random.SeedSequence):
+        return generator(replicate_stream(seed, replicate))
+    return np.random.default_rng([int(seed), replicate])
+
+
+def run_until_converged(init_mailly, init_moulin, steps, p1, p2, seed,
+                        rel_target, abs_target=0.5, confidence=0.95, batch_size=16, max_replicates=1024,
+                        antithetic=False):
+    """Replicate one parameter point until the confidence intervals are tight enough.
+
+    Replicates run batch_size at a time through model.run_batch; replicate r
+    uses replicate_generator(seed, r), so the values do not depend on
+    batch_size. After each batch the half-width z * se of every metric is
+    compared with max(rel_target * |mean|, abs_target).
+
+    With antithetic=True replicates come in pairs: replicates 2k and 2k + 1
+    share the stream of replicate k, the second one using 1 - u for every
+    uniform u. The pair means are the independent samples the intervals are
+    computed from.
+
+    Args:
+        init_mailly, init_moulin, steps, p1, p2: Parameters of the point
+        seed: Integer seed or streams.row_stream of the point (the same for every
+            point gives common random numbers)
+        rel_target: Target half-width relative to the mean
+        abs_target: Absolute half-width that is always good enough (metrics that stay near 0)
+        confidence: Confidence level of the intervals
+        batch_size: Replicates per batch (rounded up to an even number with antithetic)
+        max_replicates: Stop there even if some interval is still too wide
+        antithetic: Use antithetic pairs
+
+    Returns:
+        Tuple (stats, converged, samples): dictionary metrics.csv name ->
+        RunningStats of the samples, whether every interval reached its
+        target, and dictionary metrics.csv name -> array of the per-replicate
+        values in replicate order
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    if antithetic:
+        batch_size += batch_size % 2
+        max_replicates += max_replicates % 2
+    stats = {name: RunningStats() for name in METRICS.values()}
+    samples = {name: [] for name in METRICS.values()}
+    n = 0
+    while n < max_replicates:
+        size = min(batch_size, max_replicates - n)
+        if antithetic:
+            rngs = [replicate_generator(seed, r // 2) for r in range(n, n + size)]
+            flip = [r % 2 == 1 for r in range(n, n + size)]
+        else:
+            rngs = [replicate_generator(seed, r) for r in range(n, n + size)]
+            flip = None
+        final = run_batch(int(init_mailly), int(init_moulin), int(steps), p1, p2, rngs, antithetic=flip)
+        for key, name in METRICS.items():
+            values = final[key]
+            samples[name].append(values)
+            stats[name].update((values[0::2] + values[1::2]) / 2 if antithetic else values)
+        n += size
+        if all(z * s.se <= max(rel_target * abs(s.mean), abs_target) for s in stats.values()):
+            break
+    samples = {name: np.concatenate(values) for name, values in samples.items()}
+    return stats, all(z * s.se <= max(rel_target * abs(s.mean), abs_target) for s in stats.values()), samples
+
+
+def antithetic_reduction(stats, samples):
+    """Variance reduction of antithetic pairs, per metric.
+
+    Returns:
+        Dictionary metrics.csv name -> variance of the mean with as many
+        independent replicates, divided by the variance of the mean of the
+        pairs (above 1: the pairs helped)
+    """
+    reduction = {}
+    for name, s in stats.items():
+        independent = np.var(samples[name], ddof=1) / len(samples[name]) if len(samples[name]) > 1 else float('nan')
+        reduction[name] = variance_ratio(independent, s.var / s.n if s.n > 1 else float('nan'))
+    return reduction
+
+
+def crn_reduction(previous, samples):
+    """Variance reduction of common random numbers on the difference between two points.
+
+    Args:
+        previous, samples: Per-replicate values of two points run with the
+            same streams (run_until_converged samples)
+
+    Returns:
+        Dictionary metrics.csv name -> (var(X) + var(Y)) / var(X - Y) over the
+        replicates both points have: what independent seeds would give,
+        divided by what the shared streams give
+    """
+    reduction = {}
+    for name, values in samples.items():
+        n = min(len(values), len(previous[name]))
+        if n < 2:
+            reduction[name] = float('nan')
+            continue
+        x, y = previous[name][:n], values[:n]
+        reduction[name] = variance_ratio(np.var(x, ddof=1) + np.var(y, ddof=1), np.var(x - y, ddof=1))
+    return reduction
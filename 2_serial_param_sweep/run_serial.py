@@ -1,9 +1,18 @@
 import argparse
+import time
 from pathlib import Path
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
+import model
 from model import State, run_simulation
+from writer import BackgroundWriter
+from result_cache import ResultCache, model_fingerprint, run_cached
+from sweep_spec import load_spec
+from replicates import run_until_converged, antithetic_reduction, crn_reduction
+from streams import row_stream, replicate_stream
+from profiling import Profiler
+from telemetry import Progress
 
 
 def parse_args():
@@ -12,59 +21,92 @@ def parse_args():
     Returns:
         Parsed arguments containing:
         - params: Path to CSV file with parameter combinations
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params
         - out_dir: Output directory for results
         - plot: Boolean flag to generate plots after run
         - smooth_window: Window size for smoothing timeseries (default: 1, no smoothing)
+        - plot_method: Downsampling of the plotted series, 'minmax' or 'lttb' (plotting.py)
+        - save_timeseries: Boolean flag to also write each run's timeseries
+        - max_pending: Results waiting for the writer thread before the sweep blocks
+        - cache_dir: Result cache directory (default: no cache)
+        - cache_max_mb: Size limit of the result cache in MB
+        - cache_trajectories: Boolean flag to also cache compressed trajectories
+        - flush_every: Number of metrics rows kept in memory before they are appended to metrics.csv
+        - ci_target: Replicate every row until the CI half-widths fall below ci_target * |mean| (default: one run per row)
+        - ci_abs: Absolute CI half-width that is always good enough
+        - confidence: Confidence level of the intervals
+        - batch_size: Replicates simulated together per batch
+        - max_replicates: Replicate cap per row
+        - root_seed: Root of the streams.py random streams, instead of the seed of each row
+        - crn: Common random numbers, every row uses this seed instead of its own
+        - antithetic: Boolean flag to replicate in antithetic pairs (u, 1 - u)
+        - stop_tol: Stop each run once stationary within this tolerance (stationarity.py), steps becomes a cap
+        - check_every: Steps between the first stationarity checks
+        - profile: Boolean flag to write timing.json (wall and CPU time per phase and per run)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile
+        - progress: Boolean flag to show a live progress line on stderr
+        - telemetry: JSONL file the progress records are appended to (telemetry.py)
+        - telemetry_every: Seconds between two progress records
 
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
     """
     my_parser = argparse.ArgumentParser(description="serial parameter sweep simulation run")
-    my_parser.add_argument('--params',type=str,required=True,help='Path to CSV file with parameter combinations')
+    source = my_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str,help='Path to CSV file with parameter combinations')
+    source.add_argument('--spec',type=str,help='Path to a JSON sweep spec, expanded lazily (see sweep_spec.py)')
     my_parser.add_argument('--out-dir',type=str,default='results',help='Output directory for results')
     my_parser.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
     my_parser.add_argument('--smooth-window',type=int, default=1,help='Window size for smoothing timeseries (default: 1, no smoothing)')
-    return my_parser.parse_args()
-
-
-def plot_results(results_list, output_dir, smooth_window=1):
-    """Simple plotting function for results"""
-    if not results_list:
-        return
-    
-    # Plot the first result as example
-    res = results_list[0]
-    
-    # Smoothing function
-    def smooth(data, window):
-        if window <= 1:
-            return data
-        return np.convolve(data, np.ones(window)/window, mode='valid')
-    
-    fig, axes = plt.subplots(2, 1, figsize=(14, 10))
-    
-    # Plot 1: Bikes at stations
-    axes[0].plot(smooth(res['mailly'], smooth_window), label='Mailly', color='blue')
-    axes[0].plot(smooth(res['moulin'], smooth_window), label='Moulin', color='green')
-    axes[0].set_title('Bikes at Stations')
-    axes[0].set_xlabel('Time')
-    axes[0].set_ylabel('Number of Bikes')
-    axes[0].legend()
-    axes[0].grid(True, alpha=0.3)
-    
-    # Plot 2: Unmet demand
-    axes[1].plot(smooth(res['unmet_mailly'], smooth_window), label='Unmet Mailly', color='red')
-    axes[1].plot(smooth(res['unmet_moulin'], smooth_window), label='Unmet Moulin', color='orange')
-    axes[1].set_title('Unmet Demand')
-    axes[1].set_xlabel('Time')
-    axes[1].set_ylabel('Unmet Demand')
-    axes[1].legend()
-    axes[1].grid(True, alpha=0.3)
-    
-    plt.tight_layout()
-    plt.savefig(output_dir / "plot.png", dpi=100)
-    plt.close()
-    print(f"Plot saved to: {output_dir / 'plot.png'}")
+    my_parser.add_argument('--plot-method',choices=['minmax','lttb'],default='minmax',help='Downsampling of the plotted series: minmax keeps every spike, lttb the shape of the curve (default: minmax)')
+    my_parser.add_argument('--save-timeseries',action='store_true',help='Also write timeseries/run_<i>.csv for every run')
+    my_parser.add_argument('--max-pending',type=int,default=4,help='Results waiting for the writer thread before the sweep blocks (default: 4)')
+    my_parser.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_parser.add_argument('--cache-max-mb',type=float,default=1024,help='Size limit of the result cache in MB (default: 1024)')
+    my_parser.add_argument('--cache-trajectories',action='store_true',help='Also cache compressed trajectories')
+    my_parser.add_argument('--flush-every',type=int,default=10000,help='Metrics rows kept in memory before being appended to metrics.csv (default: 10000)')
+    my_parser.add_argument('--ci-target',type=float,default=None,help='Replicate each row until every CI half-width is below this fraction of the mean (default: one run per row)')
+    my_parser.add_argument('--ci-abs',type=float,default=0.5,help='CI half-width that is always good enough, for metrics near 0 (default: 0.5)')
+    my_parser.add_argument('--confidence',type=float,default=0.95,help='Confidence level of the intervals (default: 0.95)')
+    my_parser.add_argument('--batch-size',type=int,default=16,help='Replicates simulated together per batch (default: 16)')
+    my_parser.add_argument('--max-replicates',type=int,default=1024,help='Replicate cap per row (default: 1024)')
+    my_parser.add_argument('--root-seed',type=int,default=None,help='Draw every (row, replicate) from its own stream under this root seed (streams.py) instead of the seed column')
+    my_parser.add_argument('--crn',type=int,default=None,help='Common random numbers: every row uses this seed (the same streams) instead of its own')
+    my_parser.add_argument('--antithetic',action='store_true',help='With --ci-target, replicate in antithetic pairs (u, 1 - u)')
+    my_parser.add_argument('--stop-tol',type=float,default=None,help='Stop each run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    my_parser.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    my_parser.add_argument('--profile',action='store_true',help='Write timing.json next to metrics.csv: wall and CPU time per phase and per run')
+    my_parser.add_argument('--profile-capture',choices=['cprofile','tracemalloc'],default=None,help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report')
+    my_parser.add_argument('--progress',action='store_true',help='Show a live progress line on stderr: runs done/failed/pending, steps/s, ETA, utilization')
+    my_parser.add_argument('--telemetry',type=str,default=None,help='Append a progress record to this JSONL file every --telemetry-every seconds (read it with telemetry.py status)')
+    my_parser.add_argument('--telemetry-every',type=float,default=10.0,help='Seconds between two progress records (default: 10)')
+    args = my_parser.parse_args()
+    if args.stop_tol is not None and args.ci_target is not None:
+        my_parser.error("--stop-tol cannot be combined with --ci-target (replicates run a fixed number of steps)")
+    if args.antithetic and args.ci_target is None:
+        my_parser.error("--antithetic needs --ci-target (pairs of replicates)")
+    if args.ci_target is not None and (args.plot or args.save_timeseries or args.cache_dir):
+        my_parser.error("--ci-target only writes aggregated metrics, it cannot be combined with --plot, --save-timeseries or --cache-dir")
+    return args
+
+
+def keep_summary(summaries, res, smooth_window, method):
+    """Keep what the figures need of one run, not the run (called from the writer thread)."""
+    # plotting (and matplotlib) only load with --plot
+    from plotting import summarize_run
+    summaries.append(summarize_run(res, smooth_window, method=method))
+
+
+def write_timeseries(res, path):
+    """Write the timeseries of one run (called from the writer thread)."""
+    df = pd.DataFrame(res)
+    df.insert(0, 'time', range(len(df)))
+    df.to_csv(path, index=False)
+
+
+def append_metrics(rows, path, header):
+    """Append a chunk of metrics rows to metrics.csv (called from the writer thread)."""
+    pd.DataFrame(rows).to_csv(path, mode='w' if header else 'a', header=header, index=False)
 
 
 def main():
@@ -87,25 +129,130 @@ def main():
     - seed: Random seed
 
     Output files:
-    - metrics.csv: Aggregated metrics for all runs
+    - metrics.csv: Aggregated metrics for all runs (plus point and replicate with --spec);
+      with --ci-target one row per point: replicates, converged, <metric>_mean and <metric>_se,
+      plus <metric>_antithetic_vrf / <metric>_crn_vrf variance reduction factors
+    - Optional timeseries/run_<i>.csv: timeseries of each run (--save-timeseries)
     - Optional plots: PNG files for timeseries and metrics visualization
+    - Optional timing.json: wall and CPU time per phase and per run (--profile)
+    - Optional telemetry JSONL: a progress record every --telemetry-every seconds and a last one at the end (--telemetry)
 
     Note:
         - Process each row in the parameters file as a separate simulation run
         - Add run_id to track individual simulations
         - **OPTIONAL**: plot timeseries for both stations
         - **OPTIONAL**: Handle smoothing for timeseries plots if requested
+        - Timeseries files are written, and the runs smoothed and downsampled
+          for the plots, by a background thread while the next simulations
+          run; the figures of all the runs are drawn at the end (plotting.py)
+        - With --spec the tasks are generated one at a time and metrics.csv is
+          written in chunks of --flush-every rows, so memory does not grow
+          with the size of the sweep
     """
     args = parse_args()
-    df_params = pd.read_csv(args.params)
+    profiler = Profiler(args.profile, args.profile_capture)
+    with profiler.phase('read_params'):
+        if args.spec:
+            spec = load_spec(args.spec)
+            n_tasks, n_steps = len(spec), None
+            tasks = spec.iter_tasks()
+        else:
+            df_params = pd.read_csv(args.params)
+            n_tasks, n_steps = len(df_params), int(df_params['steps'].sum())
+            tasks = df_params.iterrows()
+    # with --ci-target the replicates, hence the steps, are not known in advance
+    progress = Progress(n_tasks, n_steps if args.ci_target is None else None, args.progress, args.telemetry, args.telemetry_every, 'run_serial')
+    # rows are produced lazily (iterrows, spec expansion): timed as they come
+    tasks = profiler.iterate('iterate_params', tasks)
     output_dir = Path(args.out_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    if args.save_timeseries:
+        (output_dir / "timeseries").mkdir(exist_ok=True)
     data_summary =[]
-    raw_results = []
-    for i,row in df_params.iterrows():
+    n_runs = 0
+    output_csv = output_dir / "metrics.csv"
+    writer = BackgroundWriter(args.max_pending)
+    # submit blocks when the writer falls behind; the jobs are timed on the writer thread
+    submit = profiler.wrap('submit', writer.submit)
+    append_job = profiler.wrap('write_metrics', append_metrics)
+    timeseries_job = profiler.wrap('write_timeseries', write_timeseries)
+    summary_job = profiler.wrap('plot_summary', keep_summary)
+    # a few thousand points per run, whatever its length, in the order of the runs
+    summaries = []
+    labels = []
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, model_fingerprint(model), int(args.cache_max_mb * 1024 * 1024))
+    need_trajectory = args.plot or args.save_timeseries
+    n_replicates = 0
+    # variance reduction factors per metric, reported at the end
+    reductions = {}
+    previous = None
+    # with --stop-tol: steps actually simulated, out of the steps asked for
+    steps_used = steps_cap = 0
+    for i,row in tasks:
+        seed = row['seed'] if args.crn is None else args.crn
+        if args.root_seed is not None:
+            # the stream follows from the identity of the row (with --spec: point
+            # and replicate), and every row shares row 0's streams with --crn
+            seed = args.root_seed
+            stream = row_stream(args.root_seed, 0 if args.crn is not None else (row['point'] if args.spec else i))
+            if args.ci_target is None:
+                stream = replicate_stream(stream, row['replicate'] if args.spec else 0)
+        else:
+            stream = seed
+        task_start = time.perf_counter()
+        if args.ci_target is not None:
+            with profiler.task(i):
+                stats, converged, samples = run_until_converged(row['init_mailly'], row['init_moulin'], row['steps'], row['p1'], row['p2'], stream,
+                                                                args.ci_target, args.ci_abs, args.confidence, args.batch_size, args.max_replicates,
+                                                                antithetic=args.antithetic)
+            progress.update('main', i, time.perf_counter() - task_start, len(samples['ambulance']) * int(row['steps']))
+            row_result = {
+                'run': i,
+                'init_mailly':row['init_mailly'],
+                'init_moulin':row['init_moulin'],
+                'steps':row['steps'],
+                'p1':row['p1'],
+                'p2':row['p2'],
+                'seed': seed,
+                'replicates': len(samples['ambulance']),
+                'converged': converged,
+            }
+            for name, s in stats.items():
+                row_result[f'{name}_mean'] = s.mean
+                row_result[f'{name}_se'] = s.se
+            if args.antithetic:
+                for name, ratio in antithetic_reduction(stats, samples).items():
+                    row_result[f'{name}_antithetic_vrf'] = ratio
+                    reductions.setdefault(f'{name} (antithetic)', []).append(ratio)
+            if args.crn is not None:
+                # differences with the previous point: what the shared streams are for
+                ratios = crn_reduction(previous, samples) if previous is not None else dict.fromkeys(samples, float('nan'))
+                for name, ratio in ratios.items():
+                    row_result[f'{name}_crn_vrf'] = ratio
+                    if previous is not None:
+                        reductions.setdefault(f'{name} (crn, vs previous row)', []).append(ratio)
+                previous = samples
+            n_replicates += len(samples['ambulance'])
+            data_summary.append(row_result)
+            n_runs += 1
+            if len(data_summary) >= args.flush_every:
+                submit(append_job, data_summary, output_csv, n_runs == len(data_summary))
+                data_summary = []
+            continue
         
-        res = run_simulation(int(row['init_mailly']),int(row['init_moulin']), int(row['steps']), row['p1'], row['p2'], int(row['seed']))
-        raw_results.append(res)
+        with profiler.task(i):
+            final, res = run_cached(cache, run_simulation, row['init_mailly'], row['init_moulin'], row['steps'], row['p1'], row['p2'], stream,
+                                    need_trajectory=need_trajectory, store_trajectory=args.cache_trajectories,
+                                    stop_tol=args.stop_tol, check_every=args.check_every)
+        progress.update('main', i, time.perf_counter() - task_start, int(final.get('steps_used', row['steps'])), int(row['steps']))
+        # hand the outputs over and go on with the next run
+        if args.save_timeseries:
+            submit(timeseries_job, res, output_dir / "timeseries" / f"run_{i}.csv")
+        if args.plot:
+            submit(summary_job, summaries, res, args.smooth_window, args.plot_method)
+            labels.append(f"run {i}")
         row_result={
             'run': i,
             #init
@@ -114,22 +261,51 @@ def main():
             'steps':row['steps'],
             'p1':row['p1'],
             'p2':row['p2'],
-           'seed': row['seed'],
+           'seed': seed,
             #final result
-            'final_mailly':res["mailly"][-1],
-            'final_moulin':res["moulin"][-1],
-            'unmet_mailly':res["unmet_mailly"][-1],
-            'unmet_moulin':res["unmet_moulin"][-1],
-            'ambulance':res["final_imbalance"][-1] 
+            'final_mailly':final["mailly"],
+            'final_moulin':final["moulin"],
+            'unmet_mailly':final["unmet_mailly"],
+            'unmet_moulin':final["unmet_moulin"],
+            'ambulance':final["final_imbalance"] 
         }
+        if args.stop_tol is not None:
+            row_result['steps_used'] = final['steps_used']
+            steps_used += final['steps_used']
+            steps_cap += int(row['steps'])
+        if args.spec:
+            row_result['point'] = row['point']
+            row_result['replicate'] = row['replicate']
         data_summary.append(row_result)
-    df_results = pd.DataFrame(data_summary)
-    output_csv = output_dir / "metrics.csv"
-    df_results.to_csv(output_csv, index=False)
-    print(f"test--Done! {len(df_results)} simulations run.")
+        n_runs += 1
+        if len(data_summary) >= args.flush_every:
+            submit(append_job, data_summary, output_csv, n_runs == len(data_summary))
+            data_summary = []
+    progress.close()
+    if data_summary or n_runs == 0:
+        submit(append_job, data_summary, output_csv, n_runs == len(data_summary))
+    with profiler.phase('drain_writer'):
+        writer.close()
+    if cache is not None:
+        with profiler.phase('cache_evict'):
+            cache.evict()
+        print(f"cache: {cache.hits} hits, {cache.misses} misses")
+    if args.ci_target is not None:
+        print(f"{n_replicates} replicates for {n_runs} points ({n_replicates / max(n_runs, 1):.1f} per point)")
+        for name, ratios in reductions.items():
+            ratios = [r for r in ratios if r == r]
+            if ratios:
+                print(f"variance reduction {name}: median x{np.median(ratios):.2f}")
+    if args.stop_tol is not None:
+        print(f"stationarity: {steps_used} of {steps_cap} steps simulated ({steps_used / max(steps_cap, 1):.1%})")
+    print(f"test--Done! {n_runs} simulations run.")
     print(f"test--Results saved to: {output_csv}")
     if args.plot:
-        plot_results(raw_results, output_dir,args.smooth_window)
+        from plotting import plot_runs
+        with profiler.phase('plot'):
+            plot_runs(summaries, output_dir, labels)
+        print(f"Plots saved to: {output_dir}")
+    profiler.write(output_dir / "timing.json", runner='run_serial', runs=n_runs)
 
         
 
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+# batch means: the steps after the warm-up are cut in BATCHES batches, and the
+# half-width of the interval is T_QUANTILE * sd(batch means) / sqrt(BATCHES)
+BATCHES = 20
+T_QUANTILE = 2.093  # Student t, 95%, 19 degrees of freedom
+# MSER-5: the warm-up is searched on means of MSER_BATCH steps
+MSER_BATCH = 5
+# no verdict before every batch has this many steps
+MIN_BATCH_STEPS = 50
+
+
+def mser_truncation(values, batch_size=MSER_BATCH):
+    """Warm-up length of a series by MSER (marginal standard error rule).
+
+    The series is averaged over batches of batch_size steps, and the warm-up
+    is the number d of first batches (at most half of them) that minimizes
+    the squared standard error of the mean of the remaining ones,
+    sum((z - mean)^2) / (m - d)^2.
+
+    Returns:
+        Number of steps to drop at the start of the series
+    """
+    m = len(values) // batch_size
+    if m < 2:
+        return 0
+    z = np.asarray(values[:m * batch_size], dtype=np.float64).reshape(m, batch_size).mean(axis=1)
+    # suffix sums: mean and spread of z[d:] for every d at once
+    s1 = np.cumsum(z[::-1])[::-1]
+    s2 = np.cumsum((z * z)[::-1])[::-1]
+    k = np.arange(m, 0, -1)
+    mser = (s2 - s1 * s1 / k) / (k * k)
+    return int(np.argmin(mser[:m // 2 + 1])) * batch_size
+
+
+def batch_means(values, n_batches=BATCHES):
+    """Mean of a series and the half-width of its batch-means confidence interval.
+
+    Returns:
+        Tuple (mean, half_width), half_width is inf when there are fewer
+        than MIN_BATCH_STEPS steps per batch
+    """
+    size = len(values) // n_batches
+    if size < MIN_BATCH_STEPS:
+        return float(np.mean(values)) if len(values) else float('nan'), float('inf')
+    means = np.asarray(values[-size * n_batches:], dtype=np.float64).reshape(n_batches, size).mean(axis=1)
+    return float(means.mean()), T_QUANTILE * float(means.std(ddof=1)) / np.sqrt(n_batches)
+
+
+def check_stationary(res, p1, p2, tol):
+    """Whether the running estimates of a run (so far) are stable within tol.
+
+    The monitored series are the unmet demand per step at each station and
+    the number of bikes at Mailly. The warm-up is the longest MSER
+    truncation of the three, and the run is stable when every batch-means
+    half-width after it is below tol times the scale of the series (p1 and
+    p2 for the unmet rates, the fleet size for the occupancy).
+
+    Args:
+        res: Lists recorded by run_simulation so far ('mailly', 'moulin',
+            'unmet_mailly', 'unmet_moulin')
+        p1, p2: Probabilities of the run
+        tol: Tolerance, relative to the scale of each series
+
+    Returns:
+        Tuple (stable, warmup, estimates): estimates maps 'unmet_mailly_rate',
+        'unmet_moulin_rate' and 'mean_mailly' to (mean, half_width)
+    """
+    total = res['mailly'][0] + res['moulin'][0]
+    series = {
+        'unmet_mailly_rate': (np.diff(np.asarray(res['unmet_mailly'])), p1),
+        'unmet_moulin_rate': (np.diff(np.asarray(res['unmet_moulin'])), p2),
+        'mean_mailly': (np.asarray(res['mailly'][1:]), total),
+    }
+    warmup = max(mser_truncation(values) for values, _ in series.values())
+    estimates = {name: batch_means(values[warmup:]) for name, (values, _) in series.items()}
+    stable = all(estimates[name][1] <= tol * max(scale, 1e-12) for name, (_, scale) in series.items())
+    return stable, warmup, estimates
@@ -0,0 +1,257 @@
+import argparse
+import json
+import math
+import time
+from bisect import bisect_right
+from pathlib import Path
+
+import numpy as np
+
+from model import run_batch
+from replicates import METRICS
+from streams import generator, stream
+
+
+# table axes, in storage order; the table is <name>.npy of shape
+# (fleet, horizon, split, p1, p2, metric, 2): mean and standard error of each
+# metric over the replicates, described by <name>.json
+AXES = ('fleet', 'horizon', 'split', 'p1', 'p2')
+
+
+def build_table(path, p1, p2, fleet, split, horizon, replicates=32, seed=0):
+    """Fill the table of expected metrics with model.run_batch.
+
+    For every (fleet, horizon) one run_batch call covers the whole
+    (split, p1, p2) grid: replicate r of every cell is driven by the stream
+    (seed, 0, r) (common random numbers), which keeps the table smooth
+    between neighbouring cells. The split axis is init_mailly / fleet
+    (init_mailly rounded to the nearest bike).
+
+    Args:
+        path: Output path without extension (<path>.npy and <path>.json)
+        p1, p2, split: Grid values of each axis
+        fleet, horizon: Fleet sizes and numbers of steps
+        replicates: Replicates per cell
+        seed: Root seed of the streams
+
+    Returns:
+        The table description (the content of <path>.json)
+    """
+    path = Path(path)
+    axes = {
+        'fleet': [int(f) for f in fleet],
+        'horizon': [int(h) for h in horizon],
+        'split': [float(s) for s in split],
+        'p1': [float(p) for p in p1],
+        'p2': [float(p) for p in p2],
+    }
+    shape = tuple(len(axes[name]) for name in AXES) + (len(METRICS), 2)
+    table = np.lib.format.open_memmap(path.with_suffix('.npy.tmp'), mode='w+', dtype=np.float32, shape=shape)
+    grid_p1 = np.array(axes['p1'])[None, :, None, None]
+    grid_p2 = np.array(axes['p2'])[None, None, :, None]
+    for f, n_bikes in enumerate(axes['fleet']):
+        init_mailly = np.rint(np.array(axes['split']) * n_bikes).astype(np.int64)[:, None, None, None]
+        for h, steps in enumerate(axes['horizon']):
+            rngs = [generator(stream(seed, 0, r)) for r in range(replicates)]
+            final = run_batch(init_mailly, n_bikes - init_mailly, steps, grid_p1, grid_p2, rngs)
+            for m, key in enumerate(METRICS):
+                values = final[key]
+                table[f, h, :, :, :, m, 0] = values.mean(axis=-1)
+                table[f, h, :, :, :, m, 1] = values.std(axis=-1, ddof=1) / np.sqrt(replicates) if replicates > 1 else np.nan
+    table.flush()
+    del table
+    path.with_suffix('.npy.tmp').replace(path.with_suffix('.npy'))
+    description = {
+        'axes': axes,
+        'metrics': list(METRICS.values()),
+        'replicates': replicates,
+        'seed': seed,
+    }
+    with open(path.with_suffix('.json'), 'w') as f:
+        json.dump(description, f, indent=4)
+    return description
+
+
+def _locate(axis, x, name):
+    """Lower index and weight of x between two grid values of an axis (name: for the error message)."""
+    if len(axis) == 1:
+        # nothing to interpolate along: only the value the table was built for
+        if not math.isclose(x, axis[0], rel_tol=1e-9, abs_tol=1e-12):
+            raise ValueError(f"{name} {x} is not in the table (built for {axis[0]} only)")
+        return 0, 0.0
+    if not axis[0] <= x <= axis[-1]:
+        raise ValueError(f"{name} {x} is outside the table ({axis[0]} to {axis[-1]})")
+    i = min(bisect_right(axis, x) - 1, len(axis) - 2)
+    return i, (x - axis[i]) / (axis[i + 1] - axis[i])
+
+
+class SurrogateTable:
+    """Expected metrics by multilinear interpolation in a memory-mapped table.
+
+    Attributes:
+        axes: Grid values of every axis (AXES)
+        metrics: Names of the metrics (metrics.csv names)
+        holdout: Error report against held-out simulations, if any
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        with open(path.with_suffix('.json'), 'r') as f:
+            description = json.load(f)
+        self.axes = description['axes']
+        self.metrics = description['metrics']
+        self.holdout = description.get('holdout')
+        # plain ndarray view of the memory map: slicing a np.memmap is slower
+        self.table = np.load(path.with_suffix('.npy'), mmap_mode='r').view(np.ndarray)
+
+    def query(self, p1, p2, fleet, init_mailly, steps):
+        """Interpolated mean and standard error of every metric.
+
+        Only the 2^5 surrounding cells are read from the memory map.
+
+        Returns:
+            Dictionary metric name -> (mean, standard error)
+
+        Raises:
+            ValueError: The point is outside the table
+        """
+        point = (fleet, steps, init_mailly / fleet, p1, p2)
+        index = []
+        weights = [1.0]
+        for name, x in zip(AXES, point):
+            i, w = _locate(self.axes[name], x, name)
+            index.append(slice(i, i + 2))
+            if len(self.axes[name]) > 1:
+                # corners in the C order of the block: this axis varies fastest
+                weights = [c * v for c in weights for v in (1.0 - w, w)]
+        block = self.table[tuple(index)].reshape(len(weights), -1)
+        values = np.dot(weights, block).reshape(len(self.metrics), 2)
+        return {name: (float(values[m, 0]), float(values[m, 1])) for m, name in enumerate(self.metrics)}
+
+
+def holdout_errors(path, n_points=40, replicates=64, seed=1):
+    """Compare the table with fresh simulations at random points inside it.
+
+    Each point (fleet, steps and init_mailly drawn as integers, p1 and p2
+    uniform) is simulated with its own streams (seed, k + 1, r), independent
+    of the table's. The report is saved in <path>.json under 'holdout'.
+
+    Returns:
+        Dictionary metric name -> mean, 95th percentile and max absolute
+        error, the mean standard error of the held-out means (the noise
+        floor of the comparison) and the fraction of points within two
+        combined standard errors
+    """
+    surrogate = SurrogateTable(path)
+    axes = surrogate.axes
+    rng = np.random.default_rng(seed)
+    errors = {name: [] for name in surrogate.metrics}
+    noise = {name: [] for name in surrogate.metrics}
+    within = {name: [] for name in surrogate.metrics}
+    for k in range(n_points):
+        fleet = int(rng.integers(min(axes['fleet']), max(axes['fleet']) + 1))
+        steps = int(rng.integers(min(axes['horizon']), max(axes['horizon']) + 1))
+        low = int(np.ceil(min(axes['split']) * fleet))
+        high = int(np.floor(max(axes['split']) * fleet))
+        init_mailly = int(rng.integers(low, high + 1))
+        p1 = rng.uniform(min(axes['p1']), max(axes['p1']))
+        p2 = rng.uniform(min(axes['p2']), max(axes['p2']))
+        predicted = surrogate.query(p1, p2, fleet, init_mailly, steps)
+        rngs = [generator(stream(seed, k + 1, r)) for r in range(replicates)]
+        final = run_batch(init_mailly, fleet - init_mailly, steps, p1, p2, rngs)
+        for key, name in METRICS.items():
+            mean = final[key].mean()
+            se = final[key].std(ddof=1) / np.sqrt(replicates)
+            table_mean, table_se = predicted[name]
+            errors[name].append(abs(table_mean - mean))
+            noise[name].append(se)
+            within[name].append(abs(table_mean - mean) <= 2 * np.hypot(se, table_se))
+    report = {
+        name: {
+            'mean_abs_error': float(np.mean(errors[name])),
+            'p95_abs_error': float(np.percentile(errors[name], 95)),
+            'max_abs_error': float(np.max(errors[name])),
+            'holdout_se': float(np.mean(noise[name])),
+            'within_2se': float(np.mean(within[name])),
+        }
+        for name in surrogate.metrics
+    }
+    path = Path(path)
+    with open(path.with_suffix('.json'), 'r') as f:
+        description = json.load(f)
+    description['holdout'] = {'points': n_points, 'replicates': replicates, 'seed': seed, 'errors': report}
+    with open(path.with_suffix('.json'), 'w') as f:
+        json.dump(description, f, indent=4)
+    return report
+
+
+def parse_args():
+    """Parse command line arguments for the surrogate table.
+
+    Returns:
+        Parsed arguments of one of the subcommands:
+        - build: table path, grid of every axis, replicates, seed, holdout points
+        - query: table path, p1, p2, fleet, init_mailly, steps
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="surrogate lookup table of expected metrics")
+    commands = my_parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Precompute the table')
+    build.add_argument('--table',type=str,default='surrogate',help='Table path without extension (default: surrogate)')
+    build.add_argument('--p1',type=float,nargs=3,default=[0.0, 1.0, 21],metavar=('MIN','MAX','NUM'),help='p1 grid (default: 0 1 21)')
+    build.add_argument('--p2',type=float,nargs=3,default=[0.0, 1.0, 21],metavar=('MIN','MAX','NUM'),help='p2 grid (default: 0 1 21)')
+    build.add_argument('--split',type=float,nargs=3,default=[0.0, 1.0, 6],metavar=('MIN','MAX','NUM'),help='init_mailly / fleet grid (default: 0 1 6)')
+    build.add_argument('--fleet',type=int,nargs='+',default=[5, 10, 15, 20],help='Fleet sizes (default: 5 10 15 20)')
+    build.add_argument('--horizon',type=int,nargs='+',default=[100, 1000, 10000],help='Numbers of steps (default: 100 1000 10000)')
+    build.add_argument('--replicates',type=int,default=32,help='Replicates per cell (default: 32)')
+    build.add_argument('--seed',type=int,default=0,help='Root seed of the streams (default: 0)')
+    build.add_argument('--holdout',type=int,default=40,help='Held-out simulations for the error report, 0 to skip (default: 40)')
+    build.add_argument('--holdout-replicates',type=int,default=64,help='Replicates per held-out point (default: 64)')
+    query = commands.add_parser('query', help='Interpolate the metrics at one point')
+    query.add_argument('--table',type=str,default='surrogate',help='Table path without extension (default: surrogate)')
+    query.add_argument('--p1',type=float,required=True,help='Probability Mailly->Moulin')
+    query.add_argument('--p2',type=float,required=True,help='Probability Moulin->Mailly')
+    query.add_argument('--fleet',type=int,required=True,help='Total number of bikes')
+    query.add_argument('--init-mailly',type=int,required=True,help='Initial bikes at Mailly')
+    query.add_argument('--steps',type=int,required=True,help='Number of simulation steps')
+    return my_parser.parse_args()
+
+
+def main():
+    """Build the table or answer a query.
+
+    Output files (build):
+    - <table>.npy: the memory-mapped table
+    - <table>.json: axes, metrics, replicates, seed and the holdout error report
+    """
+    args = parse_args()
+    if args.command == 'build':
+        start = time.perf_counter()
+        description = build_table(args.table, np.linspace(*args.p1[:2], int(args.p1[2])), np.linspace(*args.p2[:2], int(args.p2[2])),
+                                  args.fleet, np.linspace(*args.split[:2], int(args.split[2])), args.horizon,
+                                  args.replicates, args.seed)
+        cells = np.prod([len(values) for values in description['axes'].values()])
+        print(f"table of {cells} cells built in {time.perf_counter() - start:.1f}s: {Path(args.table).with_suffix('.npy')}")
+        if args.holdout:
+            report = holdout_errors(args.table, args.holdout, args.holdout_replicates, args.seed + 1)
+            for name, errors in report.items():
+                print(f"{name}: mean error {errors['mean_abs_error']:.3g}, p95 {errors['p95_abs_error']:.3g}, "
+                      f"max {errors['max_abs_error']:.3g} (holdout se {errors['holdout_se']:.3g}, "
+                      f"{errors['within_2se']:.0%} within 2 se)")
+    else:
+        surrogate = SurrogateTable(args.table)
+        start = time.perf_counter()
+        try:
+            result = surrogate.query(args.p1, args.p2, args.fleet, args.init_mailly, args.steps)
+        except ValueError as e:
+            raise SystemExit(f"error: {e}")
+        elapsed = time.perf_counter() - start
+        for name, (mean, se) in result.items():
+            print(f"{name}: {mean:.3f} +/- {se:.3f}")
+        print(f"query answered in {elapsed * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
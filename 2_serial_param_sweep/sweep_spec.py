@@ -0,0 +1,228 @@
+import argparse
+import json
+from math import prod
+
+import numpy as np
+
+
+# Declarative sweep spec (JSON), expanded lazily into tasks.
+#
+# {
+#   "sampler": "grid" | "random" | "lhs" | "sobol",
+#   "fleet": 15,                               # init_moulin = fleet - init_mailly
+#   "steps": 10000,                            # a number: fixed value
+#   "p1": {"min": 0.3, "max": 0.7, "num": 5},  # with "num": grid axis (linspace)
+#   "p2": {"min": 0.3, "max": 0.7},            # without "num": sampled range
+#   "init_mailly": [5, 10],                    # a list: grid axis (explicit values)
+#   "points": 1000,                            # number of sampled points
+#   "replicates": 3,                           # seeds per parameter point
+#   "seed": 0
+# }
+#
+# Grid axes are crossed with the sampled points, and every point is run
+# `replicates` times. Task i is computed from i alone (mixed-radix digits for
+# the grid, a keyed permutation for LHS, Sobol' digits...), nothing is
+# materialized, so a 10^7-task sweep costs no memory and a SLURM array task
+# can compute its own parameters from its index.
+SAMPLERS = ('grid', 'random', 'lhs', 'sobol')
+PARAMS = ('p1', 'p2', 'init_mailly', 'steps')
+INTEGER_PARAMS = ('init_mailly', 'steps')
+
+MASK64 = (1 << 64) - 1
+
+# Sobol' primitive polynomials and initial direction numbers (Joe & Kuo),
+# one per dimension after the first: (degree s, coefficients a, m_1..m_s)
+SOBOL_POLYNOMIALS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+]
+SOBOL_BITS = 52
+
+
+def _mix(x):
+    """splitmix64 finalizer, used as the round function of the permutation."""
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+
+class _Permutation:
+    """Keyed random permutation of range(n), evaluated one index at a time.
+
+    A 4-round Feistel network on the smallest even number of bits covering
+    n, with cycle-walking to stay below n: O(1) memory whatever n is.
+    """
+
+    def __init__(self, n, key):
+        self.n = n
+        bits = max((n - 1).bit_length(), 2)
+        bits += bits % 2
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [_mix((key + 0x9e3779b97f4a7c15 * (r + 1)) & MASK64) for r in range(4)]
+
+    def __call__(self, i):
+        while True:
+            left, right = i >> self.half, i & self.mask
+            for k in self.keys:
+                left, right = right, left ^ (_mix(right ^ k) & self.mask)
+            i = (left << self.half) | right
+            if i < self.n:
+                return i
+
+
+def _sobol_directions(dims):
+    """Direction numbers v[d][k] (integers on SOBOL_BITS bits) for the first dims dimensions."""
+    if dims > len(SOBOL_POLYNOMIALS) + 1:
+        raise ValueError(f"sobol sampler supports at most {len(SOBOL_POLYNOMIALS) + 1} sampled parameters")
+    directions = [[1 << (SOBOL_BITS - k) for k in range(1, SOBOL_BITS + 1)]]
+    for s, a, m_init in SOBOL_POLYNOMIALS[:dims - 1]:
+        m = list(m_init)
+        for k in range(s, SOBOL_BITS):
+            new = m[k - s] ^ (m[k - s] << s)
+            for j in range(1, s):
+                if (a >> (s - 1 - j)) & 1:
+                    new ^= m[k - j] << j
+            m.append(new)
+        directions.append([m[k] << (SOBOL_BITS - 1 - k) for k in range(SOBOL_BITS)])
+    return directions
+
+
+class SweepSpec:
+    """Index-addressable parameter space described by a sweep spec.
+
+    Attributes:
+        sampler: One of SAMPLERS
+        fleet: Total number of bikes
+        replicates: Number of seeds per parameter point
+        seed: Seed of the sampler, run seeds are seed + task index
+    """
+
+    def __init__(self, spec):
+        self.sampler = spec.get('sampler', 'grid')
+        if self.sampler not in SAMPLERS:
+            raise ValueError(f"unknown sampler {self.sampler!r}, expected one of {SAMPLERS}")
+        self.fleet = int(spec['fleet'])
+        self.replicates = int(spec.get('replicates', 1))
+        self.seed = int(spec.get('seed', 0))
+        self.fixed = {}
+        self.axes = []
+        self.ranges = []
+        for name in PARAMS:
+            value = spec[name]
+            if isinstance(value, list):
+                self.axes.append((name, value))
+            elif isinstance(value, dict) and 'num' in value:
+                values = np.linspace(value['min'], value['max'], int(value['num']))
+                if name in INTEGER_PARAMS:
+                    values = np.round(values).astype(int)
+                self.axes.append((name, values.tolist()))
+            elif isinstance(value, dict):
+                self.ranges.append((name, value['min'], value['max']))
+            else:
+                self.fixed[name] = value
+        if self.ranges and self.sampler == 'grid':
+            raise ValueError("min/max ranges without 'num' need a random, lhs or sobol sampler")
+        self.points = int(spec.get('points', 1)) if self.ranges else 1
+        self.n_combos = prod(len(values) for _, values in self.axes)
+
+        if self.sampler == 'lhs':
+            self._permutations = [_Permutation(self.points, _mix(self.seed * 31 + d)) for d in range(len(self.ranges))]
+        if self.sampler == 'sobol':
+            self._directions = _sobol_directions(len(self.ranges))
+            rng = np.random.default_rng(self.seed)
+            # random digital shift: scrambles the sequence without breaking its structure
+            self._shift = [int(x) for x in rng.integers(0, 1 << SOBOL_BITS, len(self.ranges), dtype=np.uint64)]
+
+    def __len__(self):
+        return self.points * self.n_combos * self.replicates
+
+    def _unit_point(self, sample):
+        """Coordinates in [0, 1)^len(ranges) of sampled point number `sample`."""
+        d = len(self.ranges)
+        if self.sampler == 'random':
+            return np.random.default_rng([self.seed, sample]).random(d)
+        if self.sampler == 'lhs':
+            jitter = np.random.default_rng([self.seed, sample]).random(d)
+            return [(perm(sample) + u) / self.points for perm, u in zip(self._permutations, jitter)]
+        coords = []
+        for v, shift in zip(self._directions, self._shift):
+            x = shift
+            i = sample
+            k = 0
+            while i:
+                if i & 1:
+                    x ^= v[k]
+                i >>= 1
+                k += 1
+            coords.append(x / (1 << SOBOL_BITS))
+        return coords
+
+    def task(self, index):
+        """Parameters of task number index (0 <= index < len(self))."""
+        if not 0 <= index < len(self):
+            raise IndexError(f"task {index} out of range, the sweep has {len(self)} tasks")
+        replicate = index % self.replicates
+        rest = index // self.replicates
+        combo = rest % self.n_combos
+        sample = rest // self.n_combos
+
+        row = dict(self.fixed)
+        for name, values in reversed(self.axes):
+            row[name] = values[combo % len(values)]
+            combo //= len(values)
+        if self.ranges:
+            for (name, lo, hi), u in zip(self.ranges, self._unit_point(sample)):
+                if name in INTEGER_PARAMS:
+                    row[name] = min(int(lo + u * (hi - lo + 1)), hi)
+                else:
+                    row[name] = lo + u * (hi - lo)
+        init_mailly = int(row['init_mailly'])
+        if not 0 <= init_mailly <= self.fleet:
+            raise ValueError(f"init_mailly={init_mailly} is outside [0, fleet={self.fleet}]")
+        return {
+            'init_mailly': init_mailly,
+            'init_moulin': self.fleet - init_mailly,
+            'steps': int(row['steps']),
+            'p1': float(row['p1']),
+            'p2': float(row['p2']),
+            'seed': self.seed + index,
+            'point': rest,
+            'replicate': replicate,
+        }
+
+    def __getitem__(self, index):
+        return self.task(index)
+
+    def iter_tasks(self, start=0, stop=None, step=1):
+        """Yield (index, task) lazily, e.g. iter_tasks(rank, None, size) for one MPI rank."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for index in range(start, stop, step):
+            yield index, self.task(index)
+
+
+def load_spec(path):
+    """Read a JSON sweep spec."""
+    with open(path, 'r') as f:
+        return SweepSpec(json.load(f))
+
+
+def main():
+    """Print the number of tasks of a spec (e.g. for sbatch --array) or some of its rows."""
+    my_parser = argparse.ArgumentParser(description="inspect a sweep spec")
+    my_parser.add_argument('spec',type=str,help='Path to the JSON sweep spec')
+    my_parser.add_argument('--head',type=int,default=0,help='Also print the first N tasks as CSV')
+    args = my_parser.parse_args()
+    spec = load_spec(args.spec)
+    print(len(spec))
+    columns = ['init_mailly', 'init_moulin', 'steps', 'p1', 'p2', 'seed', 'point', 'replicate']
+    if args.head:
+        print(','.join(columns))
+        for _, task in spec.iter_tasks(0, args.head):
+            print(','.join(str(task[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import argparse
+import atexit
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+
+def append_record(path, record):
+    """Append one JSON line to path.
+
+    Note:
+        The line goes out in a single write on a file opened in append mode,
+        so runners and array tasks can share one file on a local disk (on NFS
+        give each writer its own file and pass them all to `status`)
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def source_name(name):
+    """Who writes the records: name@host:pid (tells apart the runners sharing a file)."""
+    return f"{name}@{socket.gethostname()}:{os.getpid()}"
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def format_line(snapshot):
+    """One terminal line out of a progress record."""
+    total = snapshot['total'] if snapshot['total'] is not None else '?'
+    line = (f"[{snapshot['done']}/{total} done, {snapshot['failed']} failed, {snapshot['pending'] if snapshot['pending'] is not None else '?'} pending] "
+            f"{snapshot['steps_per_s']:.3g} steps/s, ETA {format_duration(snapshot['eta_s'])}")
+    utilization = [worker['utilization'] for worker in snapshot['workers'].values()]
+    if utilization:
+        line += f", util {sum(utilization) / len(utilization):.0%} (min {min(utilization):.0%}, {len(utilization)} workers)"
+    return line
+
+
+class Progress:
+    """Live progress of a sweep: tasks done, failed and pending, steps/s, ETA and utilization.
+
+    Every finished task is reported with update(), from any thread. A
+    background thread refreshes the terminal line (stderr, in place on a
+    terminal, one line every `every` seconds otherwise) and appends a record
+    to the JSONL file every `every` seconds; close() writes the last one.
+    Disabled (no show, no jsonl), every method returns at once.
+
+    Attributes:
+        total: Number of tasks of the sweep (None if unknown)
+        total_steps: Steps asked for by all the tasks; the ETA is then based
+            on steps rather than on tasks (None if unknown)
+        show: Whether to draw the terminal line
+        jsonl: JSONL file the records are appended to, or None
+        every: Seconds between two records
+        source: Name of the runner in the records
+    """
+
+    def __init__(self, total, total_steps=None, show=False, jsonl=None, every=10.0, source='sweep'):
+        self.total = total
+        self.total_steps = total_steps
+        self.show = show
+        self.jsonl = jsonl
+        self.every = every
+        self.source = source_name(source)
+        self.enabled = show or jsonl is not None
+        self.done = 0
+        self.failed = 0
+        self.steps = 0
+        self.planned = 0
+        self.workers = {}
+        self.errors = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._stop = threading.Event()
+        self._closed = False
+        if not self.enabled:
+            return
+        self._tty = show and sys.stderr.isatty()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+        # an exception that ends the runner still leaves an 'aborted' record
+        atexit.register(self.close, 'aborted')
+
+    def update(self, worker, task, seconds, steps=0, planned=None, error=None):
+        """Record one finished task.
+
+        Args:
+            worker: Who ran it (thread name, pid, rank...), for the utilization
+            task: Task id, kept with the error
+            seconds: Wall time the worker spent on it
+            steps: Steps simulated
+            planned: Steps asked for (default: steps), for the ETA
+            error: None if the task succeeded, else the error message
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.workers.setdefault(str(worker), {'tasks': 0, 'busy': 0.0})
+            entry['tasks'] += 1
+            entry['busy'] += seconds
+            self.planned += steps if planned is None else planned
+            if error is None:
+                self.done += 1
+                self.steps += steps
+            else:
+                self.failed += 1
+                if len(self.errors) < 10:
+                    self.errors.append({'task': task, 'error': error})
+
+    def snapshot(self, status='running'):
+        """The current progress, as the JSON-able record written to the JSONL file."""
+        with self._lock:
+            elapsed = time.perf_counter() - self._start
+            finished = self.done + self.failed
+            pending = self.total - finished if self.total is not None else None
+            eta = None
+            if pending is not None and finished:
+                if self.total_steps and self.planned:
+                    eta = elapsed * max(self.total_steps - self.planned, 0) / self.planned
+                else:
+                    eta = elapsed * pending / finished
+            return {
+                'time': time.time(),
+                'source': self.source,
+                'event': 'progress',
+                'status': status,
+                'elapsed': elapsed,
+                'total': self.total,
+                'done': self.done,
+                'failed': self.failed,
+                'pending': pending,
+                'steps': self.steps,
+                'steps_per_s': self.steps / elapsed if elapsed > 0 else 0.0,
+                'eta_s': eta,
+                'workers': {name: {**entry, 'utilization': entry['busy'] / elapsed if elapsed > 0 else 0.0}
+                            for name, entry in self.workers.items()},
+                'errors': list(self.errors),
+            }
+
+    def _draw(self, snapshot, end=''):
+        line = format_line(snapshot)
+        if self._tty:
+            sys.stderr.write('\r' + line.ljust(120) + end)
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+
+    def _run(self):
+        refresh = 1.0 if self._tty else self.every
+        next_record = time.perf_counter() + self.every
+        while not self._stop.wait(min(refresh, self.every)):
+            snapshot = self.snapshot()
+            if self.show:
+                self._draw(snapshot)
+            if self.jsonl is not None and time.perf_counter() >= next_record:
+                append_record(self.jsonl, snapshot)
+                next_record += self.every
+
+    def close(self, status='done'):
+        """Stop the refreshes and write the last line and record (idempotent)."""
+        if not self.enabled or self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        self._thread.join()
+        snapshot = self.snapshot(status)
+        if self.show:
+            self._draw(snapshot, end='\n')
+        if self.jsonl is not None:
+            append_record(self.jsonl, snapshot)
+
+
+class TaskTelemetry:
+    """One record for one task of an array job ({'event': 'task'}), appended when it ends.
+
+    finish() writes the record of a task that went through. A task that
+    raises, returns early or is killed by SIGTERM (e.g. the time limit of
+    the job) writes a failed record on its way out, so `status` can tell
+    failed tasks from pending ones.
+
+    Attributes:
+        path: JSONL file shared by the tasks, or None for no record at all
+        task: Task id (the array index)
+        total: Number of tasks of the array, if known
+        worker: Host the task runs on; the busy time of a host over the
+            span of the job is its utilization, above 100% with several
+            tasks per node
+    """
+
+    def __init__(self, path, task, total=None, source='run_one'):
+        self.path = path
+        self.task = task
+        self.total = total
+        self.source = source
+        self.worker = socket.gethostname()
+        self._start = time.perf_counter()
+        self._written = path is None
+        if path is None:
+            return
+        self._previous_hook = sys.excepthook
+        sys.excepthook = self._excepthook
+        signal.signal(signal.SIGTERM, self._sigterm)
+        atexit.register(self.finish, error='exited before the end of the task')
+
+    def _excepthook(self, exc_type, exc, tb):
+        self.finish(error=repr(exc))
+        self._previous_hook(exc_type, exc, tb)
+
+    def _sigterm(self, signum, frame):
+        self.finish(error='killed (SIGTERM, e.g. time limit)')
+        sys.exit(128 + signum)
+
+    def finish(self, steps=0, planned=None, error=None):
+        """Append the record of the task (only the first call writes)."""
+        if self._written:
+            return
+        self._written = True
+        append_record(self.path, {
+            'time': time.time(),
+            'source': source_name(self.source),
+            'event': 'task',
+            'task': self.task,
+            'total': self.total,
+            'worker': self.worker,
+            'seconds': time.perf_counter() - self._start,
+            'steps': steps,
+            'planned': steps if planned is None else planned,
+            'error': error,
+        })
+
+
+def read_records(paths):
+    """Every record of the JSONL files; a line cut short by a writer still at work is skipped."""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def task_status(records, total=None):
+    """Progress record aggregated from per-task records ({'event': 'task'}, e.g. run_one.py --telemetry).
+
+    The last record of a task wins (a rerun array task replaces its failure).
+    Utilization is the busy time of each worker over the span from the first
+    task start to the last record.
+    """
+    last = {}
+    for record in records:
+        last[record['task']] = record
+    if total is None:
+        total = max((record['total'] for record in records if record.get('total') is not None), default=None)
+    start = min(record['time'] - record['seconds'] for record in records)
+    end = max(record['time'] for record in records)
+    elapsed = max(end - start, 1e-9)
+    done = sum(record['error'] is None for record in last.values())
+    failed = len(last) - done
+    steps = sum(record['steps'] for record in last.values() if record['error'] is None)
+    workers = {}
+    for record in records:
+        entry = workers.setdefault(record['worker'], {'tasks': 0, 'busy': 0.0})
+        entry['tasks'] += 1
+        entry['busy'] += record['seconds']
+    pending = total - done - failed if total is not None else None
+    return {
+        'time': end,
+        'source': 'tasks',
+        'event': 'progress',
+        'status': 'done' if pending == 0 else 'running',
+        'elapsed': elapsed,
+        'total': total,
+        'done': done,
+        'failed': failed,
+        'pending': pending,
+        'steps': steps,
+        'steps_per_s': steps / elapsed,
+        'eta_s': elapsed * pending / len(last) if pending is not None else None,
+        'workers': {name: {**entry, 'utilization': entry['busy'] / elapsed} for name, entry in workers.items()},
+        'errors': [{'task': task, 'error': record['error']} for task, record in last.items() if record['error'] is not None][:10],
+    }
+
+
+def print_status(paths, total=None):
+    """Print the last progress record of every runner and the aggregate of the task records."""
+    records = read_records(paths)
+    latest = {}
+    tasks = []
+    for record in records:
+        if record.get('event') == 'task':
+            tasks.append(record)
+        else:
+            latest[record['source']] = record
+    now = time.time()
+    for source, record in latest.items():
+        print(f"{source} ({record['status']}, {format_duration(now - record['time'])} ago): {format_line(record)}")
+    if tasks:
+        record = task_status(tasks, total)
+        print(f"{len(tasks)} task records (last {format_duration(now - record['time'])} ago): {format_line(record)}")
+        for error in record['errors']:
+            print(f"  task {error['task']} failed: {error['error']}")
+    if not latest and not tasks:
+        print("no records yet")
+
+
+def parse_args():
+    """Parse command line arguments for reading telemetry files.
+
+    Returns:
+        Parsed arguments containing:
+        - files: JSONL telemetry files
+        - total: Number of tasks of the sweep, for the pending count of task records (default: the one they record)
+        - watch: Print the status again every this many seconds (default: once)
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="status of running sweeps from their telemetry files")
+    commands = my_parser.add_subparsers(dest='command', required=True)
+    status_parser = commands.add_parser('status', help='Print the progress recorded in JSONL telemetry files')
+    status_parser.add_argument('files',nargs='+',help='JSONL telemetry files')
+    status_parser.add_argument('--total',type=int,default=None,help='Number of tasks of the sweep, for the pending count and ETA of task records (default: the one they record)')
+    status_parser.add_argument('--watch',type=float,default=None,help='Print the status again every this many seconds')
+    return my_parser.parse_args()
+
+
+def main():
+    """Print the status of the sweeps writing to the given files."""
+    args = parse_args()
+    while True:
+        print_status(args.files, args.total)
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """Run output jobs (to_csv, savefig, sink writes...) in a writer thread.
+
+    The simulation hands finished results over with submit() and keeps going
+    while the thread formats and writes them. The queue is bounded: when the
+    writer falls behind, submit() blocks until a slot frees up, so pending
+    results never pile up in memory.
+
+    Jobs run in submission order. The first exception raised by a job is
+    re-raised by the next submit() or by close(); later jobs are skipped.
+    """
+
+    def __init__(self, max_pending=4):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); blocks while max_pending jobs are waiting."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        """Wait until every queued job is written, then stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self._error is not None:
+                continue
+            fn, args, kwargs = job
+            try:
+                fn(*args, **kwargs)
+            except BaseException as e:
+                self._error = e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original error behind a writer one
+            self._queue.put(None)
+            self._thread.join()
+
+
+class BackgroundSink:
+    """Wrap a stream_simulation sink so its blocks are written by a BackgroundWriter.
+
+    The simulation computes the next block while the previous one is flushed.
+    """
+
+    def __init__(self, sink, max_pending=4):
+        self.sink = sink
+        self._writer = BackgroundWriter(max_pending)
+
+    def write(self, columns):
+        self._writer.submit(self.sink.write, columns)
+
+    def close(self):
+        self._writer.close()
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._writer.__exit__(exc_type, *exc)
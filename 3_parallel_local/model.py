@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import Dict
+from typing import Callable, Dict, List
 import numpy as np
-import pandas as pd
+
+from stationarity import check_stationary
 
 
 @dataclass
@@ -65,6 +66,162 @@ def step(
     return state
 
 
+@dataclass
+class ThresholdPolicy:
+    """Rebalancing rule: every `period` steps, when |mailly - moulin| exceeds
+    `threshold`, an operator moves `k` bikes from the fuller station to the other.
+
+    Attributes:
+        threshold: Imbalance above which bikes are moved
+        k: Bikes moved per intervention (fewer if the station has fewer)
+        period: Steps between two looks at the imbalance
+    """
+
+    threshold: int
+    k: int
+    period: int = 1
+
+    def __call__(self, state: State, t: int) -> int:
+        """Apply the rule before the demand of step t; return the number of bikes moved."""
+        if t % self.period:
+            return 0
+        imbalance = state.mailly - state.moulin
+        if imbalance > self.threshold:
+            n = min(self.k, state.mailly)
+            state.mailly -= n
+            state.moulin += n
+            return n
+        if -imbalance > self.threshold:
+            n = min(self.k, state.moulin)
+            state.moulin -= n
+            state.mailly += n
+            return n
+        return 0
+
+
+class Observer:
+    """Hooks run_simulation calls as the simulation goes: subclass it and
+    override the ones you need, the others are never called.
+
+    Attributes:
+        every: on_step is called before every step t with t % every == 0 (0: never)
+
+    Note:
+        - station is 'mailly' or 'moulin', t the step
+        - With no observer run_simulation takes a loop without any hook,
+          so production sweeps pay nothing for them
+    """
+
+    every = 0
+
+    def on_trip(self, t: int, station: str) -> None:
+        """A bike left station during step t."""
+
+    def on_unmet(self, t: int, station: str) -> None:
+        """A user found station empty during step t."""
+
+    def on_empty(self, t: int, station: str) -> None:
+        """station gave its last bike during step t."""
+
+    def on_step(self, t: int, state: State) -> None:
+        """State before step t (read only)."""
+
+
+# uniforms drawn at once by _fast_loop: the same stream as one rng.random() per draw
+DRAW_BLOCK = 4096
+
+
+def _fast_loop(state, start, stop, p1, p2, rng, res):
+    """Steps start .. stop - 1 of run_simulation without hooks: step() with local variables."""
+    mailly, moulin = state.mailly, state.moulin
+    unmet_mailly, unmet_moulin = state.unmet_mailly, state.unmet_moulin
+    record_mailly = res["mailly"].append
+    record_moulin = res["moulin"].append
+    record_unmet_mailly = res["unmet_mailly"].append
+    record_unmet_moulin = res["unmet_moulin"].append
+    record_imbalance = res["final_imbalance"].append
+    for block in range(start, stop, DRAW_BLOCK):
+        u = rng.random(2 * (min(block + DRAW_BLOCK, stop) - block)).tolist()
+        for k in range(0, len(u), 2):
+            record_mailly(mailly)
+            record_moulin(moulin)
+            record_unmet_mailly(unmet_mailly)
+            record_unmet_moulin(unmet_moulin)
+            record_imbalance(mailly - moulin)
+            if u[k] < p1:
+                if mailly:
+                    mailly -= 1
+                    moulin += 1
+                else:
+                    unmet_mailly += 1
+            if u[k + 1] < p2:
+                if moulin:
+                    moulin -= 1
+                    mailly += 1
+                else:
+                    unmet_moulin += 1
+    state.mailly, state.moulin = mailly, moulin
+    state.unmet_mailly, state.unmet_moulin = unmet_mailly, unmet_moulin
+
+
+def _hooks(observers, name):
+    """Bound `name` hooks of the observers that override it."""
+    default = getattr(Observer, name)
+    return [getattr(o, name) for o in observers if getattr(type(o), name, default) is not default]
+
+
+class _ObservedLoop:
+    """Steps of run_simulation with rebalance and/or observers (same draws as step())."""
+
+    def __init__(self, observers, rebalance):
+        self.rebalance = rebalance
+        self.n_moves = 0
+        self.on_trip = _hooks(observers, 'on_trip')
+        self.on_unmet = _hooks(observers, 'on_unmet')
+        self.on_empty = _hooks(observers, 'on_empty')
+        self.on_step = [(o.every, o.on_step) for o in observers if o.every and _hooks([o], 'on_step')]
+
+    def _trip(self, t, station, left):
+        for hook in self.on_trip:
+            hook(t, station)
+        if not left:
+            for hook in self.on_empty:
+                hook(t, station)
+
+    def __call__(self, state, start, stop, p1, p2, rng, res):
+        random = rng.random
+        for t in range(start, stop):
+            res["mailly"].append(state.mailly)
+            res["moulin"].append(state.moulin)
+            res["unmet_mailly"].append(state.unmet_mailly)
+            res["unmet_moulin"].append(state.unmet_moulin)
+            res["final_imbalance"].append(state.mailly - state.moulin)
+            for every, hook in self.on_step:
+                if t % every == 0:
+                    hook(t, state)
+            if self.rebalance is not None:
+                res["moves"].append(self.n_moves)
+                self.n_moves += self.rebalance(state, t)
+            if random() < p1:
+                if state.mailly:
+                    state.mailly -= 1
+                    state.moulin += 1
+                    self._trip(t, 'mailly', state.mailly)
+                else:
+                    state.unmet_mailly += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'mailly')
+            if random() < p2:
+                if state.moulin:
+                    state.moulin -= 1
+                    state.mailly += 1
+                    self._trip(t, 'moulin', state.moulin)
+                else:
+                    state.unmet_moulin += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'moulin')
+
+
 def run_simulation(
     initial_mailly: int,
     initial_moulin: int,
@@ -72,6 +229,10 @@ def run_simulation(
     p1: float,
     p2: float,
     seed: int,
+    stop_tol: float = None,
+    check_every: int = 1000,
+    rebalance: Callable[[State, int], int] = None,
+    observers: List['Observer'] = None,
 ) -> Dict[str, list]:
     """Run a complete bike-sharing simulation with extended metrics.
 
@@ -81,6 +242,15 @@ def run_simulation(
         p1: Probability of movement from Mailly to Moulin
         p2: Probability of movement from Moulin to Mailly
         seed: Random seed for reproducibility
+        stop_tol: Stop early once the run is stationary within this tolerance
+            (stationarity.check_stationary), None to run all the steps
+        check_every: Steps between two stationarity checks at the start;
+            later checks are 10% of the steps apart, so they cost O(steps) in all
+        rebalance: Operator intervention, called as rebalance(state, t) after
+            step t is recorded and before its demand, returns the bikes it
+            moved (e.g. ThresholdPolicy); None for no intervention
+        observers: Observer instances called on trips, unmet requests,
+            stations running empty and every `every` steps; None for none
 
     Returns:
         - Dictionary indexed by step, metrics including:
@@ -89,33 +259,140 @@ def run_simulation(
             - 'unmet_mailly': Number of unmet requests at Mailly
             - 'unmet_moulin': Number of unmet requests at Moulin
             - 'final_imbalance': Final difference between station bike counts
+            - 'moves': Bikes moved by rebalance so far (only with rebalance)
 
     Note:
         - Create the state object with initial bike counts
         - Initialize metrics dictionary with all required counters
         - Record state at each time step for the DataFrame
         - Calculate final imbalance as mailly - moulin
+        - A run stopped early at step n has lists of length n, exactly those
+          of the same run with steps=n
+        - Without rebalance nor observers the steps run in _fast_loop (no
+          State, no metrics dict, uniforms drawn by blocks), otherwise in
+          an _ObservedLoop; both follow step() draw for draw, so they give the
+          same run
     """
+    rng = np.random.default_rng(seed)
+    res = {"mailly": [], "moulin": [], "unmet_mailly": [], "unmet_moulin": [], "final_imbalance": []}
+    if rebalance is not None:
+        res["moves"] = []
     state = State(mailly=initial_mailly,moulin=initial_moulin)
+    if rebalance is None and not observers:
+        loop = _fast_loop
+    else:
+        loop = _ObservedLoop(observers or [], rebalance)
+    # the steps go by segments between two stationarity checks
+    i = 0
+    next_check = check_every if stop_tol is not None else steps
+    while i < steps:
+        stop = min(next_check, steps)
+        loop(state, i, stop, p1, p2, rng, res)
+        i = stop
+        if i == steps or check_stationary(res, p1, p2, stop_tol)[0]:
+            break
+        next_check = i + max(check_every, i // 10)
+    return res
+
+
+# steps per chunk of run_simulation_chunked: the NumPy calls are long enough to
+# run without the GIL most of the time (~100 calls per chunk hold it), and the
+# temporaries stay in cache (2^15 and up is slower on one core)
+CHUNK_STEPS = 1 << 14
+
+
+def _clamp_scan(shift, low, high):
+    """Prefix compositions of the step maps x -> clip(x + shift[t], low[t], high[t]), in place.
+
+    After the call map t is f_t o ... o f_0. The composition of two such maps
+    is one again, clip(clip(x + s1, l1, h1) + s2, l2, h2) =
+    clip(x + s1 + s2, clip(l1 + s2, l2, h2), clip(h1 + s2, l2, h2)), so the
+    scan is exact: log2(n) passes of whole-array operations (Hillis-Steele).
+    """
+    d = 1
+    while d < len(shift):
+        s2, l2, h2 = shift[d:], low[d:], high[d:]
+        new_low = np.minimum(np.maximum(low[:-d] + s2, l2), h2)
+        new_high = np.minimum(np.maximum(high[:-d] + s2, l2), h2)
+        new_shift = shift[:-d] + s2
+        shift[d:] = new_shift
+        low[d:] = new_low
+        high[d:] = new_high
+        d *= 2
+
+
+def run_simulation_chunked(
+    initial_mailly: int,
+    initial_moulin: int,
+    steps: int,
+    p1: float,
+    p2: float,
+    seed: int,
+    stop_tol: float = None,
+    check_every: int = 1000,
+) -> Dict[str, np.ndarray]:
+    """run_simulation in NumPy chunks of CHUNK_STEPS steps, same results as arrays.
+
+    One step moves Mailly from m to min(max(m - a1, 0) + a2, fleet), a1 and
+    a2 the two requests of the step, i.e. clip(m + a2 - a1, min(a2, fleet),
+    fleet): a chunk of steps is a prefix scan of such maps (_clamp_scan), and
+    the unmet requests follow from the state before each step. The uniforms
+    are drawn in the order of step(), so the run is the one run_simulation
+    gives, draw for draw.
+
+    Nearly all the time is spent inside NumPy calls that release the GIL, so
+    threads running it scale with the cores; the call keeps no state outside
+    its own generator and arrays, so it is also safe on free-threaded builds.
+
+    Returns:
+        The dictionary of run_simulation (no 'moves': no rebalance here), with
+        int64 arrays instead of lists
+    """
+    fleet = initial_mailly + initial_moulin
     rng = np.random.default_rng(seed)
-    metrics = {'unmet_mailly':0,'unmet_moulin':0}
-    mailly = []
-    moulin = []
-    unmet_mailly = []
-    unmet_moulin = []
-    final_imbalance = []
-    for i in range(steps):
-        mailly.append(state.mailly)
-        moulin.append(state.moulin)
-        unmet_mailly.append(state.unmet_mailly)
-        unmet_moulin.append(state.unmet_moulin)
-        final_imbalance.append(state.mailly - state.moulin)
-        step(state,p1,p2,rng,metrics)
+    mailly = np.empty(steps, dtype=np.int64)
+    unmet_mailly = np.empty(steps, dtype=np.int64)
+    unmet_moulin = np.empty(steps, dtype=np.int64)
+    m, n_unmet_mailly, n_unmet_moulin = initial_mailly, 0, 0
+    # the chunks go by segments between two stationarity checks, as in run_simulation
+    i = 0
+    next_check = check_every if stop_tol is not None else steps
+    while i < steps:
+        stop = min(next_check, steps)
+        for start in range(i, stop, CHUNK_STEPS):
+            end = min(start + CHUNK_STEPS, stop)
+            u = rng.random((end - start, 2))
+            a1 = u[:, 0] < p1
+            a2 = u[:, 1] < p2
+            shift = a2.astype(np.int64) - a1
+            low = a2.astype(np.int64) if fleet else np.zeros(end - start, dtype=np.int64)
+            high = np.full(end - start, fleet, dtype=np.int64)
+            _clamp_scan(shift, low, high)
+            before = mailly[start:end]
+            before[0] = m
+            before[1:] = np.minimum(np.maximum(m + shift[:-1], low[:-1]), high[:-1])
+            # Mailly empty for its request, then Moulin empty for the second one
+            unmet_a = a1 & (before == 0)
+            unmet_b = a2 & (np.maximum(before - a1, 0) == fleet)
+            np.cumsum(unmet_a, out=unmet_mailly[start:end])
+            np.cumsum(unmet_b, out=unmet_moulin[start:end])
+            unmet_mailly[start:end] += n_unmet_mailly - unmet_a
+            unmet_moulin[start:end] += n_unmet_moulin - unmet_b
+            n_unmet_mailly += int(unmet_a.sum())
+            n_unmet_moulin += int(unmet_b.sum())
+            m = int(min(max(m + shift[-1], low[-1]), high[-1]))
+        i = stop
+        if i == steps:
+            break
+        so_far = {"mailly": mailly[:i], "moulin": fleet - mailly[:i], "unmet_mailly": unmet_mailly[:i], "unmet_moulin": unmet_moulin[:i]}
+        if check_stationary(so_far, p1, p2, stop_tol)[0]:
+            break
+        next_check = i + max(check_every, i // 10)
+    mailly = mailly[:i]
     return {
-    "mailly": mailly,
-    "moulin": moulin,
-    "unmet_mailly": unmet_mailly,
-    "unmet_moulin": unmet_moulin,
-    "final_imbalance": final_imbalance
+        "mailly": mailly,
+        "moulin": fleet - mailly,
+        "unmet_mailly": unmet_mailly[:i],
+        "unmet_moulin": unmet_moulin[:i],
+        "final_imbalance": 2 * mailly - fleet,
     }
-        
\ No newline at end of file
@@ -0,0 +1,255 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import matplotlib
+# no display needed, and Agg is the fastest backend to write PNGs
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+
+# points kept per series: about two per pixel column of a 14 inch figure at 100 dpi
+MAX_POINTS = 2000
+# runs per page of small multiples, and points per series in a panel (about 300 pixels wide)
+GRID_RUNS = 25
+GRID_POINTS = 300
+# points drawn by all the runs of the overlay together (a few hundred at least per run)
+OVERLAY_POINTS = 20000
+# series of a run, by panel: (key, label, color)
+PANELS = [
+    ('Bikes at Stations', 'Number of Bikes', [('mailly', 'Mailly', 'blue'), ('moulin', 'Moulin', 'green')]),
+    ('Unmet Demand', 'Unmet Demand', [('unmet_mailly', 'Unmet Mailly', 'red'), ('unmet_moulin', 'Unmet Moulin', 'orange')]),
+]
+
+
+def rolling_mean(values, window):
+    """Mean over a sliding window, as np.convolve(values, np.ones(window)/window, mode='valid').
+
+    Note:
+        Difference of two cumulative sums: O(n) whatever the window (convolve
+        is O(n * window)); exact for the integer series of the model, whose
+        sums stay far below 2**53
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if window <= 1 or len(values) < window:
+        return values
+    cumsum = np.empty(len(values) + 1)
+    cumsum[0] = 0.0
+    np.cumsum(values, out=cumsum[1:])
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def minmax(values, n_out):
+    """Indices of the min and max of values in n_out // 2 equal buckets, plus the first and last points.
+
+    A line through them covers the same pixels as one through every point:
+    spikes and plateaus survive, whatever the length of the run.
+
+    Returns:
+        Sorted int64 array of at most n_out + 4 indices
+    """
+    n = len(values)
+    if n <= n_out:
+        return np.arange(n)
+    size = -(-n // max(n_out // 2, 1))
+    full = n // size * size
+    blocks = values[:full].reshape(-1, size)
+    base = np.arange(blocks.shape[0]) * size
+    low = blocks.argmin(axis=1) + base
+    high = blocks.argmax(axis=1) + base
+    extra = [0, n - 1]
+    if full < n:
+        tail = values[full:]
+        extra += [full + int(tail.argmin()), full + int(tail.argmax())]
+    return np.unique(np.concatenate([low, high, extra]))
+
+
+def lttb(values, n_out):
+    """Indices picked by Largest-Triangle-Three-Buckets: the point of each bucket
+    making the largest triangle with the previous pick and the mean of the next bucket.
+
+    Returns:
+        Sorted int64 array of n_out indices (first and last point included)
+
+    Note:
+        One vectorized pass per bucket, O(n) in all; keeps the shape of the
+        curve better than minmax for a given number of points, but can drop
+        isolated spikes
+    """
+    n = len(values)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    y = np.asarray(values, dtype=np.float64)
+    # n_out - 2 buckets over the points between the first and the last
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    picked = np.empty(n_out, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        cx = (hi + next_hi - 1) / 2
+        cy = y[hi:next_hi].mean()
+        area = np.abs((a - cx) * (y[lo:hi] - y[a]) - (a - np.arange(lo, hi)) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        picked[i + 1] = a
+    return picked
+
+
+DOWNSAMPLERS = {'minmax': minmax, 'lttb': lttb}
+
+
+def downsample(values, n_out=MAX_POINTS, method='minmax'):
+    """(x, y) of at most about n_out points of values, x being the positions in values."""
+    values = np.asarray(values)
+    index = DOWNSAMPLERS[method](values, n_out)
+    return index, values[index]
+
+
+def thin(xy, n_out):
+    """The (x, y) of summarize_run() downsampled again (minmax) to n_out points, for small panels."""
+    x, y = xy
+    index = minmax(y, n_out)
+    return x[index], y[index]
+
+
+def summarize_run(res, smooth_window=1, max_points=MAX_POINTS, method='minmax'):
+    """What the figures need of a run: every series smoothed and downsampled.
+
+    O(n) in the length of the run and a few thousand points whatever it is, so
+    a sweep can keep the summary of every run instead of the trajectories.
+
+    Args:
+        res: Run with per-step 'mailly', 'moulin' and optionally 'unmet_*'
+            series (dict of lists or arrays, DataFrame, structured array...),
+            and 'time' for the x axis
+        smooth_window: Window of the rolling mean (1: no smoothing)
+        max_points: Points kept per series
+        method: 'minmax' or 'lttb'
+
+    Returns:
+        Dict series name -> (x, y) arrays
+    """
+    # the fields of a structured array (e.g. a .npy trajectory), else the keys or columns
+    fields = getattr(getattr(res, 'dtype', None), 'names', None) or res
+    time = np.asarray(res['time']) if 'time' in fields else None
+    summary = {}
+    for _, _, series in PANELS:
+        for key, _, _ in series:
+            if key not in fields:
+                continue
+            values = rolling_mean(res[key], smooth_window) if smooth_window > 1 else np.asarray(res[key])
+            x, y = downsample(values, max_points, method)
+            # a smoothed point sits at the end of its window
+            x = x + (smooth_window - 1 if smooth_window > 1 else 0)
+            summary[key] = (time[x] if time is not None else x, y)
+    return summary
+
+
+def draw_run(summary, title, path):
+    """The figure of one run: bikes at the stations, and the unmet demand if the run has it."""
+    panels = [panel for panel in PANELS if any(key in summary for key, _, _ in panel[2])]
+    fig, axes = plt.subplots(len(panels), 1, figsize=(14, 5 * len(panels)), squeeze=False)
+    for ax, (panel_title, ylabel, series) in zip(axes[:, 0], panels):
+        for key, label, color in series:
+            if key in summary:
+                ax.plot(*summary[key], label=label, color=color)
+        ax.set_title(f"{title}: {panel_title}" if title else panel_title)
+        ax.set_xlabel('Time')
+        ax.set_ylabel(ylabel)
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+    # fixed margins: tight_layout measures every tick label, a third of the time of the figure
+    height = 5 * len(panels)
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.6 / height, top=1 - 0.4 / height, hspace=0.3)
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+
+
+def draw_overlay(summaries, labels, path):
+    """Every run on the same axes, one panel per series.
+
+    Note:
+        A panel is one LineCollection rather than a line per run (the cost of
+        a figure goes with its artists), and the runs share OVERLAY_POINTS
+    """
+    keys = [key for _, _, series in PANELS for key, _, _ in series if key in summaries[0]]
+    n_points = min(MAX_POINTS, max(200, OVERLAY_POINTS // len(summaries)))
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    fig, axes = plt.subplots(len(keys), 1, figsize=(14, 3.5 * len(keys)), squeeze=False, sharex=True)
+    # transparent lines once there are many runs
+    alpha = 1.0 if len(summaries) <= 10 else max(0.1, 10 / len(summaries))
+    for ax, key in zip(axes[:, 0], keys):
+        lines = [np.column_stack(thin(summary[key], n_points)) for summary in summaries]
+        ax.add_collection(LineCollection(lines, colors=colors, linewidths=0.8, alpha=alpha))
+        ax.autoscale_view()
+        ax.set_title(key)
+        ax.grid(True, alpha=0.3)
+    if len(summaries) <= 10:
+        axes[0, 0].legend(handles=[plt.Line2D([], [], color=colors[i % len(colors)]) for i in range(len(labels))], labels=labels)
+    axes[-1, 0].set_xlabel('Time')
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.05, top=0.96, hspace=0.3)
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+
+
+def draw_grid(summaries, labels, path):
+    """Small multiples: one panel per run, bikes at Mailly and Moulin, shared axes."""
+    n_cols = int(np.ceil(np.sqrt(len(summaries))))
+    n_rows = -(-len(summaries) // n_cols)
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(3 * n_cols, 2.2 * n_rows), squeeze=False, sharex=True, sharey=True)
+    for ax in axes.flat[len(summaries):]:
+        ax.set_visible(False)
+    for ax, summary, label in zip(axes.flat, summaries, labels):
+        for key, _, color in PANELS[0][2]:
+            if key in summary:
+                ax.plot(*thin(summary[key], GRID_POINTS), color=color, linewidth=0.6)
+        ax.set_title(label, fontsize=8)
+        ax.tick_params(labelsize=6)
+    fig.subplots_adjust(left=0.05, right=0.99, bottom=0.05, top=0.95, hspace=0.35, wspace=0.1)
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+
+
+def _draw(job):
+    draw, args = job
+    draw(*args)
+    return args[-1]
+
+
+def plot_runs(summaries, output_dir, labels=None, workers=None):
+    """Write the figures of a sweep, each one drawn in its own worker process.
+
+    plot.png is the first run (as before), plot_overlay.png every run on the
+    same axes and plot_grid_<k>.png the small multiples, GRID_RUNS runs a page.
+
+    Args:
+        summaries: summarize_run() of every run
+        output_dir: Directory of the PNG files
+        labels: Name of every run (default: run <i>)
+        workers: Processes drawing the figures (default: one per figure, up to
+            the number of CPUs; 1 draws them in this process)
+
+    Returns:
+        Paths of the files written
+    """
+    if not summaries:
+        return []
+    output_dir = Path(output_dir)
+    if labels is None:
+        labels = [f"run {i}" for i in range(len(summaries))]
+    labels = [str(label) for label in labels]
+    jobs = [(draw_run, (summaries[0], labels[0], output_dir / "plot.png")),
+            (draw_overlay, (summaries, labels, output_dir / "plot_overlay.png"))]
+    for page, start in enumerate(range(0, len(summaries), GRID_RUNS)):
+        jobs.append((draw_grid, (summaries[start:start + GRID_RUNS], labels[start:start + GRID_RUNS], output_dir / f"plot_grid_{page}.png")))
+    if workers is None:
+        workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        return [_draw(job) for job in jobs]
+    # forked workers start with matplotlib already imported; the summaries are small to send
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_draw, jobs))
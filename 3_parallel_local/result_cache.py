@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from streams import seed_key
+
+
+# bump when the layout of the cache entries changes
+CACHE_FORMAT = 1
+# sources next to model.py the results also depend on: stationarity.py decides
+# when a --stop-tol run stops, streams.py what a seed draws
+MODEL_DEPENDENCIES = ('stationarity.py', 'streams.py')
+
+
+def model_fingerprint(model_module):
+    """Hash of the model source and of MODEL_DEPENDENCIES: editing any of them invalidates the cached results."""
+    model_path = Path(model_module.__file__)
+    digest = hashlib.sha256()
+    for path in [model_path] + [model_path.parent / name for name in MODEL_DEPENDENCIES]:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def params_key(init_mailly, init_moulin, steps, p1, p2, seed, fingerprint, stop=None):
+    """Content address of one simulation (run_simulation is deterministic given these).
+
+    Note:
+        seed is an integer or a streams.py SeedSequence, keyed by its identity;
+        stop is (stop_tol, check_every) for a run that may stop early, None otherwise
+    """
+    params = {
+        'init_mailly': int(init_mailly),
+        'init_moulin': int(init_moulin),
+        'steps': int(steps),
+        'p1': float(p1),
+        'p2': float(p2),
+        'seed': seed_key(seed),
+        'model': fingerprint,
+        'format': CACHE_FORMAT,
+    }
+    if stop is not None:
+        params['stop'] = [float(stop[0]), int(stop[1])]
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """On-disk cache of simulation results shared by every runner and process.
+
+    Each entry is <dir>/<key[:2]>/<key>.json (the metrics) plus, optionally,
+    <key>.npz (the trajectory, compressed). Files are written under a
+    temporary name and renamed into place, so concurrent readers and writers
+    never see half an entry; the .json goes last and marks the entry as
+    complete. Hits refresh the mtime, and evict() removes the least recently
+    used entries once the cache is bigger than max_bytes.
+
+    Attributes:
+        path: Cache directory
+        fingerprint: Model fingerprint mixed into every key
+        max_bytes: Size limit enforced by evict()
+        hits, misses: Lookups answered from the cache or not (thread safe: one cache can be shared by threads)
+    """
+
+    def __init__(self, path, fingerprint, max_bytes=1024 * 1024 * 1024):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._count_lock = threading.Lock()
+
+    def key(self, init_mailly, init_moulin, steps, p1, p2, seed, stop=None):
+        return params_key(init_mailly, init_moulin, steps, p1, p2, seed, self.fingerprint, stop)
+
+    def _entry(self, key):
+        return self.path / key[:2] / key
+
+    def get(self, key, need_trajectory=False):
+        """Return (metrics, trajectory or None), or None on a miss.
+
+        Note:
+            With need_trajectory=True an entry stored without trajectory is a miss
+        """
+        entry = self._entry(key)
+        try:
+            with open(entry.with_suffix('.json'), 'r') as f:
+                metrics = json.load(f)
+            trajectory = None
+            if need_trajectory:
+                with np.load(entry.with_suffix('.npz')) as data:
+                    trajectory = {name: data[name] for name in data.files}
+            os.utime(entry.with_suffix('.json'))
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # missing, evicted meanwhile or unreadable: simulate again
+            with self._count_lock:
+                self.misses += 1
+            return None
+        with self._count_lock:
+            self.hits += 1
+        return metrics, trajectory
+
+    def put(self, key, metrics, trajectory=None):
+        """Store metrics (a JSON-able dict) and optionally a dict of trajectory arrays."""
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        if trajectory is not None:
+            tmp_path = entry.with_name(entry.name + '.npz' + tmp)
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **{name: np.asarray(values) for name, values in trajectory.items()})
+            os.replace(tmp_path, entry.with_suffix('.npz'))
+        tmp_path = entry.with_name(entry.name + '.json' + tmp)
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f)
+        os.replace(tmp_path, entry.with_suffix('.json'))
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes.
+
+        Note:
+            Several processes may evict at the same time, files that are
+            already gone are skipped
+        """
+        entries = {}
+        total = 0
+        if not self.path.exists():
+            return
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for f in os.scandir(shard.path):
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                key, _, suffix = f.name.partition('.')
+                size, mtime = entries.get(key, (0, 0))
+                # the .json mtime is the one refreshed on hits
+                entries[key] = (size + st.st_size, st.st_mtime if suffix == 'json' else mtime)
+        if total <= self.max_bytes:
+            return
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            entry = self._entry(key)
+            for suffix in ('.json', '.npz'):
+                try:
+                    os.remove(entry.with_suffix(suffix))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def run_cached(cache, run_simulation, init_mailly, init_moulin, steps, p1, p2, seed,
+               need_trajectory=False, store_trajectory=False, stop_tol=None, check_every=1000):
+    """Look a simulation up in the cache, run and store it on a miss.
+
+    Args:
+        cache: ResultCache, or None to always simulate
+        run_simulation: the model function (dict of per-step lists or arrays version)
+        init_mailly, init_moulin, steps, p1, p2, seed: simulation parameters (seed: integer or SeedSequence)
+        need_trajectory: the caller needs the per-step lists, not only the final values
+        store_trajectory: also store the compressed trajectory on a miss (only
+            then: a caller needing it, e.g. for --plot, does not fill the cache with it)
+        stop_tol, check_every: stop the run early once stationary (run_simulation options)
+
+    Returns:
+        Tuple (final, res): final maps each model output to its last value,
+        res is the per-step dict (None on a hit when need_trajectory is False);
+        with stop_tol final also has 'steps_used'
+    """
+    key = None
+    stop = (stop_tol, check_every) if stop_tol is not None else None
+    if cache is not None:
+        key = cache.key(init_mailly, init_moulin, steps, p1, p2, seed, stop)
+        cached = cache.get(key, need_trajectory=need_trajectory)
+        if cached is not None:
+            return cached
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = int(seed)
+    if stop is None:
+        res = run_simulation(int(init_mailly), int(init_moulin), int(steps), p1, p2, seed)
+    else:
+        res = run_simulation(int(init_mailly), int(init_moulin), int(steps), p1, p2, seed, stop_tol=stop_tol, check_every=check_every)
+    final = {name: int(values[-1]) for name, values in res.items()}
+    if stop is not None:
+        final['steps_used'] = len(res['mailly'])
+    if cache is not None:
+        cache.put(key, final, res if store_trajectory else None)
+    return final, res
@@ -0,0 +1,277 @@
+import argparse
+from pathlib import Path
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+
+import model
+from result_cache import model_fingerprint
+from run_parallel import multi_work
+
+
+# outputs the refinement follows: total unmet demand and final imbalance
+OUTPUTS = ('unmet_total', 'final_imbalance')
+
+
+def parse_args():
+    """Parse command line arguments for the adaptive (p1, p2) sweep.
+
+    Returns:
+        Parsed arguments containing:
+        - p1_min, p1_max, p2_min, p2_max: Bounds of the (p1, p2) square
+        - coarse: Number of points per axis of the initial grid
+        - max_level: Number of times a cell may be split in four
+        - tol: Refine a cell when interpolation misses its center by more than tol (fraction of the output range)
+        - front: Also refine a cell when an output varies by more than front (fraction of its range) across its corners
+        - replicates: Seeds averaged at every point
+        - steps, init_mailly, init_moulin, seed: Simulation parameters
+        - workers: Number of workers ('auto' for automatic detection)
+        - backend: 'processes' (multiprocessing) or 'threads'
+        - out_dir: Output directory for results
+        - cache_dir: Result cache directory (default: no cache)
+        - check_dense: Also run the dense grid and report the interpolation error
+        - plot: Boolean flag to generate plot
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_args = argparse.ArgumentParser(description="adaptive (p1, p2) parameter sweep")
+    my_args.add_argument('--p1-min',type=float,default=0.0,help='Lower bound of p1 (default: 0)')
+    my_args.add_argument('--p1-max',type=float,default=1.0,help='Upper bound of p1 (default: 1)')
+    my_args.add_argument('--p2-min',type=float,default=0.0,help='Lower bound of p2 (default: 0)')
+    my_args.add_argument('--p2-max',type=float,default=1.0,help='Upper bound of p2 (default: 1)')
+    my_args.add_argument('--coarse',type=int,default=5,help='Points per axis of the initial grid (default: 5)')
+    my_args.add_argument('--max-level',type=int,default=3,help='Number of refinement rounds (default: 3)')
+    my_args.add_argument('--tol',type=float,default=0.05,help='Refinement threshold on the interpolation error at cell centers, fraction of the output range (default: 0.05)')
+    my_args.add_argument('--front',type=float,default=0.5,help='Refine cells an output crosses by more than this fraction of its range (default: 0.5)')
+    my_args.add_argument('--replicates',type=int,default=4,help='Seeds averaged at every point (default: 4)')
+    my_args.add_argument('--steps',type=int,default=1000,help='Number of simulation steps (default: 1000)')
+    my_args.add_argument('--init-mailly',type=int,default=10,help='Initial bikes at Mailly (default: 10)')
+    my_args.add_argument('--init-moulin',type=int,default=5,help='Initial bikes at Moulin (default: 5)')
+    my_args.add_argument('--seed',type=int,default=0,help='First seed, replicate r uses seed + r at every point (default: 0)')
+    my_args.add_argument('--workers',type=str,default='4', help=' Number of workers (auto: for automatic detection)')
+    my_args.add_argument('--backend',choices=['processes','threads'],default='processes',help='Pool used for each round (default: processes)')
+    my_args.add_argument('--out-dir',type=str,default='results', help=' Output directory for results')
+    my_args.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_args.add_argument('--check-dense',action='store_true',help='Also run the equivalent dense grid and report the error')
+    my_args.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
+    return my_args.parse_args()
+
+
+def evaluate(pool, points, coords, args):
+    """Run every point with args.replicates seeds in one round of tasks.
+
+    Args:
+        pool: multiprocessing or thread pool
+        points: List of lattice points (i, j)
+        coords: Function mapping a lattice point to (p1, p2)
+        args: Parsed arguments
+
+    Returns:
+        Dictionary point -> dict of OUTPUTS averaged over the replicates
+    """
+    tasks = []
+    for k, point in enumerate(points):
+        p1, p2 = coords(point)
+        for r in range(args.replicates):
+            task = {
+                'run_id': k * args.replicates + r,
+                'init_mailly': args.init_mailly,
+                'init_moulin': args.init_moulin,
+                'steps': args.steps,
+                'p1': p1,
+                'p2': p2,
+                # same seeds at every point: the differences between points
+                # come from (p1, p2), not from the noise
+                'seed': args.seed + r,
+            }
+            if args.cache_dir:
+                task['cache_dir'] = args.cache_dir
+                task['model_fingerprint'] = model_fingerprint(model)
+            tasks.append(task)
+    sums = np.zeros((len(points), len(OUTPUTS)))
+    for summary in pool.imap_unordered(multi_work, tasks, chunksize=args.replicates):
+        k = summary['run_id'] // args.replicates
+        sums[k, 0] += summary['unmet_mailly'] + summary['unmet_moulin']
+        sums[k, 1] += summary['ambulance']
+    means = sums / args.replicates
+    return {point: dict(zip(OUTPUTS, means[k])) for k, point in enumerate(points)}
+
+
+def output_ranges(values):
+    """Range (max - min) of every output over the evaluated points, 1 when flat."""
+    return {name: (max(v[name] for v in values.values()) - min(v[name] for v in values.values())) or 1.0
+            for name in OUTPUTS}
+
+
+def corners(cell):
+    """Lattice corners of a cell (i, j, h): lower left corner and side h."""
+    i, j, h = cell
+    return [(i, j), (i + h, j), (i, j + h), (i + h, j + h)]
+
+
+def cell_points(cell):
+    """Points a cell needs: its corners, and its center unless it is a finest cell."""
+    i, j, h = cell
+    if h == 1:
+        return corners(cell)
+    return corners(cell) + [(i + h // 2, j + h // 2)]
+
+
+def spread(cell, values, scale):
+    """Largest variation of an output across the corners of a cell, as a fraction of its range."""
+    worst = 0.0
+    for name in OUTPUTS:
+        corner_values = [values[point][name] for point in corners(cell)]
+        worst = max(worst, (max(corner_values) - min(corner_values)) / scale[name])
+    return worst
+
+
+def surplus(cell, values, scale):
+    """Largest gap between an output at the center of a cell and the mean of its corners.
+
+    Note:
+        This is the error bilinear interpolation would make at the center: it is
+        zero where the outputs vary linearly (however fast), and large around the
+        kinks where unmet demand leaves zero or saturates, which is where the
+        contours need resolution
+    """
+    i, j, h = cell
+    center = values[(i + h // 2, j + h // 2)]
+    worst = 0.0
+    for name in OUTPUTS:
+        corner_mean = np.mean([values[point][name] for point in corners(cell)])
+        worst = max(worst, abs(center[name] - corner_mean) / scale[name])
+    return worst
+
+
+def interpolate(cells, values, n):
+    """Bilinear interpolation of the leaf cells on the full (n + 1) x (n + 1) lattice.
+
+    Returns:
+        Dictionary output name -> (n + 1, n + 1) array indexed [i, j]
+    """
+    grids = {name: np.zeros((n + 1, n + 1)) for name in OUTPUTS}
+    for cell in cells:
+        i, j, h = cell
+        u = np.linspace(0, 1, h + 1)[:, None]
+        v = np.linspace(0, 1, h + 1)[None, :]
+        for name in OUTPUTS:
+            f00, f10, f01, f11 = (values[point][name] for point in corners(cell))
+            grids[name][i:i + h + 1, j:j + h + 1] = (f00 * (1 - u) * (1 - v) + f10 * u * (1 - v)
+                                                    + f01 * (1 - u) * v + f11 * u * v)
+    return grids
+
+
+def main():
+    """Main function to run the adaptive (p1, p2) sweep.
+
+    This function should:
+    1. Evaluate a coarse grid of (p1, p2) points
+    2. Split in four the cells where unmet_mailly + unmet_moulin or
+       final_imbalance changes fastest: bilinear interpolation misses their
+       center (surplus) or they cross a front (spread)
+    3. Evaluate the new points of each round on the pool, until no cell
+       needs refining or max_level is reached
+    4. Save every evaluated point, optionally compare with the dense grid
+
+    Output files:
+    - adaptive_points.csv: p1, p2, round, mean unmet_total and final_imbalance of every point
+    - Optional dense_check.csv: the dense grid, with the interpolated adaptive values
+    - Optional plots: adaptive.png, the points over the interpolated unmet demand
+
+    Note:
+        - Points live on the lattice of the finest level, (coarse - 1) * 2^max_level
+          intervals per axis: a point shared by several cells is run once
+        - Every point averages the same replicate seeds (common random numbers),
+          otherwise the noise alone would trigger refinements everywhere
+    """
+    args = parse_args()
+    output_dir = Path(args.out_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if args.workers == 'auto':
+        n_workers = mp.cpu_count()
+    else:
+        n_workers = int(args.workers)
+
+    finest = 2 ** args.max_level
+    n = (args.coarse - 1) * finest
+    def coords(point):
+        i, j = point
+        return (args.p1_min + (args.p1_max - args.p1_min) * i / n,
+                args.p2_min + (args.p2_max - args.p2_min) * j / n)
+
+    cells = [(a * finest, b * finest, finest) for a in range(args.coarse - 1) for b in range(args.coarse - 1)]
+    points = sorted({point for cell in cells for point in cell_points(cell)})
+    rounds = {point: 0 for point in points}
+    pool = ThreadPool(n_workers) if args.backend == 'threads' else mp.Pool(n_workers)
+    with pool:
+        values = evaluate(pool, points, coords, args)
+        print(f"round 0: {len(points)} points")
+        for level in range(1, args.max_level + 1):
+            scale = output_ranges(values)
+            split = [cell for cell in cells if cell[2] > 1 and (surplus(cell, values, scale) > args.tol
+                                                                or spread(cell, values, scale) > args.front)]
+            if not split:
+                break
+            children = []
+            for i, j, h in split:
+                half = h // 2
+                children += [(i, j, half), (i + half, j, half), (i, j + half, half), (i + half, j + half, half)]
+            new_points = sorted({point for cell in children for point in cell_points(cell)} - values.keys())
+            values.update(evaluate(pool, new_points, coords, args))
+            rounds.update({point: level for point in new_points})
+            split = set(split)
+            cells = [cell for cell in cells if cell not in split] + children
+            print(f"round {level}: {len(split)} cells refined, {len(new_points)} new points")
+
+        n_runs = len(values) * args.replicates
+        dense_runs = (n + 1) ** 2 * args.replicates
+        rows = [{'p1': coords(point)[0], 'p2': coords(point)[1], 'round': rounds[point], **values[point]}
+                for point in sorted(values)]
+        pd.DataFrame(rows).to_csv(output_dir / "adaptive_points.csv", index=False)
+        print(f"test-adaptive--Done! {n_runs} simulations run ({n_runs / dense_runs:.0%} of the {dense_runs} of the dense grid).")
+
+        grids = interpolate(cells, values, n)
+        if args.check_dense:
+            dense_points = [(i, j) for i in range(n + 1) for j in range(n + 1)]
+            # points already run by the adaptive sweep are exact, reuse them
+            dense = dict(values)
+            dense.update(evaluate(pool, [point for point in dense_points if point not in values], coords, args))
+            check = []
+            for point in dense_points:
+                row = {'p1': coords(point)[0], 'p2': coords(point)[1]}
+                for name in OUTPUTS:
+                    row[name] = dense[point][name]
+                    row[f'{name}_adaptive'] = grids[name][point]
+                check.append(row)
+            df_check = pd.DataFrame(check)
+            df_check.to_csv(output_dir / "dense_check.csv", index=False)
+            scale = output_ranges(dense)
+            for name in OUTPUTS:
+                error = (df_check[f'{name}_adaptive'] - df_check[name]).abs() / scale[name]
+                print(f"{name}: mean error {error.mean():.2%}, max error {error.max():.2%} of the range")
+
+    if args.plot:
+        # matplotlib only loads with --plot
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=(8, 7))
+        extent = (args.p2_min, args.p2_max, args.p1_min, args.p1_max)
+        image = ax.imshow(grids['unmet_total'], origin='lower', extent=extent, aspect='auto', cmap='viridis')
+        fig.colorbar(image, ax=ax, label='Unmet demand (mailly + moulin)')
+        p1s, p2s = zip(*(coords(point) for point in values))
+        ax.scatter(p2s, p1s, s=4, color='white')
+        ax.set_xlabel('p2')
+        ax.set_ylabel('p1')
+        ax.set_title('Adaptive sweep: evaluated points')
+        plt.tight_layout()
+        plt.savefig(output_dir / "adaptive.png", dpi=100)
+        plt.close()
+        print(f"Plot saved to: {output_dir / 'adaptive.png'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,25 @@
 import argparse
+import csv
+import heapq
+import time
 from pathlib import Path
 from mpi4py import MPI
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+import model
 from model import State, run_simulation
+from result_cache import ResultCache, model_fingerprint, run_cached
+from sweep_spec import load_spec
+from streams import with_stream
+from trajectories import FIELDS, as_array, as_results
+from profiling import Profiler
+from telemetry import Progress
 
 
-def plot_results(results_list, output_dir, smooth_window=1):
-    """Simple plotting function for results"""
-    if not results_list:
-        return
-    
-    # Plot the first result as example
-    res = results_list[0]
-    
-    # Smoothing function
-    def smooth(data, window):
-        if window <= 1:
-            return data
-        return np.convolve(data, np.ones(window)/window, mode='valid')
-    
-    fig, axes = plt.subplots(2, 1, figsize=(14, 10))
-    
-    # Plot 1: Bikes at stations
-    axes[0].plot(smooth(res['mailly'], smooth_window), label='Mailly', color='blue')
-    axes[0].plot(smooth(res['moulin'], smooth_window), label='Moulin', color='green')
-    axes[0].set_title('Bikes at Stations')
-    axes[0].set_xlabel('Time')
-    axes[0].set_ylabel('Number of Bikes')
-    axes[0].legend()
-    axes[0].grid(True, alpha=0.3)
-    
-    # Plot 2: Unmet demand
-    axes[1].plot(smooth(res['unmet_mailly'], smooth_window), label='Unmet Mailly', color='red')
-    axes[1].plot(smooth(res['unmet_moulin'], smooth_window), label='Unmet Moulin', color='orange')
-    axes[1].set_title('Unmet Demand')
-    axes[1].set_xlabel('Time')
-    axes[1].set_ylabel('Unmet Demand')
-    axes[1].legend()
-    axes[1].grid(True, alpha=0.3)
-    
-    plt.tight_layout()
-    plt.savefig(output_dir / "plot.png", dpi=100)
-    plt.close()
-    print(f"Plot saved to: {output_dir / 'plot.png'}")
-
+# every trajectory goes with this tag: tags only go up to MPI_TAG_UB (32767 at
+# least), and MPI keeps the order of the messages from one rank on one tag
+TRAJECTORY_TAG = 1
 
 def parse_args():
     """Parse command line arguments for parallel parameter sweep.
@@ -54,21 +27,77 @@ def parse_args():
     Returns:
         Parsed arguments containing:
         - params: Path to CSV file with parameter combinations
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params
         - out_dir: Output directory for results
         - workers: Number of worker processes ('auto' for automatic detection)
         - plot: Boolean flag to generate plots after run
+        - plot_method: Downsampling of the plotted series, 'minmax' or 'lttb' (plotting.py)
+        - cache_dir: Result cache directory (default: no cache)
+        - cache_max_mb: Size limit of the result cache in MB
+        - cache_trajectories: Boolean flag to also cache compressed trajectories
+        - root_seed: Root of the streams.py random streams, instead of the seed of each row
+        - stop_tol: Stop each run once stationary within this tolerance (stationarity.py), steps becomes a cap
+        - check_every: Steps between the first stationarity checks
+        - flush_every: Number of metrics rows a rank keeps in memory before appending them to its part of metrics.csv
+        - profile: Boolean flag to write timing.json (wall and CPU time per phase and per run)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile (every rank, profile_rank<r>.* for rank r > 0)
+        - progress: Boolean flag to show a live progress line on stderr
+        - telemetry: JSONL file the progress records are appended to (telemetry.py)
+        - telemetry_every: Seconds between two progress records
 
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
     """
     my_args = argparse.ArgumentParser(description="parallel parameter sweep usings threads")
-    my_args.add_argument('--params',type=str,required=True, help='Path to CSV file')
+    source = my_args.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str, help='Path to CSV file')
+    source.add_argument('--spec',type=str, help='Path to a JSON sweep spec, expanded lazily (see sweep_spec.py)')
     my_args.add_argument('--out-dir',type=str,default='results', help=' Output directory for results')
     my_args.add_argument('--workers',type=str,default='4', help=' Number of worker processes (auto: for automatic detection)')
     my_args.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
+    my_args.add_argument('--plot-method',choices=['minmax','lttb'],default='minmax',help='Downsampling of the plotted series: minmax keeps every spike, lttb the shape of the curve (default: minmax)')
+    my_args.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_args.add_argument('--cache-max-mb',type=float,default=1024,help='Size limit of the result cache in MB (default: 1024)')
+    my_args.add_argument('--cache-trajectories',action='store_true',help='Also cache compressed trajectories')
+    my_args.add_argument('--root-seed',type=int,default=None,help='Draw every row from its own stream under this root seed (streams.py), whatever the worker count')
+    my_args.add_argument('--stop-tol',type=float,default=None,help='Stop each run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    my_args.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    my_args.add_argument('--flush-every',type=int,default=10000,help='Metrics rows a rank keeps in memory before appending them to its part of metrics.csv (default: 10000)')
+    my_args.add_argument('--profile',action='store_true',help='Write timing.json next to metrics.csv: wall and CPU time per phase and per run')
+    my_args.add_argument('--profile-capture',choices=['cprofile','tracemalloc'],default=None,help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report of every rank')
+    my_args.add_argument('--progress',action='store_true',help='Show a live progress line on stderr: runs done/failed/pending, steps/s, ETA, per-worker utilization')
+    my_args.add_argument('--telemetry',type=str,default=None,help='Append a progress record to this JSONL file every --telemetry-every seconds (read it with telemetry.py status)')
+    my_args.add_argument('--telemetry-every',type=float,default=10.0,help='Seconds between two progress records (default: 10)')
     return my_args.parse_args()
 
 
+def append_metrics(rows, path, header):
+    """Append a chunk of metrics rows to a metrics file."""
+    pd.DataFrame(rows).to_csv(path, mode='w' if header else 'a', header=header, index=False)
+
+
+def merge_metrics(parts, path):
+    """Merge the ranks' metrics files, each sorted by run_id, into one metrics.csv sorted by run_id.
+
+    Note:
+        The files are streamed side by side (heapq.merge), never loaded,
+        and the cells are copied as they were written
+    """
+    files = [open(part, newline='') for part in parts]
+    try:
+        readers = [csv.reader(f) for f in files]
+        headers = [next(reader) for reader in readers]
+        with open(path, 'w', newline='') as out:
+            # the same line ends as pandas' to_csv
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(headers[0])
+            key = headers[0].index('run_id')
+            writer.writerows(heapq.merge(*readers, key=lambda row: int(row[key])))
+    finally:
+        for f in files:
+            f.close()
+
+
 def main():
     """Main function to run parallel parameter sweep using MPI.
 
@@ -90,11 +119,17 @@ def main():
     - seed: Random seed
 
     Output files:
-    - metrics.csv: Aggregated metrics for all runs
+    - metrics.csv: Aggregated metrics for all runs (merged from every rank's metrics_rank<r>.csv, which are removed)
     - Optional plots: PNG files for timeseries and metrics visualization
+    - Optional timing.json: wall and CPU time per phase and per run (--profile, every rank under ranks)
+    - Optional telemetry JSONL: a progress record every --telemetry-every seconds and a last one at the end (--telemetry)
 
     Note:
         - Use the mpi4py module for parallel processing
+        - Every rank appends its rows to its own metrics_rank<r>.csv in
+          chunks of --flush-every rows; rank 0 only gathers counts (and
+          with --plot the run ids) and merges the files at the end, so the
+          out dir must be seen by every rank (one host, or a shared filesystem)
     """
     #init 
     comm= MPI.COMM_WORLD
@@ -102,23 +137,65 @@ def main():
     size = comm.Get_size()
     chunks = None
     args = parse_args()
+    profiler = Profiler(args.profile, args.profile_capture)
     
-    if rank==0:
-        df_params = pd.read_csv(args.params)
-        output_dir = Path(args.out_dir)
-        output_dir.mkdir(parents=True, exist_ok=True)
-        df_params['run_id'] = df_params.index
-        
-        all_tasks = df_params.to_dict('records')
-        #div tasks in n=size
-        chunks = np.array_split(all_tasks,size)
+    output_dir = Path(args.out_dir)
+    # every rank writes its part of metrics.csv there
+    output_dir.mkdir(parents=True, exist_ok=True)
     
-    #distribution/scatter
-    my_tasks = comm.scatter(chunks,root=0)
-    my_results = []
+    n_tasks = n_steps = None
+    if args.spec:
+        # every rank expands its own share of the spec (tasks rank, rank + size, ...):
+        # nothing is materialized nor scattered
+        spec = load_spec(args.spec)
+        n_tasks = len(spec)
+        my_tasks = (with_stream({**task, 'run_id': i}, args.root_seed) for i, task in spec.iter_tasks(rank, None, size))
+    else:
+        if rank==0:
+            with profiler.phase('read_params'):
+                df_params = pd.read_csv(args.params)
+                n_tasks, n_steps = len(df_params), int(df_params['steps'].sum())
+                df_params['run_id'] = df_params.index
+                
+                all_tasks = [with_stream(task, args.root_seed) for task in df_params.to_dict('records')]
+                #div tasks in n=size
+                chunks = np.array_split(all_tasks,size)
+        
+        #distribution/scatter
+        with profiler.phase('scatter'):
+            my_tasks = comm.scatter(chunks,root=0)
+    # rank 0 shows the progress of every rank: the others send it a report per
+    # run, on their own communicator so they never mix with the trajectories
+    reporting = args.progress or args.telemetry is not None
+    progress_comm = comm.Dup() if reporting else None
+    progress = Progress(n_tasks if rank == 0 else None, n_steps, rank == 0 and args.progress,
+                        args.telemetry if rank == 0 else None, args.telemetry_every, 'run_mpi')
+    sent = []
+
+    def receive_reports(until=None):
+        # what has arrived, or everything up to `until` runs (blocking)
+        while progress_comm.Iprobe(source=MPI.ANY_SOURCE) or (until is not None and progress.done + progress.failed < until):
+            progress.update(*progress_comm.recv(source=MPI.ANY_SOURCE))
+
+    part_csv = output_dir / f"metrics_rank{rank}.csv"
+    append_job = profiler.wrap('write_metrics', append_metrics)
+    rows = []
+    my_runs = 0
+    # with --stop-tol: steps actually simulated, out of the steps asked for
+    steps_used = steps_cap = 0
+    # with --plot: (run_id, steps) of this rank's runs, in order, and their trajectories
+    my_index = []
+    my_trajectories = {}
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, model_fingerprint(model), int(args.cache_max_mb * 1024 * 1024))
     
     for row in my_tasks:
-        res = run_simulation(int(row['init_mailly']),int(row['init_moulin']), int(row['steps']), row['p1'], row['p2'], int(row['seed']))
+        start = time.perf_counter()
+        with profiler.task(row.get('run_id', 0)):
+            final, res = run_cached(cache, run_simulation, row['init_mailly'], row['init_moulin'], row['steps'], row['p1'], row['p2'], row.get('stream', row['seed']),
+                                    need_trajectory=args.plot, store_trajectory=args.cache_trajectories,
+                                    stop_tol=args.stop_tol, check_every=args.check_every)
         summary = {
                 'run_id': row.get('run_id', 0),
                 #init
@@ -129,35 +206,107 @@ def main():
                 'p2':row['p2'],
                 'seed': row['seed'],
                 #final result
-                'final_mailly':res["mailly"][-1],
-                'final_moulin':res["moulin"][-1],
-                'unmet_mailly':res["unmet_mailly"][-1],
-                'unmet_moulin':res["unmet_moulin"][-1],
-                'ambulance':res["final_imbalance"][-1] 
+                'final_mailly':final["mailly"],
+                'final_moulin':final["moulin"],
+                'unmet_mailly':final["unmet_mailly"],
+                'unmet_moulin':final["unmet_moulin"],
+                'ambulance':final["final_imbalance"] 
                 }
-        my_results.append(summary)
+        if 'point' in row:
+            # --spec tasks: parameter point and replicate number
+            summary['point'] = row['point']
+            summary['replicate'] = row['replicate']
+        if 'steps_used' in final:
+            summary['steps_used'] = final['steps_used']
+            steps_used += final['steps_used']
+            steps_cap += int(row['steps'])
+        rows.append(summary)
+        my_runs += 1
+        if len(rows) >= args.flush_every:
+            # the rank's tasks come in increasing run_id: its file stays sorted
+            append_job(rows, part_csv, my_runs == len(rows))
+            rows = []
+        if args.plot:
+            my_index.append((summary['run_id'], int(final.get('steps_used', row['steps']))))
+            my_trajectories[summary['run_id']] = as_array(res)
+        if reporting:
+            report = (f"rank {rank}", summary['run_id'], time.perf_counter() - start, int(final.get('steps_used', row['steps'])), int(row['steps']))
+            if rank == 0:
+                progress.update(*report)
+                receive_reports()
+            else:
+                sent.append(progress_comm.isend(report, dest=0))
+    if reporting:
+        if rank == 0:
+            receive_reports(until=n_tasks)
+            progress.close()
+        else:
+            MPI.Request.waitall(sent)
         
-    #geting the results/gather
-    all_res= comm.gather(my_results,root=0)
+    if rows:
+        append_job(rows, part_csv, my_runs == len(rows))
+    rows = []
+
+    #geting the counts/gather: the rows stay in the ranks' files
+    with profiler.phase('gather'):
+        all_counts = comm.gather((my_runs, cache.hits if cache is not None else 0, steps_used, steps_cap), root=0)
+        all_index = comm.gather(my_index, root=0)
+    
+    # trajectories travel as raw int64 buffers (Send/Recv), not pickled lists;
+    # each rank sends them in the order of its runs, rank 0 receives them in that order
+    with profiler.phase('send_trajectories'):
+        if args.plot and rank != 0:
+            for trajectory in my_trajectories.values():
+                comm.Send([trajectory, MPI.INT64_T], dest=0, tag=TRAJECTORY_TAG)
+            my_trajectories = {}
+        if args.plot and rank == 0:
+            # downsampled as they come: only the summaries are kept
+            from plotting import summarize_run, plot_runs
+            summaries = {}
+            for source, index in enumerate(all_index):
+                for run_id, steps in index:
+                    if source == 0:
+                        trajectory = my_trajectories.pop(run_id)
+                    else:
+                        trajectory = np.empty((len(FIELDS), steps), dtype=np.int64)
+                        comm.Recv([trajectory, MPI.INT64_T], source=source, tag=TRAJECTORY_TAG)
+                    summaries[run_id] = summarize_run(as_results(trajectory), method=args.plot_method)
     
+    n_runs = 0
     if rank==0:
-        final_data = []
-        for worker_list in all_res:
-            final_data.extend(worker_list)
-        df_results = pd.DataFrame(final_data)
-        df_results = df_results.sort_values('run_id')
-        csv_path = output_dir / "metrics.csv"
-        df_results.to_csv(csv_path, index=False)
-        print(f"test-paralle_mpi4py--Done! {len(df_results)} simulations run.")
+        n_runs, hits, total_used, total_cap = (sum(column) for column in zip(*all_counts))
+        with profiler.phase('write_metrics'):
+            csv_path = output_dir / "metrics.csv"
+            parts = [output_dir / f"metrics_rank{source}.csv" for source, counts in enumerate(all_counts) if counts[0]]
+            if parts:
+                merge_metrics(parts, csv_path)
+            else:
+                append_metrics([], csv_path, True)
+            for part in parts:
+                part.unlink()
+        if cache is not None:
+            with profiler.phase('cache_evict'):
+                cache.evict()
+            print(f"cache: {hits} hits, {n_runs - hits} misses")
+        if args.stop_tol is not None:
+            print(f"stationarity: {total_used} of {total_cap} steps simulated")
+        print(f"test-paralle_mpi4py--Done! {n_runs} simulations run.")
         
         if args.plot:
-            # Collect raw results for plotting
-            raw_results = []
-            for task in all_tasks:
-                res = run_simulation(int(task['init_mailly']), int(task['init_moulin']), 
-                                   int(task['steps']), task['p1'], task['p2'], int(task['seed']))
-                raw_results.append(res)
-            plot_results(raw_results, output_dir)
+            # trajectories came back from the ranks, no need to simulate again
+            with profiler.phase('plot'):
+                run_ids = sorted(summaries)
+                # drawn here: forking pool workers from an MPI process is not safe
+                plot_runs([summaries[run_id] for run_id in run_ids], output_dir, [f"run {run_id}" for run_id in run_ids], workers=1)
+            print(f"Plots saved to: {output_dir}")
+    if args.profile:
+        # every rank's phases, tasks and capture end up in rank 0's timing.json
+        rank_summary = profiler.summary()
+        if rank != 0:
+            rank_summary.update(profiler.save_capture(output_dir / f"profile_rank{rank}"))
+        rank_summaries = comm.gather(rank_summary, root=0)
+        if rank == 0:
+            profiler.write(output_dir / "timing.json", runner='run_mpi', runs=n_runs, ranks=rank_summaries)
     
         
     
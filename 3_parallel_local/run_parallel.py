@@ -1,51 +1,18 @@
 import argparse
+import os
+from itertools import islice
 from pathlib import Path
 import multiprocessing as mp
 import pandas as pd
-import matplotlib.pyplot as plt
 
+import model
 from model import State, run_simulation
-import numpy as np
-
-
-def plot_results(results_list, output_dir, smooth_window=1):
-    """Simple plotting function for results"""
-    if not results_list:
-        return
-    
-    # Plot the first result as example
-    res = results_list[0]
-    
-    # Smoothing function
-    def smooth(data, window):
-        if window <= 1:
-            return data
-        return np.convolve(data, np.ones(window)/window, mode='valid')
-    
-    fig, axes = plt.subplots(2, 1, figsize=(14, 10))
-    
-    # Plot 1: Bikes at stations
-    axes[0].plot(smooth(res['mailly'], smooth_window), label='Mailly', color='blue')
-    axes[0].plot(smooth(res['moulin'], smooth_window), label='Moulin', color='green')
-    axes[0].set_title('Bikes at Stations')
-    axes[0].set_xlabel('Time')
-    axes[0].set_ylabel('Number of Bikes')
-    axes[0].legend()
-    axes[0].grid(True, alpha=0.3)
-    
-    # Plot 2: Unmet demand
-    axes[1].plot(smooth(res['unmet_mailly'], smooth_window), label='Unmet Mailly', color='red')
-    axes[1].plot(smooth(res['unmet_moulin'], smooth_window), label='Unmet Moulin', color='orange')
-    axes[1].set_title('Unmet Demand')
-    axes[1].set_xlabel('Time')
-    axes[1].set_ylabel('Unmet Demand')
-    axes[1].legend()
-    axes[1].grid(True, alpha=0.3)
-    
-    plt.tight_layout()
-    plt.savefig(output_dir / "plot.png", dpi=100)
-    plt.close()
-    print(f"Plot saved to: {output_dir / 'plot.png'}")
+from result_cache import ResultCache, model_fingerprint, run_cached
+from sweep_spec import load_spec
+from streams import with_stream
+from trajectories import to_shared, share_tracker, attach_shared, release_shared, discard_shared
+from profiling import Profiler, task_clock, task_times
+from telemetry import Progress
 
 
 def parse_args():
@@ -54,24 +21,72 @@ def parse_args():
     Returns:
         Parsed arguments containing:
         - params: Path to CSV file with parameter combinations
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params
         - out_dir: Output directory for results
         - workers: Number of worker processes ('auto' for automatic detection)
         - plot: Boolean flag to generate plots after run
+        - plot_method: Downsampling of the plotted series, 'minmax' or 'lttb' (plotting.py)
+        - cache_dir: Result cache directory (default: no cache)
+        - cache_max_mb: Size limit of the result cache in MB
+        - cache_trajectories: Boolean flag to also cache compressed trajectories
+        - root_seed: Root of the streams.py random streams, instead of the seed of each row
+        - chunksize: Number of tasks sent to a worker at once
+        - flush_every: Number of metrics rows kept in memory before they are appended to metrics.csv
+        - stop_tol: Stop each run once stationary within this tolerance (stationarity.py), steps becomes a cap
+        - check_every: Steps between the first stationarity checks
+        - profile: Boolean flag to write timing.json (wall and CPU time per phase and per run)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile (main process only)
+        - progress: Boolean flag to show a live progress line on stderr
+        - telemetry: JSONL file the progress records are appended to (telemetry.py)
+        - telemetry_every: Seconds between two progress records
 
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
     """
     my_args = argparse.ArgumentParser(description="parallel parameter sweep usings threads")
-    my_args.add_argument('--params',type=str,required=True, help='Path to CSV file')
+    source = my_args.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str, help='Path to CSV file')
+    source.add_argument('--spec',type=str, help='Path to a JSON sweep spec, expanded lazily (see sweep_spec.py)')
     my_args.add_argument('--out-dir',type=str,default='results', help=' Output directory for results')
     my_args.add_argument('--workers',type=str,default='4', help=' Number of worker processes (auto: for automatic detection)')
     my_args.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
+    my_args.add_argument('--plot-method',choices=['minmax','lttb'],default='minmax',help='Downsampling of the plotted series: minmax keeps every spike, lttb the shape of the curve (default: minmax)')
+    my_args.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_args.add_argument('--cache-max-mb',type=float,default=1024,help='Size limit of the result cache in MB (default: 1024)')
+    my_args.add_argument('--cache-trajectories',action='store_true',help='Also cache compressed trajectories')
+    my_args.add_argument('--root-seed',type=int,default=None,help='Draw every row from its own stream under this root seed (streams.py), whatever the worker count')
+    my_args.add_argument('--chunksize',type=int,default=16,help='Number of tasks sent to a worker at once (default: 16)')
+    my_args.add_argument('--flush-every',type=int,default=10000,help='Metrics rows kept in memory before being appended to metrics.csv (default: 10000)')
+    my_args.add_argument('--stop-tol',type=float,default=None,help='Stop each run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    my_args.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    my_args.add_argument('--profile',action='store_true',help='Write timing.json next to metrics.csv: wall and CPU time per phase and per run')
+    my_args.add_argument('--profile-capture',choices=['cprofile','tracemalloc'],default=None,help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report of the main process')
+    my_args.add_argument('--progress',action='store_true',help='Show a live progress line on stderr: runs done/failed/pending, steps/s, ETA, per-worker utilization')
+    my_args.add_argument('--telemetry',type=str,default=None,help='Append a progress record to this JSONL file every --telemetry-every seconds (read it with telemetry.py status)')
+    my_args.add_argument('--telemetry-every',type=float,default=10.0,help='Seconds between two progress records (default: 10)')
     return my_args.parse_args()
 
 def multi_work(row):
-    """this func execute the simulation in a parallel"""
-    res = run_simulation(int(row['init_mailly']),int(row['init_moulin']), int(row['steps']), row['p1'], row['p2'], int(row['seed']))
-    return{
+    """this func execute the simulation in a parallel
+
+    Note:
+        if row['return_trajectory'] is set, the trajectory is put in shared
+        memory and only its handle comes back, under the 'trajectory' key
+        if row['cache_dir'] is set, the result cache is looked up first
+        if row['stop_tol'] is set, the run stops once stationary and
+        'steps_used' is added to the summary
+        if row['profile'] or row['progress'] is set, the wall and CPU time of
+        the task come back as 'task_wall' and 'task_cpu', with row['progress']
+        the pid of the worker as 'worker'
+    """
+    start = task_clock() if row.get('profile') or row.get('progress') else None
+    cache = None
+    if row.get('cache_dir'):
+        cache = ResultCache(row['cache_dir'], row['model_fingerprint'])
+    final, res = run_cached(cache, run_simulation, row['init_mailly'], row['init_moulin'], row['steps'], row['p1'], row['p2'], row.get('stream', row['seed']),
+                            need_trajectory=bool(row.get('return_trajectory')), store_trajectory=bool(row.get('cache_trajectories')),
+                            stop_tol=row.get('stop_tol'), check_every=row.get('check_every', 1000))
+    summary = {
             'run_id': row.get('run_id', 0),
             #init
             'init_mailly':row['init_mailly'],
@@ -81,14 +96,32 @@ def multi_work(row):
             'p2':row['p2'],
             'seed': row['seed'],
             #final result
-            'final_mailly':res["mailly"][-1],
-            'final_moulin':res["moulin"][-1],
-            'unmet_mailly':res["unmet_mailly"][-1],
-            'unmet_moulin':res["unmet_moulin"][-1],
-            'ambulance':res["final_imbalance"][-1] 
+            'final_mailly':final["mailly"],
+            'final_moulin':final["moulin"],
+            'unmet_mailly':final["unmet_mailly"],
+            'unmet_moulin':final["unmet_moulin"],
+            'ambulance':final["final_imbalance"] 
             }
-        
-        
+    if 'point' in row:
+        # --spec tasks: parameter point and replicate number
+        summary['point'] = row['point']
+        summary['replicate'] = row['replicate']
+    if 'steps_used' in final:
+        summary['steps_used'] = final['steps_used']
+    if row.get('return_trajectory'):
+        summary['trajectory'] = to_shared(res)
+    if cache is not None:
+        summary['cache_hit'] = cache.hits
+    if start is not None:
+        summary['task_wall'], summary['task_cpu'] = task_times(start)
+    if row.get('progress'):
+        summary['worker'] = os.getpid()
+    return summary
+
+
+def append_metrics(rows, path, header):
+    """Append a chunk of metrics rows to metrics.csv."""
+    pd.DataFrame(rows).to_csv(path, mode='w' if header else 'a', header=header, index=False)
 
 
 def main():
@@ -114,39 +147,127 @@ def main():
     Output files:
     - metrics.csv: Aggregated metrics for all runs
     - Optional plots: PNG files for timeseries and metrics visualization
+    - Optional timing.json: wall and CPU time per phase and per run (--profile)
+    - Optional telemetry JSONL: a progress record every --telemetry-every seconds and a last one at the end (--telemetry)
 
     Note:
         - Use multiprocessing for parallel processing
+        - metrics.csv is written in chunks of --flush-every rows as the
+          results come back (in run_id order, pool.imap keeps the task
+          order): only the plot handles are kept for the whole sweep
     """
     args = parse_args()
-    df_params = pd.read_csv(args.params)
+    profiler = Profiler(args.profile, args.profile_capture)
     output_dir = Path(args.out_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    df_params['run_id'] = df_params.index
+    # options every worker needs, added to each task
+    options = {'return_trajectory': args.plot}
+    if args.cache_dir:
+        options['cache_dir'] = args.cache_dir
+        options['model_fingerprint'] = model_fingerprint(model)
+        options['cache_trajectories'] = args.cache_trajectories
+    if args.stop_tol is not None:
+        options['stop_tol'] = args.stop_tol
+        options['check_every'] = args.check_every
+    if args.profile:
+        options['profile'] = True
+    if args.progress or args.telemetry:
+        options['progress'] = True
     
-    tasks = df_params.to_dict('records')
+    with profiler.phase('read_params'):
+        if args.spec:
+            # tasks are generated while the pool consumes them, never all at once
+            spec = load_spec(args.spec)
+            n_tasks, n_steps = len(spec), None
+            tasks = (with_stream({**task, 'run_id': i, **options}, args.root_seed) for i, task in spec.iter_tasks())
+        else:
+            df_params = pd.read_csv(args.params)
+            n_tasks, n_steps = len(df_params), int(df_params['steps'].sum())
+            df_params['run_id'] = df_params.index
+            tasks = [with_stream({**task, **options}, args.root_seed) for task in df_params.to_dict('records')]
     if args.workers == 'auto':
         n_workers = mp.cpu_count()
     else:
         n_workers = int(args.workers)
         
-    with mp.Pool(processes=n_workers) as pool:
-        res = pool.map(multi_work,tasks)
-    
-    df_results = pd.DataFrame(res)
-    df_results = df_results.sort_values('run_id')
-    csv_path = output_dir / "metrics.csv"
-    df_results.to_csv(csv_path, index=False)
-    print(f"test-paralle--Done! {len(df_results)} simulations run.")
-    
+    progress = Progress(n_tasks, n_steps, args.progress, args.telemetry, args.telemetry_every, 'run_parallel')
+    output_csv = output_dir / "metrics.csv"
+    append_job = profiler.wrap('write_metrics', append_metrics)
+    rows = []
+    n_runs = hits = 0
+    # with --stop-tol: steps actually simulated, out of the steps asked for
+    steps_used = steps_cap = 0
+    # (run_id, handle) of every run, for the plot
+    handles = []
+    # shared memory blocks received and not freed yet
+    outstanding = set()
     if args.plot:
-        # Collect raw results for plotting
-        raw_results = []
-        for task in tasks:
-            res = run_simulation(int(task['init_mailly']), int(task['init_moulin']), 
-                               int(task['steps']), task['p1'], task['p2'], int(task['seed']))
-            raw_results.append(res)
-        plot_results(raw_results, output_dir)
+        # the workers' blocks are registered with this process' tracker: they go away with it
+        share_tracker()
+    try:
+        # pool start-up, pickling, the simulations and the results coming back;
+        # the simulations alone are the per-task times
+        with profiler.phase('pool'), mp.Pool(processes=n_workers) as pool:
+            # the pool would drain a generator up front: hand it bounded windows
+            # instead; imap keeps the task order, chunks amortize the pickling
+            tasks = iter(tasks)
+            while True:
+                window = list(islice(tasks, 4 * n_workers * args.chunksize))
+                if not window:
+                    break
+                for summary in pool.imap(multi_work, window, chunksize=args.chunksize):
+                    # timed in the worker: the pid's busy time gives its utilization
+                    progress.update(summary.pop('worker', None), summary['run_id'], summary.get('task_wall', 0.0),
+                                    int(summary.get('steps_used', summary['steps'])), int(summary['steps']))
+                    if 'task_wall' in summary:
+                        profiler.add_task(summary['run_id'], summary.pop('task_wall'), summary.pop('task_cpu'))
+                    if 'trajectory' in summary:
+                        handle = summary.pop('trajectory')
+                        outstanding.add(handle)
+                        handles.append((summary['run_id'], handle))
+                    hits += summary.pop('cache_hit', 0)
+                    if args.stop_tol is not None:
+                        steps_used += summary['steps_used']
+                        steps_cap += int(summary['steps'])
+                    rows.append(summary)
+                    n_runs += 1
+                    if len(rows) >= args.flush_every:
+                        append_job(rows, output_csv, n_runs == len(rows))
+                        rows = []
+        progress.close()
+        if rows or n_runs == 0:
+            append_job(rows, output_csv, n_runs == len(rows))
+        if args.cache_dir:
+            with profiler.phase('cache_evict'):
+                ResultCache(args.cache_dir, model_fingerprint(model), int(args.cache_max_mb * 1024 * 1024)).evict()
+            print(f"cache: {hits} hits, {n_runs - hits} misses")
+        if args.stop_tol is not None:
+            print(f"stationarity: {steps_used} of {steps_cap} steps simulated")
+        print(f"test-paralle--Done! {n_runs} simulations run.")
+    
+        if args.plot:
+            # the workers left the trajectories in shared memory (pool.imap keeps
+            # the task order): downsample each one straight from there and free
+            # its block before the next, the figures only need the summaries
+            from plotting import summarize_run, plot_runs
+            summaries = []
+            with profiler.phase('plot'):
+                for run_id, handle in handles:
+                    shm, results = attach_shared(handle)
+                    try:
+                        summaries.append(summarize_run(results, method=args.plot_method))
+                    finally:
+                        # drop the views before closing the block
+                        del results
+                        release_shared(shm)
+                        outstanding.discard(handle)
+                plot_runs(summaries, output_dir, [f"run {run_id}" for run_id, handle in handles])
+            print(f"Plots saved to: {output_dir}")
+    finally:
+        # an error or Ctrl-C before the plot: free the blocks now, not when the tracker exits
+        for handle in outstanding:
+            discard_shared(handle)
+    profiler.write(output_dir / "timing.json", runner='run_parallel', runs=n_runs, workers=n_workers, chunksize=args.chunksize)
         
 
 
@@ -0,0 +1,392 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+from pathlib import Path
+import signal
+import socket
+import sys
+import threading
+import time
+import pandas as pd
+
+import model
+from result_cache import model_fingerprint
+from run_parallel import multi_work
+from sweep_spec import load_spec
+from streams import with_stream
+
+
+# a queue directory: one file per task, its state is the subdirectory it is in
+# tasks/<run_id>.json (pending) -> leases/<run_id>@<worker>.json -> done/<run_id>.json (the metrics of the run)
+#                                                               -> failed/<run_id>.json (max_attempts reached)
+SUBDIRS = ('tasks', 'leases', 'done', 'failed', 'tmp')
+SETTINGS_NAME = 'queue.json'
+
+
+def parse_args():
+    """Parse command line arguments for the file-backed work queue.
+
+    Returns:
+        Parsed arguments containing:
+        - command: 'submit', 'worker', 'status' or 'collect'
+        - queue: Queue directory, on a filesystem shared by the workers
+        - params: Path to CSV file with parameter combinations (submit)
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params (submit)
+        - root_seed: Root of the streams.py random streams, instead of the seed of each row (submit)
+        - stop_tol: Stop each run once stationary within this tolerance (stationarity.py), steps becomes a cap (submit)
+        - check_every: Steps between the first stationarity checks (submit)
+        - cache_dir: Result cache directory (submit, default: no cache)
+        - cache_trajectories: Boolean flag to also cache compressed trajectories (submit)
+        - lease: Seconds without a heartbeat after which a claimed task goes back to the queue (submit)
+        - max_attempts: Claims of a task before it is moved to failed/ (submit)
+        - workers: Number of worker processes on this host ('auto' for automatic detection) (worker)
+        - poll: Seconds between two looks at the queue when there is nothing to claim (worker)
+        - max_tasks: Stop the worker after this many tasks (worker, default: when the queue is empty)
+        - out_dir: Output directory of metrics.csv (collect)
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="durable work queue in a directory: submit a sweep, then start workers on any host that sees the directory")
+    commands = my_parser.add_subparsers(dest='command', required=True)
+    submit_parser = commands.add_parser('submit', help='Write one task file per run of the sweep into a new queue directory')
+    submit_parser.add_argument('queue',help='Queue directory (created), on a filesystem shared by the workers')
+    source = submit_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str, help='Path to CSV file')
+    source.add_argument('--spec',type=str, help='Path to a JSON sweep spec (see sweep_spec.py)')
+    submit_parser.add_argument('--root-seed',type=int,default=None,help='Draw every row from its own stream under this root seed (streams.py): same metrics as the other runners')
+    submit_parser.add_argument('--stop-tol',type=float,default=None,help='Stop each run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    submit_parser.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    submit_parser.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    submit_parser.add_argument('--cache-trajectories',action='store_true',help='Also cache compressed trajectories')
+    submit_parser.add_argument('--lease',type=float,default=60.0,help='Seconds without a heartbeat after which a claimed task is requeued, i.e. its worker is taken for dead (default: 60)')
+    submit_parser.add_argument('--max-attempts',type=int,default=3,help='Claims of a task (crashed workers and errors) before it is moved to failed/ (default: 3)')
+    worker_parser = commands.add_parser('worker', help='Claim and run tasks until the queue is empty')
+    worker_parser.add_argument('queue',help='Queue directory')
+    worker_parser.add_argument('--workers',type=str,default='1',help='Number of worker processes on this host (auto: for automatic detection, default: 1)')
+    worker_parser.add_argument('--poll',type=float,default=1.0,help='Seconds between two looks at the queue while the tasks left are leased by other workers (default: 1)')
+    worker_parser.add_argument('--max-tasks',type=int,default=None,help='Stop after this many tasks per worker process (default: when the queue is empty)')
+    status_parser = commands.add_parser('status', help='Print the number of tasks pending, leased (and expired), done and failed')
+    status_parser.add_argument('queue',help='Queue directory')
+    collect_parser = commands.add_parser('collect', help='Write metrics.csv from the runs done so far')
+    collect_parser.add_argument('queue',help='Queue directory')
+    collect_parser.add_argument('--out-dir',type=str,default='results',help='Output directory for metrics.csv')
+    return my_parser.parse_args()
+
+
+def write_json(queue_dir, path, data):
+    """Write data to path through queue_dir/tmp and a rename: nobody ever reads half a file.
+
+    Note:
+        Writing the same run twice (a worker taken for dead that still
+        finishes) replaces the file with the same content: results are
+        idempotent
+    """
+    tmp_path = queue_dir / 'tmp' / f"{path.name}.{socket.gethostname()}.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        # numpy scalars of the model as plain numbers
+        json.dump(data, f, default=lambda value: value.item())
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def queue_time(queue_dir, worker):
+    """Current time by the clock of the filesystem that holds the queue.
+
+    Note:
+        Lease mtimes are set by the file server on a shared filesystem:
+        comparing them with this time rather than with the local clock
+        makes the expiry independent of the clock skew between hosts
+    """
+    probe = queue_dir / 'tmp' / f".clock.{worker}"
+    probe.touch()
+    return probe.stat().st_mtime
+
+
+def count_files(directory):
+    with os.scandir(directory) as it:
+        return sum(1 for entry in it if entry.name.endswith('.json'))
+
+
+def submit(queue_dir, tasks, settings):
+    """Create the queue directory, its settings and one pending task file per run.
+
+    Returns:
+        Number of tasks written
+    """
+    if (queue_dir / SETTINGS_NAME).exists():
+        raise SystemExit(f"error: {queue_dir} already holds a sweep")
+    for name in SUBDIRS:
+        (queue_dir / name).mkdir(parents=True, exist_ok=True)
+    n_tasks = 0
+    for i, task in tasks:
+        write_json(queue_dir, queue_dir / 'tasks' / f"{i}.json", {**task, 'run_id': i, 'attempts': 0})
+        n_tasks += 1
+    # written last: workers started early wait for it
+    write_json(queue_dir, queue_dir / SETTINGS_NAME, {**settings, 'total': n_tasks})
+    return n_tasks
+
+
+def requeue_expired(queue_dir, lease, worker):
+    """Put back in tasks/ the leases whose heartbeat is older than `lease` seconds.
+
+    Returns:
+        Number of tasks requeued
+
+    Note:
+        The rename is atomic: when several workers find the same expired
+        lease, one of them moves it and the others get FileNotFoundError
+    """
+    now = queue_time(queue_dir, worker)
+    requeued = 0
+    with os.scandir(queue_dir / 'leases') as it:
+        for entry in it:
+            try:
+                if now - entry.stat().st_mtime < lease:
+                    continue
+                os.rename(entry.path, queue_dir / 'tasks' / (entry.name.split('@')[0] + '.json'))
+            except FileNotFoundError:
+                continue
+            requeued += 1
+    return requeued
+
+
+def claim(queue_dir, worker):
+    """Move one pending task to leases/ under this worker's name.
+
+    Returns:
+        Tuple (task, lease path), or None when no task is pending
+
+    Note:
+        The first rename wins; the tasks are visited in directory order and
+        a worker that loses the race tries the next one. The rename keeps
+        the mtime of the task file: the lease is touched at once, or a task
+        that waited longer than the lease would look expired and another
+        worker would requeue it (a lease already gone is a lost race too)
+    """
+    with os.scandir(queue_dir / 'tasks') as it:
+        for entry in it:
+            if not entry.name.endswith('.json'):
+                continue
+            lease_path = queue_dir / 'leases' / f"{entry.name[:-len('.json')]}@{worker}.json"
+            try:
+                os.rename(entry.path, lease_path)
+                os.utime(lease_path)
+                return read_json(lease_path), lease_path
+            except FileNotFoundError:
+                continue
+    return None
+
+
+def move_lease(queue_dir, lease_path, task, dest):
+    """Rewrite a lease with task and move it to dest (leases/ or tasks/), unless it was taken back.
+
+    Returns:
+        False when the lease is gone (requeued by another worker's requeue_expired)
+
+    Note:
+        The lease first leaves leases/ with a rename: writing it in place
+        would recreate a lease that was requeued meanwhile, and the run
+        would then be claimed and run twice
+    """
+    held = queue_dir / 'tmp' / f"{lease_path.name}.{socket.gethostname()}.{os.getpid()}.held"
+    try:
+        os.rename(lease_path, held)
+    except FileNotFoundError:
+        return False
+    write_json(queue_dir, held, task)
+    os.rename(held, dest)
+    return True
+
+
+def heartbeat(lease_path, every, stop):
+    """Touch the lease every `every` seconds until stop is set (a missing lease was taken back: the run goes on)."""
+    while not stop.wait(every):
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_task(queue_dir, settings, task, lease_path, options):
+    """Run one claimed task and move it to done/, back to tasks/ or to failed/.
+
+    Returns:
+        'done', 'skipped' (already done by another worker, or lease taken back), 'retry' or 'failed'
+    """
+    run_id = task['run_id']
+    done_path = queue_dir / 'done' / f"{run_id}.json"
+    if done_path.exists():
+        # requeued after its worker finished anyway
+        lease_path.unlink(missing_ok=True)
+        return 'skipped'
+    task['attempts'] += 1
+    if task['attempts'] > settings['max_attempts']:
+        write_json(queue_dir, queue_dir / 'failed' / f"{run_id}.json", {**task, 'attempts': settings['max_attempts'],
+                                                                                'error': task.get('error', 'lease expired every time: the worker died')})
+        lease_path.unlink(missing_ok=True)
+        return 'failed'
+    # the count of claims is in the lease, a crash before the end still counts
+    if not move_lease(queue_dir, lease_path, task, lease_path):
+        return 'skipped'
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(lease_path, settings['lease'] / 3, stop), daemon=True)
+    beat.start()
+    try:
+        row = {key: value for key, value in task.items() if key not in ('attempts', 'error')}
+        summary = multi_work(with_stream({**row, **options}, settings['root_seed']))
+    except Exception as e:
+        stop.set()
+        beat.join()
+        print(f"error: run {run_id}: {e!r}")
+        # back to the queue with its error, for another attempt
+        move_lease(queue_dir, lease_path, {**task, 'error': repr(e)}, queue_dir / 'tasks' / f"{run_id}.json")
+        return 'retry'
+    except BaseException:
+        # killed (SIGTERM, Ctrl-C): give the task back at once rather than after the lease,
+        # without counting the attempt
+        stop.set()
+        beat.join()
+        move_lease(queue_dir, lease_path, {**task, 'attempts': task['attempts'] - 1}, queue_dir / 'tasks' / f"{run_id}.json")
+        raise
+    stop.set()
+    beat.join()
+    write_json(queue_dir, done_path, summary)
+    lease_path.unlink(missing_ok=True)
+    return 'done'
+
+
+def worker_loop(queue_dir, poll=1.0, max_tasks=None):
+    """Claim and run tasks until the queue is empty (nothing pending, nothing leased) or max_tasks ran.
+
+    Returns:
+        Dict outcome -> number of tasks
+    """
+    # SIGTERM (e.g. a killed job) goes through the release of the current lease
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    while not (queue_dir / SETTINGS_NAME).exists():
+        time.sleep(poll)
+    settings = read_json(queue_dir / SETTINGS_NAME)
+    options = {}
+    if settings['stop_tol'] is not None:
+        options['stop_tol'] = settings['stop_tol']
+        options['check_every'] = settings['check_every']
+    if settings['cache_dir']:
+        options['cache_dir'] = settings['cache_dir']
+        options['model_fingerprint'] = model_fingerprint(model)
+        options['cache_trajectories'] = settings['cache_trajectories']
+    counts = {'done': 0, 'skipped': 0, 'retry': 0, 'failed': 0, 'requeued': 0}
+    next_check = 0.0
+    while max_tasks is None or counts['done'] + counts['retry'] + counts['failed'] < max_tasks:
+        if time.monotonic() >= next_check:
+            counts['requeued'] += requeue_expired(queue_dir, settings['lease'], worker)
+            next_check = time.monotonic() + settings['lease'] / 2
+        claimed = claim(queue_dir, worker)
+        if claimed is None:
+            if count_files(queue_dir / 'leases') == 0 and count_files(queue_dir / 'tasks') == 0:
+                break
+            # the other workers hold the rest: wait for them to finish, or for their leases to expire
+            time.sleep(poll)
+            next_check = 0.0
+            continue
+        counts[run_task(queue_dir, settings, *claimed, options)] += 1
+    return counts
+
+
+def _worker_process(queue_dir, poll, max_tasks):
+    counts = worker_loop(queue_dir, poll, max_tasks)
+    print(f"worker {socket.gethostname()}-{os.getpid()}: {counts['done']} runs done, {counts['retry']} errors, "
+          f"{counts['failed']} failed, {counts['skipped']} already done, {counts['requeued']} expired leases requeued")
+
+
+def queue_status(queue_dir):
+    """Counts of the tasks by state, and how many leases are expired."""
+    settings = read_json(queue_dir / SETTINGS_NAME)
+    now = queue_time(queue_dir, f"status-{socket.gethostname()}-{os.getpid()}")
+    expired = 0
+    with os.scandir(queue_dir / 'leases') as it:
+        for entry in it:
+            try:
+                expired += now - entry.stat().st_mtime >= settings['lease']
+            except FileNotFoundError:
+                continue
+    return {
+        'total': settings['total'],
+        'pending': count_files(queue_dir / 'tasks'),
+        'leased': count_files(queue_dir / 'leases'),
+        'expired': expired,
+        'done': count_files(queue_dir / 'done'),
+        'failed': count_files(queue_dir / 'failed'),
+    }
+
+
+def main():
+    """Main function of the durable work queue.
+
+    This function should:
+    1. submit: expand the sweep (params CSV or spec) into one task file per run
+    2. worker: claim tasks (atomic rename into leases/), keep the lease
+       alive with a heartbeat, write the metrics to done/ and requeue the
+       leases of workers that stopped beating
+    3. status: print the tasks pending, leased, done and failed
+    4. collect: aggregate done/ into metrics.csv
+
+    Output files:
+    - {queue}/done/<run_id>.json: Metrics of every run, as run_parallel.py computes them
+    - {queue}/failed/<run_id>.json: Tasks claimed max_attempts times, with the last error
+    - {out_dir}/metrics.csv: Aggregated metrics of the runs done (collect)
+
+    Note:
+        - Workers can be added or killed at any time: a killed worker's
+          task comes back after the lease (at once on SIGTERM or Ctrl-C),
+          and a run done twice writes the same file
+        - Every host must see the queue directory (NFS or another shared
+          filesystem with atomic rename)
+    """
+    args = parse_args()
+    queue_dir = Path(args.queue)
+    if args.command == 'submit':
+        if args.spec:
+            tasks = load_spec(args.spec).iter_tasks()
+        else:
+            df_params = pd.read_csv(args.params)
+            tasks = enumerate(df_params.to_dict('records'))
+        settings = {'root_seed': args.root_seed, 'stop_tol': args.stop_tol, 'check_every': args.check_every,
+                    'cache_dir': args.cache_dir, 'cache_trajectories': args.cache_trajectories,
+                    'lease': args.lease, 'max_attempts': args.max_attempts}
+        n_tasks = submit(queue_dir, tasks, settings)
+        print(f"{n_tasks} tasks submitted to {queue_dir}")
+    elif args.command == 'worker':
+        n_workers = mp.cpu_count() if args.workers == 'auto' else int(args.workers)
+        if n_workers <= 1:
+            _worker_process(queue_dir, args.poll, args.max_tasks)
+            return
+        processes = [mp.Process(target=_worker_process, args=(queue_dir, args.poll, args.max_tasks)) for _ in range(n_workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.command == 'status':
+        status = queue_status(queue_dir)
+        print(f"{status['done']}/{status['total']} done, {status['failed']} failed, {status['pending']} pending, "
+              f"{status['leased']} leased ({status['expired']} expired)")
+    else:
+        output_dir = Path(args.out_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        done = [read_json(path) for path in (queue_dir / 'done').glob('*.json')]
+        df_results = pd.DataFrame(done)
+        if len(df_results):
+            df_results = df_results.sort_values('run_id')
+        df_results.to_csv(output_dir / "metrics.csv", index=False)
+        failed = count_files(queue_dir / 'failed')
+        print(f"test--queue--Done! {len(df_results)} simulations collected, {failed} failed.")
+
+
+if __name__ == "__main__":
+    main()
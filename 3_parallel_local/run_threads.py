@@ -1,53 +1,22 @@
 import argparse
 from pathlib import Path
 import threading
+import time
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from model import State, run_simulation
+import model
+from model import State, run_simulation, run_simulation_chunked
+from result_cache import ResultCache, model_fingerprint, run_cached
+from sweep_spec import load_spec
+from streams import with_stream
+from profiling import Profiler
+from telemetry import Progress
 
 import queue
-import numpy as np
 
 
-def plot_results(results_list, output_dir, smooth_window=1):
-    """Simple plotting function for results"""
-    if not results_list:
-        return
-    
-    # Plot the first result as example
-    res = results_list[0]
-    
-    # Smoothing function
-    def smooth(data, window):
-        if window <= 1:
-            return data
-        return np.convolve(data, np.ones(window)/window, mode='valid')
-    
-    fig, axes = plt.subplots(2, 1, figsize=(14, 10))
-    
-    # Plot 1: Bikes at stations
-    axes[0].plot(smooth(res['mailly'], smooth_window), label='Mailly', color='blue')
-    axes[0].plot(smooth(res['moulin'], smooth_window), label='Moulin', color='green')
-    axes[0].set_title('Bikes at Stations')
-    axes[0].set_xlabel('Time')
-    axes[0].set_ylabel('Number of Bikes')
-    axes[0].legend()
-    axes[0].grid(True, alpha=0.3)
-    
-    # Plot 2: Unmet demand
-    axes[1].plot(smooth(res['unmet_mailly'], smooth_window), label='Unmet Mailly', color='red')
-    axes[1].plot(smooth(res['unmet_moulin'], smooth_window), label='Unmet Moulin', color='orange')
-    axes[1].set_title('Unmet Demand')
-    axes[1].set_xlabel('Time')
-    axes[1].set_ylabel('Unmet Demand')
-    axes[1].legend()
-    axes[1].grid(True, alpha=0.3)
-    
-    plt.tight_layout()
-    plt.savefig(output_dir / "plot.png", dpi=100)
-    plt.close()
-    print(f"Plot saved to: {output_dir / 'plot.png'}")
+# --kernel: the NumPy one releases the GIL, so the threads run side by side
+KERNELS = {'numpy': run_simulation_chunked, 'python': run_simulation}
 
 
 def parse_args():
@@ -56,30 +25,148 @@ def parse_args():
     Returns:
         Parsed arguments containing:
         - params: Path to CSV file with parameter combinations
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params
         - out_dir: Output directory for results
         - workers: Number of worker processes ('auto' for automatic detection)
         - plot: Boolean flag to generate plots after run
+        - plot_method: Downsampling of the plotted series, 'minmax' or 'lttb' (plotting.py)
+        - cache_dir: Result cache directory (default: no cache)
+        - cache_max_mb: Size limit of the result cache in MB
+        - cache_trajectories: Boolean flag to also cache compressed trajectories
+        - root_seed: Root of the streams.py random streams, instead of the seed of each row
+        - stop_tol: Stop each run once stationary within this tolerance (stationarity.py), steps becomes a cap
+        - check_every: Steps between the first stationarity checks
+        - profile: Boolean flag to write timing.json (wall and CPU time per phase and per run)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile (main process only)
+        - kernel: 'numpy' (chunked, releases the GIL) or 'python' (model.run_simulation)
+        - flush_every: Number of metrics rows kept in memory before they are appended to metrics.csv
+        - progress: Boolean flag to show a live progress line on stderr
+        - telemetry: JSONL file the progress records are appended to (telemetry.py)
+        - telemetry_every: Seconds between two progress records
 
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
     """
     my_args = argparse.ArgumentParser(description="parallel parameter sweep usings threads")
-    my_args.add_argument('--params',type=str,required=True, help='Path to CSV file')
+    source = my_args.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str, help='Path to CSV file')
+    source.add_argument('--spec',type=str, help='Path to a JSON sweep spec, expanded lazily (see sweep_spec.py)')
     my_args.add_argument('--out-dir',type=str,default='results', help=' Output directory for results')
     my_args.add_argument('--workers',type=str,default='4', help=' Number of worker processes (auto: for automatic detection)')
     my_args.add_argument('--plot',action='store_true',help='Boolean flag to generate plot')
+    my_args.add_argument('--plot-method',choices=['minmax','lttb'],default='minmax',help='Downsampling of the plotted series: minmax keeps every spike, lttb the shape of the curve (default: minmax)')
+    my_args.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_args.add_argument('--cache-max-mb',type=float,default=1024,help='Size limit of the result cache in MB (default: 1024)')
+    my_args.add_argument('--cache-trajectories',action='store_true',help='Also cache compressed trajectories')
+    my_args.add_argument('--root-seed',type=int,default=None,help='Draw every row from its own stream under this root seed (streams.py), whatever the worker count')
+    my_args.add_argument('--stop-tol',type=float,default=None,help='Stop each run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    my_args.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    my_args.add_argument('--profile',action='store_true',help='Write timing.json next to metrics.csv: wall and CPU time per phase and per run')
+    my_args.add_argument('--profile-capture',choices=['cprofile','tracemalloc'],default=None,help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report of the main process')
+    my_args.add_argument('--kernel',choices=list(KERNELS),default='numpy',help='Model kernel: numpy releases the GIL so threads scale, python is the step by step loop (default: numpy, same results)')
+    my_args.add_argument('--flush-every',type=int,default=10000,help='Metrics rows kept in memory before being appended to metrics.csv (default: 10000)')
+    my_args.add_argument('--progress',action='store_true',help='Show a live progress line on stderr: runs done/failed/pending, steps/s, ETA, per-worker utilization')
+    my_args.add_argument('--telemetry',type=str,default=None,help='Append a progress record to this JSONL file every --telemetry-every seconds (read it with telemetry.py status)')
+    my_args.add_argument('--telemetry-every',type=float,default=10.0,help='Seconds between two progress records (default: 10)')
     return my_args.parse_args()
-    
-lock = threading.Lock()
-def thread_work(task_queue, results_list):
-    """this func execute the simulation in a thread"""
+
+
+def append_metrics(rows, path, header):
+    """Append a chunk of metrics rows to metrics.csv."""
+    pd.DataFrame(rows).to_csv(path, mode='w' if header else 'a', header=header, index=False)
+
+
+class OrderedRows:
+    """Metrics rows handed over by the threads, appended to metrics.csv in run_id order.
+
+    The runs finish in any order: a row waits here until every run before it
+    is done or failed, then joins the chunk written every flush_every rows.
+    Only the rows overtaken by a slower run are held, not the whole sweep.
+    A row's 'plot_summary' is set aside, in the same order, for the figures.
+
+    Note:
+        run ids are expected to be 0, 1, 2...; close() writes whatever is
+        still waiting, sorted
+    """
+
+    def __init__(self, path, flush_every, write=append_metrics):
+        self.path = path
+        self.flush_every = flush_every
+        self.write = write
+        self.count = 0
+        # with --stop-tol: steps actually simulated, out of the steps asked for
+        self.steps_used = self.steps_cap = 0
+        self.plot_summaries = []
+        self.labels = []
+        self._pending = {}
+        self._next = 0
+        self._rows = []
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def add(self, run_id, row=None):
+        """Hand over the row of run run_id, or None if the run failed."""
+        with self._lock:
+            self._pending[run_id] = row
+            while self._next in self._pending:
+                self._take(self._pending.pop(self._next))
+                self._next += 1
+            if len(self._rows) >= self.flush_every:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            for run_id in sorted(self._pending):
+                self._take(self._pending[run_id])
+            self._pending = {}
+            if self._rows or self._written == 0:
+                self._flush()
+
+    def _take(self, row):
+        if row is None:
+            return
+        if 'plot_summary' in row:
+            self.plot_summaries.append(row.pop('plot_summary'))
+            self.labels.append(f"run {row['run_id']}")
+        if 'steps_used' in row:
+            self.steps_used += row['steps_used']
+            self.steps_cap += int(row['steps'])
+        self._rows.append(row)
+        self.count += 1
+
+    def _flush(self):
+        self.write(self._rows, self.path, self._written == 0)
+        self._written += len(self._rows)
+        self._rows = []
+
+
+def thread_work(task_queue, results, cache=None, profiler=None, progress=None):
+    """this func execute the simulation in a thread (results: shared OrderedRows, cache: shared ResultCache or None,
+    profiler: shared Profiler or None, progress: shared telemetry.Progress or None)
+
+    Note:
+        a run that raises is reported (message and progress) and skipped,
+        the thread goes on with the next one
+        row['kernel'] picks the model function in KERNELS (default: python)
+        if row['plot_method'] is set, the run is downsampled for the figures
+        here (plotting.summarize_run) and its trajectory dropped
+    """
+    if profiler is None:
+        profiler = Profiler()
+    if progress is None:
+        progress = Progress(None)
+    worker = threading.current_thread().name
     while True:
         row = task_queue.get()
         if row is None:
             task_queue.task_done()
             break
+        start = time.perf_counter()
         try:
-            res = run_simulation(int(row['init_mailly']),int(row['init_moulin']), int(row['steps']), row['p1'], row['p2'], int(row['seed']))
+            with profiler.task(row.get('run_id', 0)):
+                final, res = run_cached(cache, KERNELS[row.get('kernel', 'python')], row['init_mailly'], row['init_moulin'], row['steps'], row['p1'], row['p2'], row.get('stream', row['seed']),
+                                        need_trajectory=bool(row.get('plot_method')), store_trajectory=bool(row.get('cache_trajectories')),
+                                        stop_tol=row.get('stop_tol'), check_every=row.get('check_every', 1000))
             row_result={
                 'run_id': row.get('run_id', 0),
                 #init
@@ -90,16 +177,27 @@ def thread_work(task_queue, results_list):
                 'p2':row['p2'],
                 'seed': row['seed'],
                 #final result
-                'final_mailly':res["mailly"][-1],
-                'final_moulin':res["moulin"][-1],
-                'unmet_mailly':res["unmet_mailly"][-1],
-                'unmet_moulin':res["unmet_moulin"][-1],
-                'ambulance':res["final_imbalance"][-1] 
+                'final_mailly':final["mailly"],
+                'final_moulin':final["moulin"],
+                'unmet_mailly':final["unmet_mailly"],
+                'unmet_moulin':final["unmet_moulin"],
+                'ambulance':final["final_imbalance"] 
             }
-            with lock:
-                results_list.append(row_result)
+            if 'point' in row:
+                # --spec tasks: parameter point and replicate number
+                row_result['point'] = row['point']
+                row_result['replicate'] = row['replicate']
+            if 'steps_used' in final:
+                row_result['steps_used'] = final['steps_used']
+            if row.get('plot_method'):
+                from plotting import summarize_run
+                row_result['plot_summary'] = summarize_run(res, method=row['plot_method'])
+            results.add(row_result['run_id'], row_result)
+            progress.update(worker, row_result['run_id'], time.perf_counter() - start, int(final.get('steps_used', row['steps'])), int(row['steps']))
         except Exception as e:
-            print("error")
+            print(f"error: run {row.get('run_id', 0)}: {e!r}")
+            progress.update(worker, row.get('run_id', 0), time.perf_counter() - start, error=repr(e))
+            results.add(row.get('run_id', 0))
         task_queue.task_done()
         
 
@@ -126,12 +224,17 @@ def main():
     Output files:
     - metrics.csv: Aggregated metrics for all runs
     - Optional plots: PNG files for timeseries and metrics visualization
+    - Optional timing.json: wall and CPU time per phase and per run (--profile)
+    - Optional telemetry JSONL: a progress record every --telemetry-every seconds and a last one at the end (--telemetry)
 
     Note:
         - Use the threading module for parallel processing
+        - metrics.csv is written in chunks of --flush-every rows, in run_id
+          order, while the threads run; with --plot only the downsampled
+          runs are kept (plotting.summarize_run, in the threads)
     """
     args = parse_args()
-    df_params = pd.read_csv(args.params)
+    profiler = Profiler(args.profile, args.profile_capture)
     output_dir = Path(args.out_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     if args.workers == 'auto':
@@ -139,38 +242,60 @@ def main():
     else:
         n_workers = int(args.workers)
         
-    df_params['run_id'] = df_params.index
-    task_queue = queue.Queue() 
-    results = []          
+    with profiler.phase('read_params'):
+        if args.spec:
+            spec = load_spec(args.spec)
+            n_tasks, n_steps = len(spec), None
+            tasks = spec.iter_tasks()
+        else:
+            df_params = pd.read_csv(args.params)
+            n_tasks, n_steps = len(df_params), int(df_params['steps'].sum())
+            tasks = ((i, row.to_dict()) for i, row in df_params.iterrows())
+    progress = Progress(n_tasks, n_steps, args.progress, args.telemetry, args.telemetry_every, 'run_threads')
+    tasks = profiler.iterate('iterate_params', tasks)
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, model_fingerprint(model), int(args.cache_max_mb * 1024 * 1024))
+    # bounded: the tasks are produced as the threads take them
+    task_queue = queue.Queue(maxsize=2 * n_workers)
+    results = OrderedRows(output_dir / "metrics.csv", args.flush_every, profiler.wrap('write_metrics', append_metrics))
     threads = []
-    for _ in range(n_workers):
-        t = threading.Thread(target=thread_work, args=(task_queue, results))
+    for k in range(n_workers):
+        t = threading.Thread(target=thread_work, args=(task_queue, results, cache, profiler, progress), name=f"worker-{k}")
         t.start()
         threads.append(t)
-    for _, row in df_params.iterrows():
-        task_queue.put(row)
+    # put blocks while the queue is full: the time the producer waits for the threads
+    put = profiler.wrap('queue_put', task_queue.put)
+    for i, row in tasks:
+        put(with_stream({**row, 'run_id': i, 'plot_method': args.plot_method if args.plot else None, 'cache_trajectories': args.cache_trajectories,
+                         'stop_tol': args.stop_tol, 'check_every': args.check_every, 'kernel': args.kernel}, args.root_seed))
 
     for _ in range(n_workers):
         task_queue.put(None)
 
-    task_queue.join() 
-    for t in threads:
-        t.join()
-
-    df_results = pd.DataFrame(results)
-    df_results = df_results.sort_values('run_id')
-    csv_path = output_dir / "metrics.csv"
-    df_results.to_csv(csv_path, index=False)
-    print(f"test--threads--Done! {len(df_results)} simulations run.")
+    with profiler.phase('join'):
+        task_queue.join() 
+        for t in threads:
+            t.join()
+    progress.close()
+    results.close()
+    if results.count < n_tasks:
+        print(f"error: {n_tasks - results.count} of {n_tasks} runs failed, they are missing from metrics.csv")
+    if cache is not None:
+        with profiler.phase('cache_evict'):
+            cache.evict()
+        print(f"cache: {cache.hits} hits, {cache.misses} misses")
+    if args.stop_tol is not None:
+        print(f"stationarity: {results.steps_used} of {results.steps_cap} steps simulated")
+    print(f"test--threads--Done! {results.count} simulations run.")
     
     if args.plot:
-        # Collect raw results for plotting
-        raw_results = []
-        for _, row in df_params.iterrows():
-            res = run_simulation(int(row['init_mailly']), int(row['init_moulin']), 
-                               int(row['steps']), row['p1'], row['p2'], int(row['seed']))
-            raw_results.append(res)
-        plot_results(raw_results, output_dir)
+        # the threads downsampled the trajectories, no need to simulate again
+        from plotting import plot_runs
+        with profiler.phase('plot'):
+            plot_runs(results.plot_summaries, output_dir, results.labels)
+        print(f"Plots saved to: {output_dir}")
+    profiler.write(output_dir / "timing.json", runner='run_threads', runs=results.count, workers=n_workers)
     
 
 
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# Random streams fixed by the identity of the work, not by who runs it.
+#
+# With a root seed R, replicate r of row i draws from the SeedSequence with
+# entropy R and spawn_key (i, r): exactly what
+# SeedSequence(R).spawn(i + 1)[i].spawn(r + 1)[r] would give, computed
+# directly.
+#
+# Serial, threads, processes, MPI and batched engines all derive their
+# generators from (R, i, r): the metrics do not depend on the worker
+# count, the chunk size or the order in which the work is done.
+
+
+def row_stream(root_seed, row):
+    """SeedSequence of a row (a parameter point), the parent of its replicates."""
+    return np.random.SeedSequence(int(root_seed), spawn_key=(int(row),))
+
+
+def replicate_stream(row_seed, replicate):
+    """SeedSequence of replicate number `replicate` of a row_stream."""
+    return np.random.SeedSequence(row_seed.entropy, spawn_key=row_seed.spawn_key + (int(replicate),))
+
+
+def stream(root_seed, row, replicate=0):
+    """SeedSequence of (row, replicate) under root_seed."""
+    return replicate_stream(row_stream(root_seed, row), replicate)
+
+
+def generator(seed):
+    """Generator of a stream.
+
+    Args:
+        seed: SeedSequence of the stream (or anything PCG64 accepts)
+
+    Returns:
+        np.random.Generator; generator(seed) gives the same numbers as
+        np.random.default_rng(seed)
+    """
+    return np.random.Generator(np.random.PCG64(seed))
+
+
+def seed_key(seed):
+    """JSON-able identity of a seed: the integer itself, or [entropy, *spawn_key] for a stream."""
+    if isinstance(seed, np.random.SeedSequence):
+        return [int(seed.entropy)] + [int(k) for k in seed.spawn_key]
+    return int(seed)
+
+
+def with_stream(task, root_seed):
+    """Give a runner task (a dict with its 'run_id') its stream under root_seed.
+
+    Returns:
+        The task with 'stream', (point, replicate) for a sweep_spec task and
+        (run_id, 0) for a params row, and 'seed' set to root_seed; the task
+        unchanged when root_seed is None
+    """
+    if root_seed is None:
+        return task
+    if 'point' in task:
+        seed = stream(root_seed, task['point'], task['replicate'])
+    else:
+        seed = stream(root_seed, task['run_id'])
+    return {**task, 'seed': root_seed, 'stream': seed}
@@ -0,0 +1,83 @@
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+# keys of the dictionary returned by model.run_simulation, one row each
+FIELDS = ('mailly', 'moulin', 'unmet_mailly', 'unmet_moulin', 'final_imbalance')
+
+
+def as_array(res):
+    """Stack the lists returned by run_simulation into one (len(FIELDS), steps) int64 array."""
+    return np.array([res[field] for field in FIELDS], dtype=np.int64).reshape(len(FIELDS), -1)
+
+
+def as_results(array):
+    """Views of a (len(FIELDS), steps) array with the keys summarize_run expects (no copy)."""
+    return {field: array[k] for k, field in enumerate(FIELDS)}
+
+
+def share_tracker():
+    """Start this process' resource tracker, before the pool: the workers then use it too.
+
+    Note:
+        The blocks the workers create stay registered with the tracker of the
+        parent, so they belong to the parent: if it dies before releasing
+        them (an error, Ctrl-C, even SIGKILL), its tracker unlinks them at
+        the end instead of leaving them in /dev/shm
+    """
+    resource_tracker.ensure_running()
+
+
+def to_shared(res):
+    """Copy a run's trajectory into a new shared memory block (called in a worker).
+
+    Returns:
+        Handle (name, steps) to send back to the parent instead of the lists
+
+    Note:
+        The block lives on once the worker is gone: it is registered with
+        the parent's resource tracker (share_tracker), and the parent
+        unlinks it (release_shared or discard_shared)
+    """
+    steps = len(res['mailly'])
+    shm = shared_memory.SharedMemory(create=True, size=max(len(FIELDS) * steps * 8, 1))
+    array = np.ndarray((len(FIELDS), steps), dtype=np.int64, buffer=shm.buf)
+    for k, field in enumerate(FIELDS):
+        array[k] = res[field]
+    del array
+    shm.close()
+    return shm.name, steps
+
+
+def discard_shared(handle):
+    """Free a block that will not be read (e.g. the sweep stopped on an error)."""
+    try:
+        shm = shared_memory.SharedMemory(name=handle[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def attach_shared(handle):
+    """Map a block created by to_shared in the parent.
+
+    Returns:
+        Tuple (shm, results) where results are zero-copy views into the block;
+        keep shm until the views are not used anymore, then release_shared(shm)
+    """
+    name, steps = handle
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray((len(FIELDS), steps), dtype=np.int64, buffer=shm.buf)
+    return shm, as_results(array)
+
+
+def release_shared(shm):
+    """Close and free a block attached with attach_shared."""
+    try:
+        shm.close()
+    except BufferError:
+        # a view is still referenced somewhere, the mapping goes away with the process
+        pass
+    shm.unlink()
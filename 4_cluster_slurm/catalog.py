@@ -0,0 +1,294 @@
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+from itertools import chain
+
+
+TABLE = 'runs'
+# parameter columns: indexed as soon as they appear, the filters of a sweep are on them
+PARAM_COLUMNS = ('p1', 'p2', 'init_mailly', 'init_moulin', 'steps', 'seed', 'point', 'replicate')
+# the collector's metrics.csv prefixes the parameters, the catalog stores them under their own name
+PARAM_PREFIX = 'param_'
+# rows per transaction when importing a CSV
+BATCH_ROWS = 50000
+SQL_TYPES = {int: 'INTEGER', float: 'REAL'}
+
+
+def quote(name):
+    """name as an SQL identifier (column names come from CSV headers)."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_type(value):
+    """Declared type of a new column from its first value (numpy scalars count as int and float)."""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if value is None:
+        return ''
+    return SQL_TYPES.get(type(value), 'TEXT')
+
+
+def register_adapters():
+    """Let sqlite3 store lists and dicts (as JSON text) and numpy scalars.
+
+    Note:
+        Adapters run inside sqlite3, only for values that are not already
+        int, float, str or None: converting every value in Python took most
+        of the insert time
+    """
+    for kind in (list, tuple, dict):
+        sqlite3.register_adapter(kind, json.dumps)
+    numpy = sys.modules.get('numpy')
+    if numpy is not None:
+        for kind in (numpy.int64, numpy.int32, numpy.float64, numpy.float32, numpy.bool_):
+            sqlite3.register_adapter(kind, kind.item)
+
+
+def parse_value(text):
+    """A CSV cell as int, else float, else text ('' is NULL)."""
+    if text == '':
+        return None
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            continue
+    return text
+
+
+def connect(path, timeout=60.0, readonly=False):
+    """Open the catalog, creating it if needed, in WAL mode.
+
+    Writers wait for each other (up to `timeout` seconds for the lock), and
+    readers never wait: a query runs while array tasks or the collector
+    are inserting.
+
+    Note:
+        WAL shares memory between the processes using the file, so every
+        writer must run on the host of the database file (a local disk,
+        not NFS written from several nodes)
+    """
+    if readonly:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=timeout, isolation_level=None)
+        return db
+    register_adapters()
+    # autocommit: the transactions are opened explicitly by insert()
+    db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    # in WAL mode, NORMAL loses no data on a crash of the process, only on a power cut
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} (run_id INTEGER PRIMARY KEY)')
+    return db
+
+
+def table_columns(db):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({TABLE})')]
+
+
+def add_index(db, column):
+    db.execute(f'CREATE INDEX IF NOT EXISTS {quote("idx_" + column)} ON {TABLE} ({quote(column)})')
+
+
+def index_params(db):
+    """Index every parameter column of the table that is not yet indexed."""
+    for name in table_columns(db):
+        if name in PARAM_COLUMNS:
+            add_index(db, name)
+
+
+def insert(db, records, index=True):
+    """Insert runs (dicts with a run_id) in one transaction, a run already there is replaced.
+
+    Columns missing from the table are added on the way (typed by their first
+    value) and the parameter columns get their index (index=False leaves it
+    to a call of index_params() once the bulk of the rows is in).
+
+    Returns:
+        Number of runs written
+
+    Note:
+        BEGIN IMMEDIATE takes the write lock before reading the columns, so
+        two workers never add the same column; replacing makes a rerun task
+        or a re-read run idempotent
+    """
+    records = list(records)
+    if not records:
+        return 0
+    # every column of the batch, in order of appearance
+    names = list(dict.fromkeys(chain.from_iterable(records)))
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        columns = set(table_columns(db))
+        for name in names:
+            if name not in columns:
+                first = next((record[name] for record in records if record.get(name) is not None), None)
+                db.execute(f'ALTER TABLE {TABLE} ADD COLUMN {quote(name)} {sql_type(first)}')
+                if index and name in PARAM_COLUMNS:
+                    add_index(db, name)
+        db.executemany(f'INSERT OR REPLACE INTO {TABLE} ({", ".join(map(quote, names))}) VALUES ({", ".join("?" * len(names))})',
+                       [tuple(map(record.get, names)) for record in records])
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return len(records)
+
+
+def catalog_record(row):
+    """Record of a metrics.csv row: `param_` columns under their own name, unless the row also has it."""
+    record = {}
+    for name, value in row.items():
+        if name.startswith(PARAM_PREFIX) and name[len(PARAM_PREFIX):] not in row:
+            name = name[len(PARAM_PREFIX):]
+        record[name] = value
+    return record
+
+
+def import_csv(db, path, batch_rows=BATCH_ROWS):
+    """Insert the rows of a metrics.csv (any runner, or the collector's) by batches of batch_rows.
+
+    Returns:
+        Number of runs written
+
+    Note:
+        The file is streamed, it is never loaded whole; a file without a
+        run_id column numbers its rows from 0. New parameter columns are
+        indexed at the end: building an index once is about 3 times cheaper
+        than keeping it up to date row by row
+    """
+    written = 0
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        batch = []
+        for i, row in enumerate(reader):
+            record = catalog_record({name: parse_value(text) for name, text in row.items()})
+            record.setdefault('run_id', i)
+            batch.append(record)
+            if len(batch) >= batch_rows:
+                written += insert(db, batch, index=False)
+                batch = []
+        written += insert(db, batch, index=False)
+    index_params(db)
+    # statistics of the new indexes, for the planner to pick the most selective one
+    db.execute('PRAGMA optimize')
+    return written
+
+
+def query(db, where=(), columns=None, order_by=None, desc=False, limit=None):
+    """Runs matching every `where` condition (SQL expressions on the columns).
+
+    Returns:
+        Tuple (column names, list of rows)
+    """
+    sql = f'SELECT {", ".join(map(quote, columns)) if columns else "*"} FROM {TABLE}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(f'({condition})' for condition in where)
+    if order_by:
+        sql += f' ORDER BY {quote(order_by)}' + (' DESC' if desc else '')
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+    cursor = db.execute(sql)
+    return [description[0] for description in cursor.description], cursor.fetchall()
+
+
+def count(db, where=()):
+    sql = f'SELECT COUNT(*) FROM {TABLE}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(f'({condition})' for condition in where)
+    return db.execute(sql).fetchone()[0]
+
+
+def query_plan(db, where=(), order_by=None):
+    """SQLite's plan of the query, e.g. 'SEARCH runs USING INDEX idx_p1 (p1>?)'."""
+    sql = f'SELECT * FROM {TABLE}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(f'({condition})' for condition in where)
+    if order_by:
+        sql += f' ORDER BY {quote(order_by)}'
+    return [row[-1] for row in db.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def parse_args():
+    """Parse command line arguments for the results catalog.
+
+    Returns:
+        Parsed arguments containing:
+        - command: 'import', 'query', 'index' or 'info'
+        - db: SQLite catalog file
+        - files: metrics.csv files to insert (import)
+        - where: SQL conditions on the columns, all must hold (query)
+        - columns: Columns to print (query, default: all)
+        - order_by, desc: Sort of the runs printed (query)
+        - limit: Number of runs printed (query)
+        - count: Boolean flag to only print the number of matching runs (query)
+        - explain: Boolean flag to print SQLite's query plan (query)
+        - column_names: Columns to index (index)
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="SQLite catalog of the runs of a sweep: parameters and metrics, indexed")
+    commands = my_parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='Insert the runs of metrics.csv files (any runner, or collect_results.py)')
+    import_parser.add_argument('db',help='SQLite catalog file (created if needed)')
+    import_parser.add_argument('files',nargs='+',help='metrics.csv files')
+    query_parser = commands.add_parser('query', help='Print the runs matching every --where as CSV')
+    query_parser.add_argument('db',help='SQLite catalog file')
+    query_parser.add_argument('--where',action='append',default=[],help='SQL condition on the columns, e.g. "p1 > 0.6" (repeat: all must hold)')
+    query_parser.add_argument('--columns',nargs='+',default=None,help='Columns to print (default: all)')
+    query_parser.add_argument('--order-by',type=str,default=None,help='Column to sort the runs by')
+    query_parser.add_argument('--desc',action='store_true',help='Sort in descending order')
+    query_parser.add_argument('--limit',type=int,default=100,help='Number of runs printed, 0 for all (default: 100)')
+    query_parser.add_argument('--count',action='store_true',help='Only print the number of matching runs')
+    query_parser.add_argument('--explain',action='store_true',help="Print SQLite's query plan on stderr (which index it uses)")
+    index_parser = commands.add_parser('index', help='Index more columns, e.g. a metric often filtered on (the parameters already are)')
+    index_parser.add_argument('db',help='SQLite catalog file')
+    index_parser.add_argument('column_names',nargs='+',help='Columns to index')
+    info_parser = commands.add_parser('info', help='Print the number of runs, the columns and the indexes')
+    info_parser.add_argument('db',help='SQLite catalog file')
+    return my_parser.parse_args()
+
+
+def main():
+    """Run one catalog command; query prints CSV on stdout and its time on stderr."""
+    args = parse_args()
+    if args.command == 'import':
+        db = connect(args.db)
+        for path in args.files:
+            start = time.perf_counter()
+            written = import_csv(db, path)
+            print(f"{path}: {written} runs in {time.perf_counter() - start:.3g}s")
+    elif args.command == 'query':
+        db = connect(args.db, readonly=True)
+        if args.explain:
+            for line in query_plan(db, args.where, args.order_by):
+                print(f"plan: {line}", file=sys.stderr)
+        start = time.perf_counter()
+        if args.count:
+            print(count(db, args.where))
+        else:
+            names, rows = query(db, args.where, args.columns, args.order_by, args.desc, args.limit or None)
+            writer = csv.writer(sys.stdout)
+            writer.writerow(names)
+            writer.writerows(rows)
+        print(f"{(time.perf_counter() - start) * 1000:.3g} ms", file=sys.stderr)
+    elif args.command == 'index':
+        db = connect(args.db)
+        for column in args.column_names:
+            if column not in table_columns(db):
+                raise SystemExit(f"error: no column {column!r} in {args.db}")
+            add_index(db, column)
+    else:
+        db = connect(args.db, readonly=True)
+        print(f"{count(db)} runs")
+        print("columns: " + ", ".join(table_columns(db)))
+        indexes = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+        print("indexes: " + (", ".join(indexes) or "none"))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
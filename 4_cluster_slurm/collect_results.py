@@ -1,8 +1,12 @@
 import argparse
+import os
 from pathlib import Path
 import json
 import pandas as pd
-import matplotlib.pyplot as plt
+
+from catalog import catalog_record, connect, insert
+from codec import CompactTrajectory
+from profiling import Profiler
 
 
 def parse_args():
@@ -13,6 +17,11 @@ def parse_args():
         - in_dir: Input directory containing subdirectories with individual run results
         - out_dir: Output directory for aggregated results
         - plot: Boolean flag to generate plots after collection
+        - full: Boolean flag to ignore the manifest and rebuild the outputs
+        - verify: Boolean flag to stat every tracked file instead of only the run directories
+        - profile: Boolean flag to write timing.json (wall and CPU time per phase and per run read)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile
+        - catalog: SQLite results catalog the ingested runs are also inserted into (catalog.py)
     
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
@@ -21,8 +30,149 @@ def parse_args():
     my_parser.add_argument('--in-dir', type=str, required=True, help='Input directory with subdirectories')
     my_parser.add_argument('--out-dir', type=str, required=True, help='Output directory')
     my_parser.add_argument('--plot', action='store_true', help='Generate plots')
+    my_parser.add_argument('--full', action='store_true', help='Ignore the manifest and re-read every run directory')
+    my_parser.add_argument('--verify', action='store_true', help='Check the size/mtime of every file, not only the run directories')
+    my_parser.add_argument('--profile', action='store_true', help='Write timing.json to the output directory: wall and CPU time per phase and per run read')
+    my_parser.add_argument('--profile-capture', choices=['cprofile', 'tracemalloc'], default=None, help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report')
+    my_parser.add_argument('--catalog', type=str, default=None, help='Also insert the metrics and parameters of the new or changed runs into this SQLite catalog (catalog.py)')
     return my_parser.parse_args()
 
+
+# files of a run directory whose size/mtime decide if the run must be re-read
+TRACKED_FILES = ("metrics.csv", "timeseries.csv", "timeseries.vtrj", "metadata.json")
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ['run_id', 'dir_mtime_ns'] + [
+    f'{name.replace(".", "_")}_{field}' for name in TRACKED_FILES for field in ('size', 'mtime_ns')
+]
+
+
+def scan_runs(in_dir):
+    """Return {run_id: (run_dir, dir_mtime_ns)} for every numbered subdirectory of in_dir.
+
+    Note:
+        Run directories are kept as plain strings: on 100k runs pathlib
+        objects cost more than the stat calls themselves
+    """
+    runs = {}
+    with os.scandir(in_dir) as it:
+        for entry in it:
+            if entry.name.isdigit() and entry.is_dir():
+                runs[int(entry.name)] = (entry.path, entry.stat().st_mtime_ns)
+    return runs
+
+
+def run_signature(run_dir, dir_mtime_ns):
+    """Return (dir_mtime_ns, size, mtime_ns, ...) for the tracked files of one run.
+
+    Note:
+        A missing file is recorded as size -1 and mtime -1
+    """
+    signature = [dir_mtime_ns]
+    for name in TRACKED_FILES:
+        try:
+            st = os.stat(os.path.join(run_dir, name))
+        except FileNotFoundError:
+            signature.extend((-1, -1))
+            continue
+        signature.extend((st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def load_manifest(out_dir):
+    """Load the manifest of already ingested runs as {run_id: signature} ({} if there is none).
+
+    Note:
+        The manifest is append-only, the last line of a run wins
+    """
+    manifest_path = out_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    df = pd.read_csv(manifest_path)
+    if df.columns.tolist() != MANIFEST_COLUMNS:
+        # written by another version of this script
+        return {}
+    df = df.drop_duplicates('run_id', keep='last')
+    return dict(zip(df['run_id'].tolist(), map(tuple, df[MANIFEST_COLUMNS[1:]].to_numpy().tolist())))
+
+
+def save_manifest(out_dir, manifest, run_ids, rewrite=False):
+    """Record the signatures of run_ids in the manifest.
+
+    Note:
+        Usually only the new lines are appended; with rewrite=True the whole
+        manifest is written again (atomically) to drop the stale lines
+    """
+    manifest_path = out_dir / MANIFEST_NAME
+    if rewrite or not manifest_path.exists():
+        run_ids = sorted(manifest)
+    rows = [(run_id,) + tuple(manifest[run_id]) for run_id in run_ids]
+    df = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    if rewrite or not manifest_path.exists():
+        tmp_path = out_dir / (MANIFEST_NAME + ".tmp")
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, manifest_path)
+    else:
+        df.to_csv(manifest_path, mode='a', header=False, index=False)
+
+
+def read_run(run_id, run_dir):
+    """Read the metrics and timeseries of one run directory.
+
+    Returns:
+        Tuple (metrics_df or None, timeseries_df or None)
+
+    Note:
+        metadata.json is written last by run_one.py, so a missing one raises
+        and the run is picked up again by the next call
+    """
+    run_dir = Path(run_dir)
+    with open(run_dir / "metadata.json", 'r') as f:
+        meta = json.load(f)
+
+    metrics_df = None
+    if (run_dir / "metrics.csv").exists():
+        metrics_df = pd.read_csv(run_dir / "metrics.csv")
+        metrics_df['run_id'] = run_id
+        for key, val in meta.items():
+            metrics_df[f'param_{key}'] = val
+
+    ts_df = None
+    if (run_dir / "timeseries.csv").exists():
+        ts_df = pd.read_csv(run_dir / "timeseries.csv")
+    elif (run_dir / "timeseries.vtrj").exists():
+        ts_df = pd.DataFrame(CompactTrajectory(run_dir / "timeseries.vtrj")[:])
+    if ts_df is not None:
+        ts_df['run_id'] = run_id
+    return metrics_df, ts_df
+
+
+def drop_runs(csv_path, run_ids):
+    """Remove the rows of the given runs from an aggregated CSV (used for changed runs)."""
+    if not csv_path.exists():
+        return
+    df = pd.read_csv(csv_path)
+    df = df[~df['run_id'].isin(run_ids)]
+    df.to_csv(csv_path, index=False)
+
+
+def append_rows(csv_path, df):
+    """Append df to an aggregated CSV, keeping the columns of the existing header.
+
+    Note:
+        If df brings columns the file does not have yet, the file is
+        rewritten once with the union of the columns
+    """
+    if not csv_path.exists():
+        df.to_csv(csv_path, index=False)
+        return
+    header = pd.read_csv(csv_path, nrows=0).columns.tolist()
+    if set(df.columns) - set(header):
+        merged = pd.concat([pd.read_csv(csv_path), df], ignore_index=True)
+        merged.to_csv(csv_path, index=False)
+        return
+    df.reindex(columns=header).to_csv(csv_path, mode='a', header=False, index=False)
+
+
 def main():
     """Main function to collect and aggregate results from distributed simulations.
     
@@ -34,7 +184,8 @@ def main():
     5. Save aggregated results to CSV files
     6. Optionally generate plots
     
-    Expected input structure:
+    Expected input structure (timeseries.vtrj instead of timeseries.csv for
+    runs written with run_one.py --format compact):
     - {in_dir}/0/metrics.csv, timeseries.csv, metadata.json
     - {in_dir}/1/metrics.csv, timeseries.csv, metadata.json
     - ...
@@ -42,9 +193,15 @@ def main():
     Output files:
     - metrics.csv: Aggregated metrics for all runs with run_id column
     - timeseries.csv: Tidy format timeseries data for all runs
+    - manifest.csv: size/mtime of the run directories and files already ingested
+    - timing.json: Wall and CPU time per phase and per run read (with --profile)
+    - Optional catalog rows: the new or changed runs, inserted into --catalog
     - Optional plots: PNG files for timeseries and metrics visualization
     
     Note:
+        - Only runs that are new or whose files changed since the last call
+          are read, their rows are appended to the aggregated files (use
+          --full to rebuild everything from scratch)
         - Extract run_id from subdirectory name (should be integer)
         - Merge metadata parameters into metrics with 'param_' prefix
         - Convert timeseries to tidy format (melt operation)
@@ -52,67 +209,109 @@ def main():
         - Sort subdirectories numerically for consistent processing
     """
     args = parse_args()
+    profiler = Profiler(args.profile, args.profile_capture)
     in_dir = Path(args.in_dir)
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
-    all_metrics = []
-    all_timeseries = []
-    run_dirs = sorted([d for d in in_dir.iterdir()
-                       if d.is_dir() and d.name.isdigit()],key=lambda x: int(x.name))
+    metrics_path = out_dir / "metrics.csv"
+    ts_path = out_dir / "timeseries.csv"
 
-    if not run_dirs:
+    with profiler.phase('scan'):
+        runs = scan_runs(in_dir)
+    if not runs:
         print("error")
         return
-    for run_dir in run_dirs:
-        try:
-            run_id = int(run_dir.name)
-            
-            with open(run_dir / "metadata.json", 'r') as f:
-                meta = json.load(f)
-
-            # Metrics
-            if (run_dir / "metrics.csv").exists():
-                metrics_df = pd.read_csv(run_dir / "metrics.csv")
-                metrics_df['run_id'] = run_id
-                
-                for key, val in meta.items():
-                    metrics_df[f'param_{key}'] = val
-                
-                all_metrics.append(metrics_df)
-
-            # Timeseries
-            if (run_dir / "timeseries.csv").exists():
-                ts_df = pd.read_csv(run_dir / "timeseries.csv")
-                ts_df['run_id'] = run_id
-                all_timeseries.append(ts_df)
 
+    with profiler.phase('load_manifest'):
+        manifest = {} if args.full else load_manifest(out_dir)
+    if not manifest:
+        # without a manifest we do not know what the outputs hold: rebuild them
+        for path in (metrics_path, ts_path, out_dir / MANIFEST_NAME):
+            if path.exists():
+                path.unlink()
+
+    # a run whose directory mtime did not move is skipped without touching its files
+    # (run_one.py replaces its files atomically, so rewriting them moves it)
+    to_read = []
+    changed = []
+    touched = []
+    for run_id in sorted(runs):
+        run_dir, dir_mtime_ns = runs[run_id]
+        known = manifest.get(run_id)
+        if known is not None and known[0] == dir_mtime_ns and not args.verify:
+            continue
+        with profiler.phase('signatures'):
+            signature = run_signature(run_dir, dir_mtime_ns)
+        if known == signature:
+            continue
+        if known is not None and known[1:] == signature[1:]:
+            # only the directory moved (e.g. a temporary file came and went)
+            manifest[run_id] = signature
+            touched.append(run_id)
+            continue
+        if known is not None:
+            changed.append(run_id)
+        to_read.append((run_id, signature))
+
+    all_metrics = []
+    all_timeseries = []
+    ingested = []
+    for run_id, signature in to_read:
+        try:
+            with profiler.task(run_id, phase='read_runs'):
+                metrics_df, ts_df = read_run(run_id, runs[run_id][0])
         except Exception as e:
-            print("error")
+            print(f"error: run {run_id}: {e}")
+            continue
+        if metrics_df is not None:
+            all_metrics.append(metrics_df)
+        if ts_df is not None:
+            all_timeseries.append(ts_df)
+        manifest[run_id] = signature
+        ingested.append(run_id)
 
-    if all_metrics:
-        final_metrics = pd.concat(all_metrics, ignore_index=True)
-        final_metrics = final_metrics.sort_values('run_id')
-        
-        csv_path = out_dir / "metrics.csv"
-        final_metrics.to_csv(csv_path, index=False)
+    if changed:
+        with profiler.phase('drop_changed'):
+            drop_runs(metrics_path, changed)
+            drop_runs(ts_path, changed)
 
+    if all_metrics:
+        with profiler.phase('append_metrics'):
+            final_metrics = pd.concat(all_metrics, ignore_index=True)
+            final_metrics = final_metrics.sort_values('run_id')
+            append_rows(metrics_path, final_metrics)
+        if args.catalog:
+            # changed runs replace their row
+            with profiler.phase('catalog_insert'):
+                db = connect(args.catalog)
+                insert(db, map(catalog_record, final_metrics.to_dict('records')))
+                db.close()
 
-    
     if all_timeseries:
-        full_ts = pd.concat(all_timeseries, ignore_index=True)
-        
-        # trasformation
-        tidy_ts = full_ts.melt(
-            id_vars=['time', 'run_id'], 
-            value_vars=['mailly', 'moulin'],
-            var_name='station', 
-            value_name='bikes'
-        )
-        
-        ts_path = out_dir / "timeseries.csv"
-        tidy_ts.to_csv(ts_path, index=False)
-    else:
+        with profiler.phase('append_timeseries'):
+            full_ts = pd.concat(all_timeseries, ignore_index=True)
+            
+            # trasformation
+            tidy_ts = full_ts.melt(
+                id_vars=['time', 'run_id'], 
+                value_vars=['mailly', 'moulin'],
+                var_name='station', 
+                value_name='bikes'
+            )
+            append_rows(ts_path, tidy_ts)
+
+    # changed runs that could not be re-read are treated as new next time
+    failed = [run_id for run_id in changed if run_id not in ingested]
+    for run_id in failed:
+        del manifest[run_id]
+    if ingested or touched or failed:
+        with profiler.phase('save_manifest'):
+            save_manifest(out_dir, manifest, ingested + touched, rewrite=bool(changed))
+
+    if not ts_path.exists():
         print("No data")
+    print(f"collected {len(ingested)} new or changed runs ({len(manifest)} in total)")
+    profiler.write(out_dir / "timing.json", runner='collect_results', runs=len(runs), read=len(ingested))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List
 import numpy as np
-import pandas as pd
+
+from stationarity import check_stationary
 
 
 @dataclass
@@ -63,7 +64,128 @@ def step(
     return state
 
 
-def run_simulation(initial: State, steps: int, p1: float, p2: float, seed: int):
+class Observer:
+    """Hooks run_simulation calls as the simulation goes: subclass it and
+    override the ones you need, the others are never called.
+
+    Attributes:
+        every: on_step is called before every step t with t % every == 0 (0: never)
+
+    Note:
+        - station is 'mailly' or 'moulin', t the step
+        - With no observer run_simulation takes a loop without any hook,
+          so production sweeps pay nothing for them
+    """
+
+    every = 0
+
+    def on_trip(self, t: int, station: str) -> None:
+        """A bike left station during step t."""
+
+    def on_unmet(self, t: int, station: str) -> None:
+        """A user found station empty during step t."""
+
+    def on_empty(self, t: int, station: str) -> None:
+        """station gave its last bike during step t."""
+
+    def on_step(self, t: int, state: State) -> None:
+        """State before step t (read only)."""
+
+
+# uniforms drawn at once by _fast_loop: the same stream as one rng.random() per draw
+DRAW_BLOCK = 4096
+
+
+def _fast_loop(state, metrics, start, stop, p1, p2, rng, history, monitored):
+    """Steps start .. stop - 1 of run_simulation without hooks: step() with local variables."""
+    mailly, moulin = state.mailly, state.moulin
+    unmet_mailly, unmet_moulin = metrics['unmet_mailly'], metrics['unmet_moulin']
+    record_mailly = history['mailly'].append
+    record_moulin = history['moulin'].append
+    # the unmet series are only kept for the stationarity checks
+    unmet_series = (monitored['unmet_mailly'], monitored['unmet_moulin']) if monitored is not None else ([], [])
+    record_unmet_mailly = unmet_series[0].append
+    record_unmet_moulin = unmet_series[1].append
+    for block in range(start, stop, DRAW_BLOCK):
+        u = rng.random(2 * (min(block + DRAW_BLOCK, stop) - block)).tolist()
+        for k in range(0, len(u), 2):
+            record_mailly(mailly)
+            record_moulin(moulin)
+            record_unmet_mailly(unmet_mailly)
+            record_unmet_moulin(unmet_moulin)
+            if u[k] < p1:
+                if mailly:
+                    mailly -= 1
+                    moulin += 1
+                else:
+                    unmet_mailly += 1
+            if u[k + 1] < p2:
+                if moulin:
+                    moulin -= 1
+                    mailly += 1
+                else:
+                    unmet_moulin += 1
+        if monitored is None:
+            del unmet_series[0][:], unmet_series[1][:]
+    state.mailly, state.moulin = mailly, moulin
+    metrics['unmet_mailly'], metrics['unmet_moulin'] = unmet_mailly, unmet_moulin
+
+
+def _hooks(observers, name):
+    """Bound `name` hooks of the observers that override it."""
+    default = getattr(Observer, name)
+    return [getattr(o, name) for o in observers if getattr(type(o), name, default) is not default]
+
+
+class _ObservedLoop:
+    """Steps of run_simulation with observers (same draws as step())."""
+
+    def __init__(self, observers):
+        self.on_trip = _hooks(observers, 'on_trip')
+        self.on_unmet = _hooks(observers, 'on_unmet')
+        self.on_empty = _hooks(observers, 'on_empty')
+        self.on_step = [(o.every, o.on_step) for o in observers if o.every and _hooks([o], 'on_step')]
+
+    def _trip(self, t, station, left):
+        for hook in self.on_trip:
+            hook(t, station)
+        if not left:
+            for hook in self.on_empty:
+                hook(t, station)
+
+    def __call__(self, state, metrics, start, stop, p1, p2, rng, history, monitored):
+        random = rng.random
+        for t in range(start, stop):
+            history['mailly'].append(state.mailly)
+            history['moulin'].append(state.moulin)
+            if monitored is not None:
+                monitored['unmet_mailly'].append(metrics['unmet_mailly'])
+                monitored['unmet_moulin'].append(metrics['unmet_moulin'])
+            for every, hook in self.on_step:
+                if t % every == 0:
+                    hook(t, state)
+            if random() < p1:
+                if state.mailly:
+                    state.mailly -= 1
+                    state.moulin += 1
+                    self._trip(t, 'mailly', state.mailly)
+                else:
+                    metrics['unmet_mailly'] += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'mailly')
+            if random() < p2:
+                if state.moulin:
+                    state.moulin -= 1
+                    state.mailly += 1
+                    self._trip(t, 'moulin', state.moulin)
+                else:
+                    metrics['unmet_moulin'] += 1
+                    for hook in self.on_unmet:
+                        hook(t, 'moulin')
+
+
+def run_simulation(initial: State, steps: int, p1: float, p2: float, seed: int, stop_tol: float = None, check_every: int = 1000,
+                   observers: List[Observer] = None, frame: bool = True):
     """Run a complete bike-sharing simulation with extended metrics.
 
     Args:
@@ -72,39 +194,59 @@ def run_simulation(initial: State, steps: int, p1: float, p2: float, seed: int):
         p1: Probability of movement from Mailly to Moulin
         p2: Probability of movement from Moulin to Mailly
         seed: Random seed for reproducibility
+        stop_tol: Stop early once the run is stationary within this tolerance
+            (stationarity.check_stationary), None to run all the steps
+        check_every: Steps between two stationarity checks at the start;
+            later checks are 10% of the steps apart, so they cost O(steps) in all
+        observers: Observer instances called on trips, unmet requests,
+            stations running empty and every `every` steps; None for none
+        frame: Return the history as a DataFrame (pandas is imported then),
+            else as a dict of int64 arrays with the same columns
 
     Returns:
         Tuple containing:
         - DataFrame with columns ['time', 'mailly', 'moulin'] tracking bike counts over time
+          (dict of arrays with frame=False)
         - Dictionary with metrics including:
             - 'unmet_mailly': Number of unmet requests at Mailly
             - 'unmet_moulin': Number of unmet requests at Moulin
             - 'final_imbalance': Final difference between station bike counts
+            - 'steps_used': Number of steps simulated (only with stop_tol)
 
     Note:
         - Initialize metrics dictionary with all required counters
         - Record state at each time step for the DataFrame
         - Calculate final imbalance as mailly - moulin
+        - Without observers the steps run in _fast_loop (no State, no metrics
+          dict, uniforms drawn by blocks), otherwise in an _ObservedLoop;
+          both follow step() draw for draw, so they give the same run
     """
     state = State(mailly=initial.mailly,moulin=initial.moulin)
     rng = np.random.default_rng(seed)
     metrics = {'unmet_mailly':0,'unmet_moulin':0}
-    # mailly = []
-    # moulin = []
-    # unmet_mailly = []
-    # unmet_moulin = []
-    # final_imbalance = []
-    history =[]
-    for i in range(steps):
-        history.append({
-            'time': i,
-            'mailly': state.mailly,
-            'moulin': state.moulin
-        })
-        # unmet_mailly.append(state.unmet_mailly)
-        # unmet_moulin.append(state.unmet_moulin)
-        # final_imbalance.append(state.mailly - state.moulin)
-        step(state,p1,p2,rng,metrics)
+    history = {'mailly': [], 'moulin': []}
+    monitored = None
+    if stop_tol is not None:
+        # series the stationarity check looks at, state before each step
+        monitored = {'mailly': history['mailly'], 'moulin': history['moulin'], 'unmet_mailly': [], 'unmet_moulin': []}
+    loop = _ObservedLoop(observers) if observers else _fast_loop
+    # the steps go by segments between two stationarity checks
+    i = 0
+    next_check = check_every if stop_tol is not None else steps
+    while i < steps:
+        stop = min(next_check, steps)
+        loop(state, metrics, i, stop, p1, p2, rng, history, monitored)
+        i = stop
+        if i == steps or check_stationary(monitored, p1, p2, stop_tol)[0]:
+            break
+        next_check = i + max(check_every, i // 10)
     metrics['final_imbalance'] = state.mailly - state.moulin
-    df_history = pd.DataFrame(history)
-    return df_history, metrics
+    if stop_tol is not None:
+        metrics['steps_used'] = len(history['mailly'])
+    columns = {'time': np.arange(len(history['mailly']), dtype=np.int64),
+               **{name: np.array(values, dtype=np.int64) for name, values in history.items()}}
+    if not frame:
+        return columns, metrics
+    # only here: an array task writing its own files never loads pandas
+    import pandas as pd
+    return pd.DataFrame(columns), metrics
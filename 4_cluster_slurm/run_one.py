@@ -1,9 +1,14 @@
 import argparse
+import csv
 import json
+import os
 from pathlib import Path
-import pandas as pd
 
+import model
 from model import State, run_simulation
+from streams import with_stream, seed_key
+from profiling import Profiler
+from telemetry import TaskTelemetry
 
 
 def parse_args():
@@ -12,20 +17,97 @@ def parse_args():
     Returns:
         Parsed arguments containing:
         - params: Path to CSV file with parameter combinations (default: params.csv)
-        - row_index: Index of the row to execute from the parameters file
+        - spec: Path to a JSON sweep spec (sweep_spec.py), instead of params
+        - row_index: Index of the row to execute from the parameters file (task index with --spec)
         - out_dir: Output directory for this simulation's results
         - base_seed: Base seed to use if row doesn't have seed column (default: 0)
+        - root_seed: Root of the streams.py random streams, instead of the seed column
+        - format: Timeseries format, 'csv' or 'compact' (.vtrj, see codec.py), or 'none' for
+          metrics.csv and metadata.json only
+        - cache_dir: Result cache directory (default: no cache)
+        - cache_max_mb: Size limit of the result cache in MB
+        - stop_tol: Stop the run once stationary within this tolerance (stationarity.py), steps becomes a cap
+        - check_every: Steps between the first stationarity checks
+        - profile: Boolean flag to write timing.json next to metrics.csv (wall and CPU time per phase)
+        - profile_capture: Also capture 'cprofile' or 'tracemalloc' data with --profile
+        - telemetry: JSONL file shared by the array tasks, one record per task (telemetry.py)
+        - catalog: SQLite results catalog the run is inserted into (catalog.py)
     
     Note:
         Use argparse.ArgumentParser to define all required and optional arguments
     """
     my_args = argparse.ArgumentParser(description="Parse command line arguments for running one simulation from parameter file")
-    my_args.add_argument('--params',type=str,required=True, help='Path to CSV file with parameter combinations (default: params.csv)')
-    my_args.add_argument('--row-index',type=int, required=True, help=' Index of the row to execute from the parameters file')
+    source = my_args.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params',type=str, help='Path to CSV file with parameter combinations (default: params.csv)')
+    source.add_argument('--spec',type=str, help='Path to a JSON sweep spec: the row is computed from --row-index, no file to read')
+    my_args.add_argument('--row-index',type=int, required=True, help=' Index of the row to execute from the parameters file (task index with --spec)')
     my_args.add_argument('--out-dir',type=str,default='results', help=' Output directory for results')
     my_args.add_argument('--base-seed',type=int,default=0,help='Base seed to use if row doesn\'t have seed column (default: 0)')
+    my_args.add_argument('--root-seed',type=int,default=None,help='Draw the row from its own stream under this root seed (streams.py): same results as the local runners with --root-seed')
+    my_args.add_argument('--format',choices=['csv','compact','none'],default='csv',help='Timeseries format: csv or compact .vtrj, or none to only write the metrics and metadata (default: csv)')
+    my_args.add_argument('--cache-dir',type=str,default=None,help='Result cache directory shared across sweeps (default: no cache)')
+    my_args.add_argument('--cache-max-mb',type=float,default=1024,help='Size limit of the result cache in MB (default: 1024)')
+    my_args.add_argument('--stop-tol',type=float,default=None,help='Stop the run once its estimates are stable within this relative tolerance; steps is then a cap (default: run all the steps)')
+    my_args.add_argument('--check-every',type=int,default=1000,help='Steps between the first stationarity checks (default: 1000)')
+    my_args.add_argument('--profile',action='store_true',help='Write timing.json next to metrics.csv: wall and CPU time per phase')
+    my_args.add_argument('--profile-capture',choices=['cprofile','tracemalloc'],default=None,help='With --profile, also capture a cProfile (profile.prof, profile.txt) or tracemalloc report')
+    my_args.add_argument('--telemetry',type=str,default=None,help='Append a record of this task (done or failed, steps, seconds, host) to this JSONL file shared by the array (read it with telemetry.py status)')
+    my_args.add_argument('--catalog',type=str,default=None,help='Also insert the parameters and metrics of the run into this SQLite catalog (catalog.py), on a disk local to the tasks')
     return my_args.parse_args()
 
+
+def read_row(path, index):
+    """Row `index` of a params CSV, typed as pd.read_csv(path).iloc[index] gives it, without pandas.
+
+    Returns:
+        Tuple (row as a dict, number of rows)
+
+    Note:
+        Every column is typed from all its values (int, else float, else
+        text), and a row of int and float columns comes out all floats, as a
+        pandas row does: metadata.json does not change
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [line for line in reader if line]
+    row = rows[index]
+    types = []
+    for k in range(len(header)):
+        for cast in (int, float, str):
+            try:
+                for line in rows:
+                    cast(line[k])
+            except ValueError:
+                continue
+            types.append(cast)
+            break
+    if float in types and str not in types:
+        types = [float] * len(types)
+    return {name: cast(value) for name, cast, value in zip(header, types, row)}, len(rows)
+
+
+def write_columns(path, columns):
+    """CSV of equal-length columns (dict name -> values), as DataFrame(columns).to_csv(path, index=False) writes it."""
+    line = ','.join(['{}'] * len(columns)) + '\n'
+    with open(path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        f.writelines(map(line.format, *(list(values) if isinstance(values, list) else values.tolist() for values in columns.values())))
+
+
+def write_atomic(path, write):
+    """Write a file through a temporary name and rename it into place.
+
+    Note:
+        collect_results.py can run while the array job is still writing:
+        it never sees half a file, and a rerun task moves the directory
+        mtime that the collector's manifest checks
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
 def main():
     """Main function to run a single simulation specified by row index.
     
@@ -33,7 +115,8 @@ def main():
     1. Parse command line arguments
     2. Read the parameters CSV file
     3. Extract the specified row by index
-    4. Handle seed generation (use row seed or base_seed + row_index)
+    4. Handle seed generation (use row seed or base_seed + row_index, or the
+       streams.py stream of the row with --root-seed)
     5. Run the simulation with extracted parameters
     6. Save results to individual output directory
     7. Save metadata about the run
@@ -47,44 +130,102 @@ def main():
     - seed: Random seed (optional)
     
     Output structure:
-    - {out_dir}/{row_index}/timeseries.csv: Simulation timeseries
+    - {out_dir}/{row_index}/timeseries.csv: Simulation timeseries (timeseries.vtrj with --format compact)
     - {out_dir}/{row_index}/metrics.csv: Simulation metrics
     - {out_dir}/{row_index}/metadata.json: Run parameters and metadata
+    - {out_dir}/{row_index}/timing.json: Wall and CPU time per phase (with --profile)
+    - Optional telemetry JSONL: one record for this task, done or failed, appended to --telemetry
+    - Optional catalog row: parameters, used_seed and metrics of the run, inserted into --catalog
     
     Note:
         - Create subdirectory named after row_index
         - Handle missing seed column gracefully
         - Save metadata as JSON with all parameters including final seed used
+        - Every array task pays the start-up: pandas is never imported, and
+          sweep_spec, result_cache and codec only in the branch that uses them
     """
     args = parse_args()
+    profiler = Profiler(args.profile, args.profile_capture)
+    # records a failure by itself if the task does not get to finish()
+    telemetry = TaskTelemetry(args.telemetry, args.row_index)
     try:
-        csv_all = pd.read_csv(args.params)
-        row = csv_all.iloc[args.row_index]
+        with profiler.phase('read_params'):
+            if args.spec:
+                # the parameters follow from the array index alone
+                from sweep_spec import load_spec
+                spec = load_spec(args.spec)
+                telemetry.total = len(spec)
+                row = dict(spec.task(args.row_index))
+            else:
+                row, telemetry.total = read_row(args.params, args.row_index)
     except IndexError:
         print(f"Erreur")
         return
     
-    if 'seed' in row: seed = int(row['seed'])
+    if args.root_seed is not None:
+        # (row_index, 0), or (point, replicate) with --spec, under the root seed
+        seed = with_stream({**row, 'run_id': args.row_index}, args.root_seed)['stream']
+    elif 'seed' in row: seed = int(row['seed'])
     else: seed = args.base_seed + args.row_index
     
     initial_state = State(
         mailly=int(row['init_mailly']),
         moulin=int(row['init_moulin'])
     )
-    df_results, metrics = run_simulation(initial=initial_state,steps=int(row['steps']),p1=row['p1'],p2=row['p2'],seed=seed)
+    cache = None
+    cached = None
+    if args.cache_dir:
+        # the timeseries is an output here, so entries always keep the trajectory
+        from result_cache import ResultCache, model_fingerprint
+        cache = ResultCache(args.cache_dir, model_fingerprint(model), int(args.cache_max_mb * 1024 * 1024))
+        key = cache.key(initial_state.mailly, initial_state.moulin, row['steps'], row['p1'], row['p2'], seed,
+                        (args.stop_tol, args.check_every) if args.stop_tol is not None else None)
+        with profiler.phase('cache_get'):
+            cached = cache.get(key, need_trajectory=True)
+    if cached is not None:
+        metrics, trajectory = cached
+    else:
+        with profiler.task(args.row_index):
+            # arrays, no DataFrame: the task never imports pandas
+            trajectory, metrics = run_simulation(initial=initial_state,steps=int(row['steps']),p1=row['p1'],p2=row['p2'],seed=seed,
+                                                 stop_tol=args.stop_tol,check_every=args.check_every,frame=False)
+        if cache is not None:
+            with profiler.phase('cache_put'):
+                cache.put(key, {name: int(value) for name, value in metrics.items()}, trajectory)
+                cache.evict()
     csv_path = Path(args.out_dir) / str(args.row_index)
     csv_path.mkdir(parents=True, exist_ok=True)
-    df_results.to_csv(csv_path / "timeseries.csv", index=False)
+    with profiler.phase('write_timeseries'):
+        if args.format == 'compact':
+            from codec import encode_trajectory
+            total = initial_state.mailly + initial_state.moulin
+            write_atomic(csv_path / "timeseries.vtrj", lambda path: encode_trajectory(path, trajectory['mailly'], total))
+        elif args.format == 'csv':
+            write_atomic(csv_path / "timeseries.csv", lambda path: write_columns(path, trajectory))
     
-    pd.DataFrame([metrics]).to_csv(csv_path / "metrics.csv", index=False)
+    with profiler.phase('write_metrics'):
+        write_atomic(csv_path / "metrics.csv", lambda path: write_columns(path, {name: [value] for name, value in metrics.items()}))
     
-    metadata = row.to_dict()
-    metadata['used_seed'] = seed
+    metadata = dict(row)
+    metadata['used_seed'] = seed_key(seed)
     
-    with open(csv_path / "metadata.json", "w") as f:
-        json.dump(metadata, f, indent=4)
+    # metadata.json goes last: the collector only ingests runs that have it
+    def write_metadata(path):
+        with open(path, "w") as f:
+            json.dump(metadata, f, indent=4)
+    with profiler.phase('write_metadata'):
+        write_atomic(csv_path / "metadata.json", write_metadata)
+    if args.catalog:
+        # a rerun task replaces its row
+        from catalog import connect, insert
+        with profiler.phase('catalog_insert'):
+            db = connect(args.catalog)
+            insert(db, [{'run_id': args.row_index, **metadata, **metrics}])
+            db.close()
         
-    print(f"test--runoneSlurm--Done! {len(df_results)} simulations run.")
+    print(f"test--runoneSlurm--Done! {len(trajectory['time'])} simulations run.")
+    telemetry.finish(int(metrics.get('steps_used', row['steps'])), int(row['steps']))
+    profiler.write(csv_path / "timing.json", runner='run_one', row_index=args.row_index, cached=cached is not None)
         
     
     
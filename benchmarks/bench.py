@@ -0,0 +1,360 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+
+ROOT = Path(__file__).resolve().parent.parent
+SERIAL_DIR = ROOT / '2_serial_param_sweep'
+PARALLEL_DIR = ROOT / '3_parallel_local'
+CLUSTER_DIR = ROOT / '4_cluster_slurm'
+
+# sizes of each suite: (quick, default, full)
+RUN_SIMULATION_STEPS = ([10**3, 10**4, 10**5], [10**3, 10**4, 10**5, 10**6], [10**3, 10**4, 10**5, 10**6, 10**7])
+RUNNER_ROWS = ([10, 100], [10, 100, 1000], [10, 100, 1000, 10**4])
+COLLECT_RUNS = ([10, 100], [10, 100, 1000], [10, 100, 1000, 10**4])
+CATALOG_RUNS = ([10**4, 10**5], [10**5, 10**6], [10**5, 10**6, 10**7])
+# steps of every runner row and of every synthetic run: the per-row costs dominate
+ROW_STEPS = 100
+
+
+def timed(function, repeats):
+    """Wall times of `repeats` calls of function()."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def record(results, name, times, per=1):
+    """Store a benchmark: best time (the least disturbed by the rest of the box) and all times, divided by per."""
+    times = [t / per for t in times]
+    results[name] = {'seconds': min(times), 'times': times}
+    print(f"{name:45s} {min(times):.6g}s")
+
+
+def bench_kernel(results, level, repeats):
+    """model.step per call, and run_simulation for every size of RUN_SIMULATION_STEPS."""
+    sys.path.insert(0, str(SERIAL_DIR))
+    from model import State, step, run_simulation
+    rng = np.random.default_rng(0)
+    state = State(mailly=10, moulin=5)
+    metrics = {'unmet_mailly': 0, 'unmet_moulin': 0}
+    calls = 100000
+
+    def many_steps():
+        for _ in range(calls):
+            step(state, 0.5, 0.5, rng, metrics)
+    record(results, 'kernel.step', timed(many_steps, repeats), per=calls)
+    for steps in RUN_SIMULATION_STEPS[level]:
+        record(results, f'kernel.run_simulation[{steps}]',
+               timed(lambda: run_simulation(10, 5, steps, 0.5, 0.5, 0), repeats if steps < 10**6 else 1))
+
+
+def write_params(path, rows, steps=ROW_STEPS):
+    """Params CSV of `rows` runs of `steps` steps; the first n rows are the same whatever rows is."""
+    rng = np.random.default_rng(0)
+    with open(path, 'w') as f:
+        f.write("steps,p1,p2,init_mailly,init_moulin,seed\n")
+        for i in range(rows):
+            f.write(f"{steps},{rng.uniform(0.2, 0.8):.3f},{rng.uniform(0.2, 0.8):.3f},10,5,{i}\n")
+
+
+def mpi_available():
+    """mpirun on the PATH and mpi4py importable: run_mpi.py can be launched on this box."""
+    if shutil.which('mpirun') is None:
+        return False
+    return subprocess.run([sys.executable, '-c', 'import mpi4py'], capture_output=True).returncode == 0
+
+
+def mpirun_command(ranks):
+    """mpirun prefix for `ranks` ranks on this box (Open MPI needs to be told it may oversubscribe and run as root)."""
+    version = subprocess.run(['mpirun', '--version'], capture_output=True, text=True).stdout
+    if 'Open MPI' in version or 'OpenRTE' in version:
+        return ['mpirun', '--allow-run-as-root', '--oversubscribe', '-n', str(ranks)]
+    return ['mpirun', '-n', str(ranks)]
+
+
+def runner_commands(params, out_dir):
+    """Command line of every sweep runner on a params CSV (run_mpi.py only if mpirun and mpi4py are there)."""
+    commands = {
+        'run_serial': [sys.executable, str(SERIAL_DIR / 'run_serial.py'), '--params', params, '--out-dir', out_dir],
+        'run_parallel': [sys.executable, str(PARALLEL_DIR / 'run_parallel.py'), '--params', params, '--out-dir', out_dir, '--workers', '2'],
+        'run_threads': [sys.executable, str(PARALLEL_DIR / 'run_threads.py'), '--params', params, '--out-dir', out_dir, '--workers', '2'],
+    }
+    if mpi_available():
+        commands['run_mpi'] = mpirun_command(2) + [sys.executable, str(PARALLEL_DIR / 'run_mpi.py'), '--params', params, '--out-dir', out_dir]
+    return commands
+
+
+def run_command(command):
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr}")
+
+
+def bench_runners(results, level, repeats, tmp):
+    """Every sweep runner, end to end (start-up included), on RUNNER_ROWS rows."""
+    for rows in RUNNER_ROWS[level]:
+        params = str(tmp / f'params_{rows}.csv')
+        write_params(params, rows)
+        for name, command in runner_commands(params, str(tmp / 'runner_out')).items():
+            record(results, f'runner.{name}[{rows}]', timed(lambda: run_command(command), repeats if rows < 1000 else 1))
+
+
+def write_run_tree(in_dir, runs):
+    """Synthetic run_one.py output: runs directories of metrics.csv, timeseries.csv and metadata.json."""
+    rng = np.random.default_rng(0)
+    for i in range(runs):
+        run_dir = in_dir / str(i)
+        run_dir.mkdir(parents=True)
+        mailly = np.clip(10 + np.cumsum(rng.integers(-1, 2, ROW_STEPS)), 0, 15)
+        with open(run_dir / 'timeseries.csv', 'w') as f:
+            f.write("time,mailly,moulin\n")
+            f.writelines(f"{t},{m},{15 - m}\n" for t, m in enumerate(mailly))
+        with open(run_dir / 'metrics.csv', 'w') as f:
+            f.write(f"unmet_mailly,unmet_moulin,final_imbalance\n{rng.integers(10)},{rng.integers(10)},{2 * mailly[-1] - 15}\n")
+        with open(run_dir / 'metadata.json', 'w') as f:
+            json.dump({'init_mailly': 10, 'init_moulin': 5, 'steps': ROW_STEPS, 'p1': 0.5, 'p2': 0.5, 'seed': i, 'used_seed': i}, f)
+
+
+def bench_collect(results, level, repeats, tmp):
+    """collect_results.py on synthetic trees: from scratch (--full) and incremental with nothing new."""
+    for runs in COLLECT_RUNS[level]:
+        in_dir = tmp / f'runs_{runs}'
+        write_run_tree(in_dir, runs)
+        out_dir = str(tmp / f'collected_{runs}')
+        command = [sys.executable, str(CLUSTER_DIR / 'collect_results.py'), '--in-dir', str(in_dir), '--out-dir', out_dir]
+        r = repeats if runs < 1000 else 1
+        record(results, f'collect.full[{runs}]', timed(lambda: run_command(command + ['--full']), r))
+        record(results, f'collect.incremental[{runs}]', timed(lambda: run_command(command), r))
+
+
+def synthetic_run(steps, rng):
+    """Dict of per-step arrays shaped like a run_simulation result (a clipped random walk)."""
+    mailly = np.clip(10 + np.cumsum(rng.integers(-1, 2, steps)), 0, 15)
+    return {'mailly': mailly, 'moulin': 15 - mailly,
+            'unmet_mailly': np.cumsum(mailly == 0), 'unmet_moulin': np.cumsum(mailly == 15)}
+
+
+def bench_plot(results, level, repeats, tmp):
+    """plotting.py: downsampling a run for every size of RUN_SIMULATION_STEPS, and the figures."""
+    sys.path.insert(0, str(SERIAL_DIR))
+    from plotting import summarize_run, draw_run, plot_runs
+    rng = np.random.default_rng(0)
+    for steps in RUN_SIMULATION_STEPS[level]:
+        run = synthetic_run(steps, rng)
+        for method in ('minmax', 'lttb'):
+            record(results, f'plot.summarize_{method}[{steps}]', timed(lambda: summarize_run(run, 50, method=method), repeats))
+    # the figures only see the summaries: their time does not depend on the steps
+    summaries = [summarize_run(synthetic_run(RUN_SIMULATION_STEPS[level][-1], rng)) for _ in range(16)]
+    record(results, 'plot.draw_run', timed(lambda: draw_run(summaries[0], 'run 0', tmp / 'plot.png'), repeats))
+    record(results, 'plot.plot_runs[16]', timed(lambda: plot_runs(summaries, tmp), repeats))
+
+
+def catalog_records(start, count, rng):
+    """Synthetic catalog rows start..start+count: parameters on a 0.001 grid, metrics at random."""
+    p1 = rng.uniform(0, 1, count).round(3).tolist()
+    p2 = rng.uniform(0, 1, count).round(3).tolist()
+    unmet = rng.integers(0, 500, (2, count)).tolist()
+    return [{'run_id': start + i, 'steps': 10000, 'p1': p1[i], 'p2': p2[i], 'init_mailly': 10, 'init_moulin': 5, 'seed': start + i,
+             'unmet_mailly': unmet[0][i], 'unmet_moulin': unmet[1][i], 'final_imbalance': 0} for i in range(count)]
+
+
+# filters of the catalog suite: (name, conditions), printed 100 runs at most
+CATALOG_QUERIES = [
+    ('p1_unmet', ['p1 > 0.6', 'unmet_moulin > 100']),
+    ('p1_narrow', ['p1 > 0.995', 'unmet_moulin > 100']),
+    ('p1_p2_box', ['p1 BETWEEN 0.5 AND 0.51', 'p2 < 0.1']),
+]
+
+
+def bench_catalog(results, level, repeats, tmp):
+    """catalog.py: bulk insert of CATALOG_RUNS runs (indexes built at the end) and filters on them."""
+    sys.path.insert(0, str(CLUSTER_DIR))
+    from catalog import connect, insert, index_params, query, count
+    batch = 50000
+    for runs in CATALOG_RUNS[level]:
+        rng = np.random.default_rng(0)
+        db = connect(str(tmp / f'catalog_{runs}.db'))
+
+        def fill():
+            for start in range(0, runs, batch):
+                insert(db, catalog_records(start, min(batch, runs - start), rng), index=False)
+            index_params(db)
+            db.execute('PRAGMA optimize')
+        record(results, f'catalog.insert[{runs}]', timed(fill, 1), per=runs)
+        for name, where in CATALOG_QUERIES:
+            record(results, f'catalog.query_{name}[{runs}]', timed(lambda: query(db, where, limit=100), repeats))
+        # counting reads every match: fast on a narrow filter only
+        record(results, f'catalog.count_p1_narrow[{runs}]', timed(lambda: count(db, CATALOG_QUERIES[1][1]), repeats))
+        db.close()
+
+
+# entry points of the startup suite: `--help` loads every module-level import and stops
+ENTRY_POINTS = {
+    'run_single': ROOT / '1_basic_single_sim' / 'run_single.py',
+    'run_serial': SERIAL_DIR / 'run_serial.py',
+    'run_parallel': PARALLEL_DIR / 'run_parallel.py',
+    'run_threads': PARALLEL_DIR / 'run_threads.py',
+    'run_one': CLUSTER_DIR / 'run_one.py',
+    'collect_results': CLUSTER_DIR / 'collect_results.py',
+    'telemetry': CLUSTER_DIR / 'telemetry.py',
+}
+# cold start of one array task (run_one.py), paid by every task of a job array
+RUN_ONE_TARGET = 0.150
+
+
+def heavy_imports(command):
+    """Which of pandas and matplotlib a command loads (python -X importtime, top-level packages)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], capture_output=True, text=True)
+    loaded = {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')}
+    return [name for name in ('pandas', 'matplotlib') if name in loaded]
+
+
+def bench_startup(results, level, repeats, tmp):
+    """Start-up: python alone, python + numpy (the floor of every entry point), every entry point's --help, and a whole run_one.py task."""
+    record(results, 'startup.python', timed(lambda: run_command([sys.executable, '-c', 'pass']), repeats))
+    record(results, 'startup.import_numpy', timed(lambda: run_command([sys.executable, '-c', 'import numpy']), repeats))
+    for name, script in ENTRY_POINTS.items():
+        command = [sys.executable, str(script), '--help']
+        record(results, f'startup.{name}', timed(lambda: run_command(command), repeats))
+        print(f"{'':45s} loads: {', '.join(heavy_imports(command)) or 'neither pandas nor matplotlib'}")
+    params = str(tmp / 'startup_params.csv')
+    write_params(params, 1)
+    command = [sys.executable, str(CLUSTER_DIR / 'run_one.py'), '--params', params, '--row-index', '0',
+               '--out-dir', str(tmp / 'startup_out'), '--format', 'none']
+    record(results, 'startup.run_one[task]', timed(lambda: run_command(command), repeats))
+    task = results['startup.run_one[task]']['seconds']
+    floor = results['startup.import_numpy']['seconds']
+    print(f"run_one.py task: {task * 1000:.0f} ms, target {RUN_ONE_TARGET * 1000:.0f} ms "
+          f"(python + numpy alone: {floor * 1000:.0f} ms on this box)")
+
+
+SUITES = {'kernel': bench_kernel, 'runners': bench_runners, 'collect': bench_collect, 'plot': bench_plot, 'startup': bench_startup,
+          'catalog': bench_catalog}
+
+
+def environment():
+    """What the numbers depend on besides the code."""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=ROOT)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def run(out, suites, level, repeats):
+    """Run the suites and write the JSON baseline."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in suites:
+            if name == 'kernel':
+                SUITES[name](results, level, repeats)
+            else:
+                SUITES[name](results, level, repeats, Path(tmp))
+    baseline = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'environment': environment(),
+        'results': results,
+    }
+    with open(out, 'w') as f:
+        json.dump(baseline, f, indent=4)
+    print(f"baseline written to {out}")
+    return baseline
+
+
+def compare(base_path, new_path, threshold):
+    """Compare two baselines benchmark by benchmark.
+
+    Returns:
+        List of the names of the benchmarks that got slower than
+        (1 + threshold) times the base
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if base['environment'] != new['environment']:
+        print("warning: the baselines come from different environments, the ratios mix code and machine")
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            print(f"{name:45s} new")
+            continue
+        ratio = result['seconds'] / base['results'][name]['seconds']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = 'faster'
+        print(f"{name:45s} {base['results'][name]['seconds']:.6g}s -> {result['seconds']:.6g}s  x{ratio:.2f} {flag}")
+    for name in base['results']:
+        if name not in new['results']:
+            print(f"{name:45s} missing")
+    return regressions
+
+
+def parse_args():
+    """Parse command line arguments for the benchmark suite.
+
+    Returns:
+        Parsed arguments of one of the subcommands:
+        - run: output JSON, suites, size level, repeats
+        - compare: base and new JSON, regression threshold
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="benchmarks of the model kernel, the sweep runners and the collector")
+    commands = my_parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the benchmarks and write a JSON baseline')
+    run_parser.add_argument('--out',type=str,default='baseline.json',help='Output JSON (default: baseline.json)')
+    run_parser.add_argument('--suites',nargs='+',choices=list(SUITES),default=list(SUITES),help='Suites to run (default: all)')
+    size = run_parser.add_mutually_exclusive_group()
+    size.add_argument('--quick',action='store_true',help='Smallest sizes only (a few seconds)')
+    size.add_argument('--full',action='store_true',help='Up to 10^7 steps and 10^4 rows/runs (minutes)')
+    run_parser.add_argument('--repeats',type=int,default=3,help='Repeats of each benchmark, the best is kept (default: 3; 1 for the largest sizes)')
+    compare_parser = commands.add_parser('compare', help='Compare a run with a baseline')
+    compare_parser.add_argument('base',type=str,help='Baseline JSON')
+    compare_parser.add_argument('new',type=str,help='JSON of the run to check')
+    compare_parser.add_argument('--threshold',type=float,default=0.25,help='Slowdown flagged as a regression, as a fraction (default: 0.25)')
+    return my_parser.parse_args()
+
+
+def main():
+    """Run the benchmarks, or compare two runs (exit code 1 on a regression)."""
+    args = parse_args()
+    if args.command == 'run':
+        level = 0 if args.quick else 2 if args.full else 1
+        run(args.out, args.suites, level, args.repeats)
+    else:
+        regressions = compare(args.base, args.new, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"no regression beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from bench import PARALLEL_DIR, SERIAL_DIR, mpi_available, mpirun_command, run_command, timed, write_params
+
+
+# metrics.csv columns that must not depend on the backend nor the worker count
+METRIC_COLUMNS = ['final_mailly', 'final_moulin', 'unmet_mailly', 'unmet_moulin', 'ambulance']
+
+
+def backend_command(backend, workers, params, out_dir, root_seed):
+    """Command line of one backend with `workers` workers (ranks for mpi, ignored for serial)."""
+    common = ['--params', params, '--out-dir', out_dir, '--root-seed', str(root_seed)]
+    if backend == 'serial':
+        return [sys.executable, str(SERIAL_DIR / 'run_serial.py')] + common
+    if backend == 'mpi':
+        return mpirun_command(workers) + [sys.executable, str(PARALLEL_DIR / 'run_mpi.py')] + common
+    return [sys.executable, str(PARALLEL_DIR / f'run_{backend}.py'), '--workers', str(workers)] + common
+
+
+def read_metrics(out_dir):
+    """run id -> metrics of a runner's metrics.csv (run_serial.py calls the id 'run')."""
+    df = pd.read_csv(Path(out_dir) / 'metrics.csv')
+    df = df.rename(columns={'run': 'run_id'})
+    return {int(row['run_id']): tuple(int(row[name]) for name in METRIC_COLUMNS) for _, row in df.iterrows()}
+
+
+def scaling_study(backends, workers, rows, rows_per_worker, steps, modes, repeats, root_seed, tmp):
+    """Time every backend at every worker count, in strong and/or weak scaling.
+
+    Strong scaling runs `rows` rows whatever the worker count, weak scaling
+    rows_per_worker rows per worker. Every row has its own stream under
+    root_seed (streams.py), and the first n rows of every params file are the
+    same, so a run must give the same metrics in every backend, every worker
+    count and both modes: any difference is reported.
+
+    Returns:
+        Tuple (table, mismatches): DataFrame with one line per (mode, backend,
+        workers) with rows, seconds, speedup and efficiency, and the list of
+        (mode, backend, workers, run_id) whose metrics differ from the first
+        result seen for that run
+    """
+    reference = {}
+    mismatches = []
+    lines = []
+    for mode in modes:
+        for backend in backends:
+            for n_workers in workers:
+                if backend == 'serial' and n_workers != 1:
+                    # one process whatever the count: the line every backend can be read against
+                    continue
+                n_rows = rows if mode == 'strong' else rows_per_worker * n_workers
+                params = str(tmp / f'params_{n_rows}.csv')
+                write_params(params, n_rows, steps)
+                out_dir = str(tmp / f'{mode}_{backend}_{n_workers}')
+                command = backend_command(backend, n_workers, params, out_dir, root_seed)
+                seconds = min(timed(lambda: run_command(command), repeats))
+                for run_id, values in read_metrics(out_dir).items():
+                    if reference.setdefault(run_id, values) != values:
+                        mismatches.append((mode, backend, n_workers, run_id))
+                lines.append({'mode': mode, 'backend': backend, 'workers': n_workers, 'rows': n_rows, 'seconds': seconds})
+                print(f"{mode:6s} {backend:8s} {n_workers:3d} workers {n_rows:6d} rows  {seconds:.3f}s")
+    table = pd.DataFrame(lines)
+    # against the same backend with one worker: strong T1 / Tp and T1 / (p Tp), weak T1 / Tp
+    t1 = table[table['workers'] == 1].set_index(['mode', 'backend'])['seconds']
+    base = table.set_index(['mode', 'backend']).index.map(t1).to_numpy()
+    table['speedup'] = base / table['seconds']
+    strong = table['mode'] == 'strong'
+    table['efficiency'] = table['speedup'].where(~strong, table['speedup'] / table['workers'])
+    table.loc[~strong, 'speedup'] = table.loc[~strong, 'speedup'] * table.loc[~strong, 'workers']
+    return table, mismatches
+
+
+def plot_scaling(table, path):
+    """Speedup and efficiency against workers, one line per backend, one column per mode."""
+    modes = list(dict.fromkeys(table['mode']))
+    fig, axes = plt.subplots(2, len(modes), figsize=(6 * len(modes), 8), squeeze=False)
+    for j, mode in enumerate(modes):
+        sub = table[table['mode'] == mode]
+        for backend, group in sub.groupby('backend', sort=False):
+            axes[0, j].plot(group['workers'], group['speedup'], marker='o', label=backend)
+            axes[1, j].plot(group['workers'], group['efficiency'], marker='o', label=backend)
+        workers = sorted(sub['workers'].unique())
+        axes[0, j].plot(workers, workers, 'k--', alpha=0.5, label='ideal')
+        axes[1, j].axhline(1.0, color='k', linestyle='--', alpha=0.5)
+        axes[0, j].set_title(f'{mode} scaling: speedup')
+        axes[1, j].set_title(f'{mode} scaling: parallel efficiency')
+        for ax in axes[:, j]:
+            ax.set_xlabel('Workers')
+            ax.set_xscale('log', base=2)
+            ax.grid(True, alpha=0.3)
+            ax.legend()
+    plt.tight_layout()
+    plt.savefig(path, dpi=100)
+    plt.close()
+
+
+def parse_args():
+    """Parse command line arguments for the scaling study.
+
+    Returns:
+        Parsed arguments containing:
+        - backends: Runners to compare (serial, parallel, threads, mpi)
+        - workers: Worker counts (1 is always added, it is the reference)
+        - rows: Rows of the strong scaling sweep
+        - rows_per_worker: Rows per worker of the weak scaling sweep
+        - steps: Steps of every row
+        - modes: strong and/or weak
+        - repeats: Repeats of each measure, the best is kept
+        - root_seed: Root seed of the streams
+        - out_dir: Output directory for scaling.csv and scaling.png
+
+    Note:
+        Use argparse.ArgumentParser to define all required and optional arguments
+    """
+    my_parser = argparse.ArgumentParser(description="strong and weak scaling of the sweep runners")
+    my_parser.add_argument('--backends',nargs='+',choices=['serial', 'parallel', 'threads', 'mpi'],default=None,
+                           help='Runners to compare (default: parallel, threads, and mpi when mpirun and mpi4py are there)')
+    my_parser.add_argument('--workers',type=int,nargs='+',default=[1, 2, 4],help='Worker counts (default: 1 2 4)')
+    my_parser.add_argument('--rows',type=int,default=256,help='Rows of the strong scaling sweep (default: 256)')
+    my_parser.add_argument('--rows-per-worker',type=int,default=64,help='Rows per worker of the weak scaling sweep (default: 64)')
+    my_parser.add_argument('--steps',type=int,default=2000,help='Steps of every row (default: 2000)')
+    my_parser.add_argument('--modes',nargs='+',choices=['strong', 'weak'],default=['strong', 'weak'],help='Scaling modes (default: both)')
+    my_parser.add_argument('--repeats',type=int,default=1,help='Repeats of each measure, the best is kept (default: 1)')
+    my_parser.add_argument('--root-seed',type=int,default=0,help='Root seed of the streams (default: 0)')
+    my_parser.add_argument('--out-dir',type=str,default='scaling',help='Output directory (default: scaling)')
+    return my_parser.parse_args()
+
+
+def main():
+    """Run the study, write the tables and the plot, exit 1 if a backend changed the metrics.
+
+    Output files:
+    - scaling.csv: mode, backend, workers, rows, seconds, speedup, efficiency
+    - scaling.png: speedup and efficiency against workers
+
+    Note:
+        Times are end to end, interpreter start-up included: with small
+        sweeps the fixed cost caps the speedup
+    """
+    args = parse_args()
+    backends = args.backends or ['parallel', 'threads'] + (['mpi'] if mpi_available() else [])
+    workers = sorted(set(args.workers) | {1})
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        table, mismatches = scaling_study(backends, workers, args.rows, args.rows_per_worker, args.steps,
+                                          args.modes, args.repeats, args.root_seed, Path(tmp))
+    table.to_csv(out_dir / 'scaling.csv', index=False)
+    plot_scaling(table, out_dir / 'scaling.png')
+    for mode in args.modes:
+        print(f"\n{mode} scaling")
+        print(table[table['mode'] == mode].pivot(index='workers', columns='backend', values=['speedup', 'efficiency']).round(2).to_string())
+    print(f"\ntables: {out_dir / 'scaling.csv'}, plot: {out_dir / 'scaling.png'}")
+    if mismatches:
+        print(f"{len(mismatches)} runs gave different metrics, e.g. (mode, backend, workers, run_id) = {mismatches[0]}")
+        sys.exit(1)
+    print("metrics identical across backends, worker counts and modes")
+
+
+if __name__ == "__main__":
+    main()
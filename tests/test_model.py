@@ -2,6 +2,10 @@ import unittest
 import subprocess
 import sys
 import os
+import tempfile
+import csv
+import json
+import time
 
 class TestIntegration(unittest.TestCase):
     
@@ -52,6 +56,33 @@ class TestIntegration(unittest.TestCase):
             '--seed', '42'
         ])
 
+    def test_1_run_basic_formats(self):
+        """Vérifie que les formats npy (memmap), compact et checkpoints donnent la même trajectoire que le csv"""
+        basic_dir = os.path.join(self.root_dir, '1_basic_single_sim')
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in ('csv', 'npy', 'compact', 'checkpoints'):
+                subprocess.run([sys.executable, 'run_single.py', '--steps', '500', '--p1', '0.5', '--p2', '0.5',
+                                '--init-mailly', '3', '--init-moulin', '2', '--seed', '7',
+                                '--out-csv', os.path.join(tmp, 'res.csv'), '--format', fmt,
+                                '--checkpoint-every', '100'],
+                               check=True, capture_output=True, cwd=basic_dir)
+            check = ("import numpy as np, pandas as pd\n"
+                     "from trajectory import load_trajectory\n"
+                     "from codec import CompactTrajectory\n"
+                     "from checkpoints import CheckpointedTrajectory\n"
+                     f"traj = load_trajectory(r'{os.path.join(tmp, 'res.npy')}')\n"
+                     f"compact = CompactTrajectory(r'{os.path.join(tmp, 'res.vtrj')}')\n"
+                     f"replay = CheckpointedTrajectory.load(r'{os.path.join(tmp, 'res_checkpoints.json')}')\n"
+                     f"df = pd.read_csv(r'{os.path.join(tmp, 'res.csv')}')\n"
+                     "assert len(traj) == len(compact) == len(df) == 500\n"
+                     "for col in ('time', 'mailly', 'moulin'):\n"
+                     "    assert (traj[col] == df[col].to_numpy()).all(), col\n"
+                     "    assert (compact[:][col] == df[col].to_numpy()).all(), col\n"
+                     "    assert (compact[123:321][col] == df[col].to_numpy()[123:321]).all(), col\n"
+                     "    assert (replay[123:321][col] == df[col].to_numpy()[123:321]).all(), col\n")
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=basic_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
     def test_2_run_serial(self):
         """Vérifie que le script 2_serial tourne"""
         # Create params.csv in 2_serial_param_sweep if not exists
@@ -72,6 +103,289 @@ class TestIntegration(unittest.TestCase):
         
         self.assertEqual(result.returncode, 0, "Le script 2_serial_param_sweep/run_serial.py a planté !")
 
+    def test_2_result_cache(self):
+        """Vérifie que le cache de résultats évite de relancer les simulations déjà faites"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        with tempfile.TemporaryDirectory() as tmp:
+            outputs = []
+            for name in ('a', 'b'):
+                out_dir = os.path.join(tmp, name)
+                result = subprocess.run([sys.executable, 'run_serial.py', '--params', 'params.csv', '--out-dir', out_dir,
+                                         '--cache-dir', os.path.join(tmp, 'cache')],
+                                        capture_output=True, text=True, cwd=serial_dir)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                outputs.append(result.stdout)
+                with open(os.path.join(out_dir, 'metrics.csv')) as f:
+                    outputs.append(f.read())
+            self.assertIn("0 hits", outputs[0])
+            self.assertIn("0 misses", outputs[2])
+            self.assertEqual(outputs[1], outputs[3])
+
+            # --plot without --cache-trajectories: no trajectory in the cache
+            plot_cache = os.path.join(tmp, 'plot_cache')
+            subprocess.run([sys.executable, 'run_serial.py', '--params', 'params.csv', '--out-dir', os.path.join(tmp, 'c'),
+                            '--cache-dir', plot_cache, '--plot'], check=True, capture_output=True, cwd=serial_dir)
+            cached = [name for _, _, names in os.walk(plot_cache) for name in names]
+            self.assertTrue(cached)
+            self.assertFalse([name for name in cached if '.npz' in name])
+
+            # the fingerprint covers stationarity.py (when a --stop-tol run stops) and streams.py
+            copy_dir = os.path.join(tmp, 'copy')
+            os.mkdir(copy_dir)
+            for name in ('model.py', 'stationarity.py', 'streams.py', 'result_cache.py'):
+                with open(os.path.join(serial_dir, name)) as src, open(os.path.join(copy_dir, name), 'w') as dst:
+                    dst.write(src.read())
+            code = "import model, result_cache; print(result_cache.model_fingerprint(model))"
+            fingerprints = []
+            for name in ('stationarity.py', 'streams.py', None):
+                fingerprints.append(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                                                   text=True, cwd=copy_dir).stdout)
+                if name is not None:
+                    with open(os.path.join(copy_dir, name), 'a') as f:
+                        f.write("\n# edited\n")
+            self.assertEqual(len(set(fingerprints)), 3)
+
+    def test_2_sweep_spec(self):
+        """Vérifie qu'une spec de sweep (lhs + grille + réplicats) est générée à la volée"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        with tempfile.TemporaryDirectory() as tmp:
+            spec = os.path.join(tmp, 'sweep.json')
+            with open(spec, 'w') as f:
+                f.write('{"sampler": "lhs", "fleet": 15, "steps": 20, "p1": {"min": 0.3, "max": 0.7},'
+                        ' "p2": [0.4, 0.6], "init_mailly": 5, "points": 4, "replicates": 2}')
+            result = subprocess.run([sys.executable, 'run_serial.py', '--spec', spec, '--out-dir', tmp, '--flush-every', '3'],
+                                    capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(os.path.join(tmp, 'metrics.csv')) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 16)
+        self.assertEqual([int(row['run']) for row in rows], list(range(16)))
+        # lhs: one p1 value per stratum
+        strata = sorted(int((float(row['p1']) - 0.3) / 0.4 * 4) for row in rows[::4])
+        self.assertEqual(strata, [0, 1, 2, 3])
+        self.assertEqual({row['p2'] for row in rows}, {'0.4', '0.6'})
+
+    def test_2_replicates_until_converged(self):
+        """Vérifie le mode réplicats : run_batch identique à run_simulation, arrêt sur l'intervalle de confiance"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        check = ("import numpy as np\n"
+                 "from model import run_simulation, run_batch\n"
+                 "b = run_batch(10, 5, 300, 0.5, 0.45, [np.random.default_rng([3, r]) for r in range(5)], block_size=64)\n"
+                 "for r in range(5):\n"
+                 "    res = run_simulation(10, 5, 300, 0.5, 0.45, [3, r])\n"
+                 "    assert all(res[k][-1] == b[k][r] for k in res)\n")
+        result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=serial_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run([sys.executable, 'run_serial.py', '--params', 'params.csv', '--out-dir', tmp,
+                                     '--ci-target', '0.1', '--batch-size', '8', '--max-replicates', '64'],
+                                    capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(os.path.join(tmp, 'metrics.csv')) as f:
+                rows = list(csv.DictReader(f))
+        for row in rows:
+            self.assertEqual(int(row['replicates']) % 8, 0)
+            self.assertLessEqual(int(row['replicates']), 64)
+            if row['converged'] == 'True':
+                half_width = 1.96 * float(row['unmet_moulin_se'])
+                self.assertLessEqual(half_width, max(0.1 * abs(float(row['unmet_moulin_mean'])), 0.5) + 1e-9)
+
+    def test_2_variance_reduction(self):
+        """Vérifie que les nombres aléatoires communs réduisent la variance des différences entre points voisins"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                for k in range(3):
+                    f.write(f"10,5,300,0.5,{0.45 + 0.01 * k},{k}\n")
+            result = subprocess.run([sys.executable, 'run_serial.py', '--params', params, '--out-dir', tmp, '--ci-target', '0.01',
+                                     '--max-replicates', '64', '--crn', '1', '--antithetic'],
+                                    capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn("variance reduction ambulance (crn", result.stdout)
+            with open(os.path.join(tmp, 'metrics.csv')) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual({row['seed'] for row in rows}, {'1'})
+        for row in rows[1:]:
+            self.assertGreater(float(row['ambulance_crn_vrf']), 1)
+
+    def test_2_surrogate(self):
+        """Vérifie la table de substitution : construction, rapport d'erreur et interpolation"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        with tempfile.TemporaryDirectory() as tmp:
+            table = os.path.join(tmp, 'table')
+            result = subprocess.run([sys.executable, 'surrogate.py', 'build', '--table', table, '--p1', '0.3', '0.7', '3',
+                                     '--p2', '0.3', '0.7', '3', '--split', '0', '1', '3', '--fleet', '5', '10',
+                                     '--horizon', '50', '100', '--replicates', '8', '--holdout', '3', '--holdout-replicates', '8'],
+                                    capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(table + '.json') as f:
+                self.assertIn('holdout', f.read())
+            query = ("from surrogate import SurrogateTable\n"
+                     f"s = SurrogateTable({table!r})\n"
+                     "a = s.query(0.5, 0.5, 10, 5, 100)['unmet_mailly'][0]\n"
+                     "b = s.query(0.5, 0.5, 5, 2.5, 100)['unmet_mailly'][0]\n"
+                     "c = s.query(0.5, 0.5, 7.5, 5 * 7.5 / 10, 100)['unmet_mailly'][0]\n"
+                     "assert a == float(s.table[1, 1, 1, 1, 1, 2, 0])\n"
+                     "assert abs(c - (a + b) / 2) < 1e-4\n"
+                     # un axe à une seule valeur n'accepte que cette valeur
+                     "from surrogate import _locate\n"
+                     "assert _locate([10], 10, 'fleet') == (0, 0.0)\n"
+                     "try:\n"
+                     "    _locate([10], 12, 'fleet')\n"
+                     "    raise AssertionError('fleet 12 accepted')\n"
+                     "except ValueError:\n"
+                     "    pass\n")
+            result = subprocess.run([sys.executable, '-c', query], capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            # hors de la table : un message d'erreur, pas une trace
+            result = subprocess.run([sys.executable, 'surrogate.py', 'query', '--table', table, '--p1', '0.5', '--p2', '0.5',
+                                     '--fleet', '10', '--init-mailly', '5', '--steps', '5000'],
+                                    capture_output=True, text=True, cwd=serial_dir)
+            self.assertNotEqual(result.returncode, 0)
+            self.assertIn('error: horizon 5000 is outside the table', result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+
+    def test_2_stationarity(self):
+        """Vérifie l'arrêt anticipé : moins de pas, et les mêmes valeurs qu'un run de steps_used pas"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                f.write("10,5,100000,0.5,0.2,1\n")
+                f.write("5,5,100000,0.9,0.95,2\n")
+            out_dir = os.path.join(tmp, 'out')
+            self.run_script('2_serial_param_sweep/run_serial.py', ['--params', params, '--out-dir', out_dir, '--stop-tol', '0.05'])
+            with open(os.path.join(out_dir, 'metrics.csv')) as f:
+                rows = list(csv.DictReader(f))
+            check = ("from model import run_simulation\n"
+                     "from stationarity import mser_truncation\n"
+                     "import numpy as np\n"
+                     "assert mser_truncation(np.r_[np.full(500, 10.0), np.random.default_rng(0).random(5000)]) >= 500\n")
+            for row in rows:
+                steps_used = int(row['steps_used'])
+                self.assertLess(steps_used, 100000)
+                check += (f"r = run_simulation({int(float(row['init_mailly']))}, {int(float(row['init_moulin']))}, {steps_used}, "
+                          f"{row['p1']}, {row['p2']}, {int(float(row['seed']))})\n"
+                          f"assert r['unmet_mailly'][-1] == {row['unmet_mailly']} and r['mailly'][-1] == {row['final_mailly']}\n")
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=serial_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_2_rebalancing(self):
+        """Vérifie la politique de rééquilibrage (run_simulation = run_batch) et l'optimiseur"""
+        serial_dir = os.path.join(self.root_dir, '2_serial_param_sweep')
+        check = ("from model import run_simulation, run_batch, ThresholdPolicy\n"
+                 "from streams import generator, stream\n"
+                 "rngs = [generator(stream(0, 0, r)) for r in range(3)]\n"
+                 "b = run_batch(10, 5, 300, 0.5, 0.4, rngs, block_size=32, policy=(3, 2, 7))\n"
+                 "for r in range(3):\n"
+                 "    s = run_simulation(10, 5, 300, 0.5, 0.4, stream(0, 0, r), rebalance=ThresholdPolicy(3, 2, 7))\n"
+                 "    assert all(s[key][-1] == b[key][r] for key in b)\n")
+        result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=serial_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'policy.json')
+            self.run_script('2_serial_param_sweep/rebalancing.py', ['--init-mailly', '8', '--init-moulin', '7', '--steps', '1000',
+                                                                    '--p1', '0.3', '--p2', '0.3', '--move-cost', '0.5',
+                                                                    '--max-replicates', '32', '--out', out])
+            with open(out) as f:
+                result = json.load(f)
+            # measured on fresh replicates, not on those that picked the winner
+            self.assertEqual((result['search_replicates'], result['replicates']), (32, 32))
+            self.assertGreater(result['improvement'], 2 * result['improvement_se'])
+
+    def test_2_observers(self):
+        """Vérifie les observateurs : mêmes runs avec ou sans, et des compteurs cohérents avec les métriques"""
+        check = ("from model import run_simulation, Observer, ThresholdPolicy\n"
+                 "class Count(Observer):\n"
+                 "    every = 100\n"
+                 "    def __init__(self):\n"
+                 "        self.n = {'trip': 0, 'unmet': 0, 'empty': 0, 'step': 0}\n"
+                 "    def on_trip(self, t, station): self.n['trip'] += 1\n"
+                 "    def on_unmet(self, t, station): self.n['unmet'] += 1\n"
+                 "    def on_empty(self, t, station): self.n['empty'] += 1\n"
+                 "    def on_step(self, t, state): self.n['step'] += 1\n"
+                 "count = Count()\n"
+                 "fast = run_simulation(3, 2, 5000, 0.5, 0.4, 7)\n"
+                 "assert run_simulation(3, 2, 5000, 0.5, 0.4, 7, observers=[count, Observer()]) == fast\n"
+                 "after = run_simulation(3, 2, 5001, 0.5, 0.4, 7)\n"
+                 "assert count.n['unmet'] == after['unmet_mailly'][-1] + after['unmet_moulin'][-1] > 0\n"
+                 "assert count.n['step'] == 50 and 0 < count.n['empty'] < count.n['trip']\n"
+                 "a = run_simulation(3, 2, 5000, 0.5, 0.4, 7, stop_tol=0.1, check_every=500)\n"
+                 "b = run_simulation(3, 2, 5000, 0.5, 0.4, 7, stop_tol=0.1, check_every=500, observers=[Count()])\n"
+                 "assert a == b\n")
+        for folder in ('2_serial_param_sweep', '3_parallel_local'):
+            result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                    cwd=os.path.join(self.root_dir, folder))
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_3_chunked_kernel(self):
+        """Vérifie le noyau NumPy par blocs : mêmes runs que la boucle pas à pas, y compris aux bords et avec --stop-tol"""
+        check = ("import numpy as np\n"
+                 "from model import run_simulation, run_simulation_chunked\n"
+                 "for args in [(10, 5, 40000, 0.5, 0.4, 1), (0, 3, 3000, 0.9, 0.1, 2), (0, 0, 100, 0.5, 0.5, 3),\n"
+                 "             (7, 0, 5000, 0.2, 0.8, np.random.SeedSequence(4, spawn_key=(1, 0)))]:\n"
+                 "    for extra in [{}, {'stop_tol': 0.1, 'check_every': 500}]:\n"
+                 "        slow = run_simulation(*args, **extra)\n"
+                 "        fast = run_simulation_chunked(*args, **extra)\n"
+                 "        slow.pop('moves', None)\n"
+                 "        assert {k: list(v) for k, v in fast.items()} == slow, (args, extra)\n")
+        result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                cwd=os.path.join(self.root_dir, '3_parallel_local'))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with tempfile.TemporaryDirectory() as tmp:
+            outputs = []
+            for kernel in ('numpy', 'python'):
+                out_dir = os.path.join(tmp, kernel)
+                self.run_script('3_parallel_local/run_threads.py', ['--params', self.params_file, '--out-dir', out_dir,
+                                                                    '--workers', '2', '--kernel', kernel])
+                with open(os.path.join(out_dir, 'metrics.csv')) as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_2_plotting(self):
+        """Vérifie plotting.py : lissage O(n) identique à convolve, extrêmes gardés, et les figures de tous les runs"""
+        check = ("import numpy as np\n"
+                 "from plotting import rolling_mean, minmax, lttb, summarize_run\n"
+                 "v = np.random.default_rng(0).integers(0, 20, 100003)\n"
+                 "for w in (1, 7, 100):\n"
+                 "    assert np.allclose(rolling_mean(v, w), np.convolve(v, np.ones(w) / w, mode='valid'), rtol=0, atol=1e-9)\n"
+                 "i = minmax(v, 2000)\n"
+                 "assert len(i) <= 2004 and i[0] == 0 and v[i].min() == v.min() and v[i].max() == v.max() and i[-1] == len(v) - 1\n"
+                 "j = lttb(v, 500)\n"
+                 "assert len(j) == 500 and j[0] == 0 and j[-1] == len(v) - 1 and (np.diff(j) > 0).all()\n"
+                 "s = summarize_run({'mailly': v, 'moulin': 20 - v}, smooth_window=10)\n"
+                 "assert set(s) == {'mailly', 'moulin'} and len(s['mailly'][0]) <= 2004 and s['mailly'][0][0] == 9\n")
+        result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                                cwd=os.path.join(self.root_dir, '2_serial_param_sweep'))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.run_script('2_serial_param_sweep/run_serial.py', ['--params', self.params_file, '--out-dir', tmp,
+                                                                   '--plot', '--smooth-window', '2', '--plot-method', 'lttb'])
+            for name in ('plot.png', 'plot_overlay.png', 'plot_grid_0.png'):
+                self.assertTrue(os.path.exists(os.path.join(tmp, name)), name)
+
+    def test_2_profile(self):
+        """Vérifie --profile : timing.json avec les phases et le temps de chaque run"""
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                f.writelines(f"10,5,500,0.5,0.4,{i}\n" for i in range(4))
+            for script, extra in [('2_serial_param_sweep/run_serial.py', ['--profile-capture', 'cprofile']),
+                                  ('3_parallel_local/run_threads.py', ['--workers', '2'])]:
+                out_dir = os.path.join(tmp, os.path.basename(script))
+                self.run_script(script, ['--params', params, '--out-dir', out_dir, '--profile'] + extra)
+                with open(os.path.join(out_dir, 'timing.json')) as f:
+                    timing = json.load(f)
+                self.assertIn('read_params', timing['phases'])
+                self.assertEqual(timing['phases']['simulate']['calls'], 4)
+                self.assertEqual(sorted(timing['tasks']['id']), [0, 1, 2, 3])
+                self.assertLessEqual(timing['task_stats']['wall_p50'], timing['task_stats']['wall_max'])
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'run_serial.py', 'profile.prof')))
+
     def test_3_run_parallel(self):
         """Vérifie que le script 3_parallel tourne (Mode Multiprocessing)"""
         # Create params.csv in 3_parallel_local if not exists
@@ -91,6 +405,254 @@ class TestIntegration(unittest.TestCase):
             print("STDERR:", result.stderr)
         
         self.assertEqual(result.returncode, 0, "Le script 3_parallel_local/run_parallel.py a planté !")
+    def test_3_plot_without_rerun(self):
+        """Vérifie que --plot marche avec les trajectoires renvoyées par les workers (processus et threads)"""
+        parallel_dir = os.path.join(self.root_dir, '3_parallel_local')
+        for script in ('run_parallel.py', 'run_threads.py'):
+            with tempfile.TemporaryDirectory() as tmp:
+                result = subprocess.run([sys.executable, script, '--params', 'params.csv', '--out-dir', tmp,
+                                         '--workers', '2', '--plot'],
+                                        capture_output=True, text=True, cwd=parallel_dir)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertTrue(os.path.exists(os.path.join(tmp, 'plot.png')))
+        # parent tué pendant le sweep : les blocs de mémoire partagée ne restent pas dans /dev/shm
+        before = set(os.listdir('/dev/shm'))
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                f.writelines(f"10,10,20000,0.3,0.2,{seed}\n" for seed in range(200))
+            proc = subprocess.Popen([sys.executable, 'run_parallel.py', '--params', params, '--out-dir', tmp,
+                                     '--workers', '2', '--plot'],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=parallel_dir)
+            deadline = time.time() + 60
+            while not set(os.listdir('/dev/shm')) - before and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(set(os.listdir('/dev/shm')) - before, "aucun bloc créé")
+            proc.kill()
+            proc.wait()
+            deadline = time.time() + 10
+            while set(os.listdir('/dev/shm')) - before and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(set(os.listdir('/dev/shm')) - before, set())
+
+    def test_3_adaptive(self):
+        """Vérifie que le sweep adaptatif raffine seulement une partie de la grille et reste précis"""
+        parallel_dir = os.path.join(self.root_dir, '3_parallel_local')
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run([sys.executable, 'run_adaptive.py', '--steps', '300', '--coarse', '3', '--max-level', '2',
+                                     '--replicates', '2', '--workers', '2', '--check-dense', '--out-dir', tmp],
+                                    capture_output=True, text=True, cwd=parallel_dir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(os.path.join(tmp, 'adaptive_points.csv')) as f:
+                n_points = len(list(csv.DictReader(f)))
+            with open(os.path.join(tmp, 'dense_check.csv')) as f:
+                dense = list(csv.DictReader(f))
+        self.assertLess(n_points, len(dense))
+        error = max(abs(float(row['unmet_total_adaptive']) - float(row['unmet_total'])) for row in dense)
+        self.assertLess(error, 0.1 * max(float(row['unmet_total']) for row in dense))
+
+    def test_3_telemetry(self):
+        """Vérifie la télémétrie : runs réussis/échoués des threads, et enregistrements des tâches run_one"""
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                f.writelines(f"10,5,500,0.5,0.4,{i}\n" for i in range(3))
+                # no step at all: the run raises
+                f.write("10,5,0,0.5,0.4,3\n")
+            jsonl = os.path.join(tmp, 'threads.jsonl')
+            out_dir = os.path.join(tmp, 'out')
+            self.run_script('3_parallel_local/run_threads.py', ['--params', params, '--out-dir', out_dir, '--workers', '2',
+                                                                '--progress', '--telemetry', jsonl])
+            with open(jsonl) as f:
+                last = [json.loads(line) for line in f][-1]
+            self.assertEqual((last['status'], last['done'], last['failed'], last['pending']), ('done', 3, 1, 0))
+            self.assertEqual(last['steps'], 1500)
+            self.assertEqual(sum(worker['tasks'] for worker in last['workers'].values()), 4)
+            with open(os.path.join(out_dir, 'metrics.csv')) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 3)
+
+            jsonl = os.path.join(tmp, 'array.jsonl')
+            # row 9 does not exist: the task gives up and is recorded as failed
+            for row_index in (0, 1, 9):
+                subprocess.run([sys.executable, os.path.join(self.root_dir, '4_cluster_slurm/run_one.py'), '--params', params,
+                                '--row-index', str(row_index), '--out-dir', os.path.join(tmp, 'runs'), '--telemetry', jsonl],
+                               capture_output=True, text=True)
+            result = subprocess.run([sys.executable, os.path.join(self.root_dir, '4_cluster_slurm/telemetry.py'), 'status', jsonl],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn("[2/4 done, 1 failed, 1 pending]", result.stdout)
+
+    def test_3_work_queue(self):
+        """Vérifie la file de tâches : la tâche d'un worker mort revient, et les métriques sont celles de run_parallel"""
+        parallel_dir = os.path.join(self.root_dir, '3_parallel_local')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("steps,p1,p2,init_mailly,init_moulin,seed\n")
+                f.writelines(f"200,{p1},0.5,10,5,{i}\n" for i, p1 in enumerate([0.2, 0.4, 0.6, 0.8]))
+            queue_dir = os.path.join(tmp, 'queue')
+
+            def run_queue(*options):
+                return subprocess.run([sys.executable, 'run_queue.py', *options], check=True, capture_output=True,
+                                      text=True, cwd=parallel_dir).stdout
+
+            run_queue('submit', queue_dir, '--params', params, '--root-seed', '3', '--lease', '5')
+            # a worker that died holding run 2: its lease is an hour old
+            lease = os.path.join(queue_dir, 'leases', '2@deadhost-1.json')
+            os.rename(os.path.join(queue_dir, 'tasks', '2.json'), lease)
+            os.utime(lease, (0, os.stat(lease).st_mtime - 3600))
+            self.assertIn('1 expired leases requeued', run_queue('worker', queue_dir, '--workers', '2'))
+            run_queue('worker', queue_dir)  # nothing left: no run is done twice
+            self.assertIn('4/4 done, 0 failed, 0 pending, 0 leased', run_queue('status', queue_dir))
+            run_queue('collect', queue_dir, '--out-dir', os.path.join(tmp, 'queue_out'))
+            subprocess.run([sys.executable, 'run_parallel.py', '--params', params, '--root-seed', '3', '--workers', '2',
+                            '--out-dir', os.path.join(tmp, 'parallel_out')], check=True, capture_output=True, cwd=parallel_dir)
+            with open(os.path.join(tmp, 'queue_out', 'metrics.csv')) as f:
+                from_queue = f.read()
+            with open(os.path.join(tmp, 'parallel_out', 'metrics.csv')) as f:
+                self.assertEqual(from_queue, f.read())
+            # une tâche restée 2 minutes dans tasks/ : une fois prise, un autre worker ne la remet pas en file
+            old_queue = os.path.join(tmp, 'old_queue')
+            run_queue('submit', old_queue, '--params', params, '--lease', '60')
+            for name in os.listdir(os.path.join(old_queue, 'tasks')):
+                task = os.path.join(old_queue, 'tasks', name)
+                os.utime(task, (0, os.stat(task).st_mtime - 120))
+            claimed = subprocess.run([sys.executable, '-c', 'import sys; from pathlib import Path; from run_queue import claim, requeue_expired; '
+                                      'd = Path(sys.argv[1]); task, lease = claim(d, "A"); '
+                                      'print(requeue_expired(d, 60, "B"), lease.exists())', old_queue],
+                                     check=True, capture_output=True, text=True, cwd=parallel_dir).stdout
+            self.assertEqual(claimed.split(), ['0', 'True'])
+
+    def test_3_streams_independent_of_workers(self):
+        """Vérifie qu'avec --root-seed les métriques sont identiques quel que soit le backend et le nombre de workers"""
+        with tempfile.TemporaryDirectory() as tmp:
+            spec = os.path.join(tmp, 'sweep.json')
+            with open(spec, 'w') as f:
+                f.write('{"sampler": "random", "fleet": 15, "steps": 200, "p1": {"min": 0.3, "max": 0.7},'
+                        ' "p2": {"min": 0.3, "max": 0.7}, "init_mailly": [5, 10], "points": 5, "replicates": 2}')
+            runs = [('2_serial_param_sweep', 'run_serial.py', []),
+                    ('3_parallel_local', 'run_parallel.py', ['--workers', '1', '--chunksize', '1']),
+                    ('3_parallel_local', 'run_parallel.py', ['--workers', '3', '--chunksize', '4', '--flush-every', '3']),
+                    ('3_parallel_local', 'run_threads.py', ['--workers', '4']),
+                    # metrics.csv écrit par morceaux de 3 lignes, toujours dans l'ordre des runs
+                    ('3_parallel_local', 'run_threads.py', ['--workers', '4', '--flush-every', '3'])]
+            outputs = []
+            for k, (folder, script, extra) in enumerate(runs):
+                out_dir = os.path.join(tmp, str(k))
+                result = subprocess.run([sys.executable, script, '--spec', spec, '--root-seed', '11', '--out-dir', out_dir] + extra,
+                                        capture_output=True, text=True, cwd=os.path.join(self.root_dir, folder))
+                self.assertEqual(result.returncode, 0, result.stderr)
+                with open(os.path.join(out_dir, 'metrics.csv')) as f:
+                    outputs.append([(row['unmet_mailly'], row['unmet_moulin'], row['ambulance']) for row in csv.DictReader(f)])
+        self.assertEqual(len(outputs[0]), 20)
+        for output in outputs[1:]:
+            self.assertEqual(output, outputs[0])
+
+    def test_4_collect_incremental(self):
+        """Vérifie que collect_results ne relit que les nouveaux runs (manifest)"""
+        slurm_dir = os.path.join(self.root_dir, '4_cluster_slurm')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("init_mailly,init_moulin,steps,p1,p2,seed\n")
+                for seed in range(3):
+                    f.write(f"10,5,5,0.5,0.5,{seed}\n")
+            runs_dir = os.path.join(tmp, 'runs')
+            agg_dir = os.path.join(tmp, 'agg')
+
+            def run_one(row):
+                subprocess.run([sys.executable, 'run_one.py', '--params', params, '--row-index', str(row),
+                                '--out-dir', runs_dir], check=True, capture_output=True, cwd=slurm_dir)
+
+            def collect():
+                result = subprocess.run([sys.executable, 'collect_results.py', '--in-dir', runs_dir, '--out-dir', agg_dir],
+                                        check=True, capture_output=True, text=True, cwd=slurm_dir)
+                return result.stdout
+
+            run_one(0)
+            run_one(1)
+            self.assertIn("collected 2 new", collect())
+            self.assertIn("collected 0 new", collect())
+            run_one(2)
+            run_one(0)  # rerun: the run changed
+            self.assertIn("collected 2 new", collect())
+
+            with open(os.path.join(agg_dir, 'metrics.csv')) as f:
+                run_ids = sorted(int(row['run_id']) for row in csv.DictReader(f))
+            self.assertEqual(run_ids, [0, 1, 2])
+
+    def test_4_run_one_startup(self):
+        """Vérifie qu'une tâche du tableau SLURM n'importe pas pandas, et que --format none n'écrit que les métriques"""
+        slurm_dir = os.path.join(self.root_dir, '4_cluster_slurm')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("steps,p1,p2,init_mailly,init_moulin,seed\n100,0.5,0.5,10,10,42\n")
+            code = ("import runpy, sys; runpy.run_path('run_one.py', run_name='__main__'); "
+                    "print('pandas' in sys.modules, 'matplotlib' in sys.modules)")
+            result = subprocess.run([sys.executable, '-c', code, '--params', params, '--row-index', '0', '--out-dir', tmp,
+                                     '--format', 'none'], check=True, capture_output=True, text=True, cwd=slurm_dir)
+            self.assertEqual(result.stdout.split()[-2:], ['False', 'False'])
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp, '0'))), ['metadata.json', 'metrics.csv'])
+
+    def test_4_catalog(self):
+        """Vérifie le catalogue SQLite : insertions par les tâches et le collecteur, requête indexée, import d'un CSV"""
+        slurm_dir = os.path.join(self.root_dir, '4_cluster_slurm')
+        with tempfile.TemporaryDirectory() as tmp:
+            params = os.path.join(tmp, 'params.csv')
+            with open(params, 'w') as f:
+                f.write("steps,p1,p2,init_mailly,init_moulin,seed\n")
+                f.writelines(f"100,{p1},0.5,10,5,{i}\n" for i, p1 in enumerate([0.2, 0.7, 0.9]))
+            runs_dir = os.path.join(tmp, 'runs')
+            tasks_db = os.path.join(tmp, 'tasks.db')
+            for row in (0, 1, 2, 1):  # rerun: the row is replaced
+                subprocess.run([sys.executable, 'run_one.py', '--params', params, '--row-index', str(row), '--out-dir', runs_dir,
+                                '--format', 'none', '--catalog', tasks_db], check=True, capture_output=True, cwd=slurm_dir)
+            collected_db = os.path.join(tmp, 'collected.db')
+            subprocess.run([sys.executable, 'collect_results.py', '--in-dir', runs_dir, '--out-dir', os.path.join(tmp, 'agg'),
+                            '--catalog', collected_db], check=True, capture_output=True, cwd=slurm_dir)
+            imported_db = os.path.join(tmp, 'imported.db')
+            subprocess.run([sys.executable, 'catalog.py', 'import', imported_db, os.path.join(tmp, 'agg', 'metrics.csv')],
+                           check=True, capture_output=True, cwd=slurm_dir)
+
+            def query(db, *options):
+                result = subprocess.run([sys.executable, 'catalog.py', 'query', db, *options],
+                                        check=True, capture_output=True, text=True, cwd=slurm_dir)
+                return result.stdout, result.stderr
+
+            for db in (tasks_db, collected_db, imported_db):
+                self.assertEqual(query(db, '--count')[0].strip(), '3')
+                stdout, stderr = query(db, '--where', 'p1 > 0.5', '--columns', 'run_id', 'p1', 'unmet_moulin', '--explain')
+                self.assertEqual(sorted(int(row['run_id']) for row in csv.DictReader(stdout.splitlines())), [1, 2])
+                self.assertIn('idx_p1', stderr)
+
+    def test_benchmarks_compare(self):
+        """Vérifie le banc d'essai : une base JSON, et compare signale un ralentissement"""
+        with tempfile.TemporaryDirectory() as tmp:
+            base = os.path.join(tmp, 'base.json')
+            self.run_script('benchmarks/bench.py', ['run', '--quick', '--suites', 'kernel', '--repeats', '1', '--out', base])
+            self.run_script('benchmarks/bench.py', ['compare', base, base])
+            with open(base) as f:
+                slower = json.load(f)
+            slower['results']['kernel.step']['seconds'] *= 2
+            new = os.path.join(tmp, 'new.json')
+            with open(new, 'w') as f:
+                json.dump(slower, f)
+            result = subprocess.run([sys.executable, os.path.join(self.root_dir, 'benchmarks', 'bench.py'), 'compare', base, new],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn('kernel.step', result.stdout.split('regression')[-1])
+
+    def test_benchmarks_scaling(self):
+        """Vérifie l'étude de passage à l'échelle : tables, graphe et métriques identiques entre backends"""
+        with tempfile.TemporaryDirectory() as tmp:
+            self.run_script('benchmarks/scaling.py', ['--backends', 'parallel', 'threads', '--workers', '2', '--modes', 'strong',
+                                                      '--rows', '8', '--steps', '50', '--out-dir', tmp])
+            with open(os.path.join(tmp, 'scaling.csv')) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 4)
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'scaling.png')))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file